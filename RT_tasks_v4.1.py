@@ -9,111 +9,115 @@ Made for PsychoPy-2022.2.4 © 2002-2018 Jonathan Peirce © 2019 Open Science Too
 """
 # %% Import Necessary Packages
 #from ast import main
-import sys, os
-from sqlite3 import Timestamp
+import sys, os, time
+launched = time.perf_counter()                                      # the startup is timed from here to the first instruction screen
 from datetime import datetime
 import numpy as np
-from psychopy import visual, core, event, clock, gui, data, parallel
-import PyQt5
+simulate = '--simulate' in sys.argv # runs a headless session on a virtual clock with a simulated participant, see simulation.py
+if simulate:
+    from simulation import visual, core, gui
+else:
+    from psychopy import core, gui                                  # psychopy.visual is imported by the preflight after the dialog
 #from psychopy.tools.filetools import fromFile, toFile
-import random, csv, time, serial, math
+import random, csv, math
+from startup import StartupTimer, Preflight, checkFolders, checkDisplay, checkLoopback, likelySubjects
+from scheduler import buildTrialTimeline, measureFrameDur
+from markers import MarkerPort, NullBackend, ParallelBackend
+from responses import ResponseCollector, KeyboardBackend, EventBackend, ScriptedBackend
+from instrumentation import TimingLog
+from recordio import RecordBuffer, Flusher
+from monitor import Monitor
+from quality import QualityCheck
+from realtime import RealtimeMode
+from adaptive import RTEstimator
+from checkpoint import Journal, lastCheckpoint, truncateData
+from clocksync import ClockSync, MarkerFileReader
+from emg import EMGStream, SocketSource, noMEP
+from design import designSpec, createPlan, planDigest, requeue
+from stimcache import StimulusCache, FeedbackCache
+from tms import TMSDriver, SerialBackend, NullBackend as NullSerialBackend
+startupTimer = StartupTimer(launched)
+startupTimer.mark('imports')
 
 #%%
-debug = True # disables serial and parallel triggers, for testing.
-
-############## Experiment settings ##################
-tasks = ['SRT_L', 'SRT_R', 'UCRT', 'ICRT']      # a list of which tasks to be run: 'SRT_L', 'SRT_R', 'UCRT', 'ICRT'
-ITI = (4000, 5000)                              # sets the range of the ITI in ms.
-PCISI = (900, 900)                              # sets the range of the interval between PC and IS in ICRT (in ms).
-maxRT = 1000                                    # the maximum allowd time to respons anfter IS, in ms
-RTtrials = 2                                   # the number of trials used to determine mean RT for TMS at 50%RT. If set to zero
-catchRatio = 0.1                                # the amount of catch trials to be added, relative to non-catch trials
-trialsPerStimtimePerCondition = 1              # the number of trials for each stimulation, per hand per task. 
-baselinesPerCondition = 1                       # the number of baseline EMG trials, per hand per task.
-bl_before = 0                                  # Number of MEP baselines before &
-bl_after = 0                                    # after the experimental tasks
-enableBreaks = True                             # enables brakes for the participant to rest
-breakInterval = 10*60                           # enables a break every 10th minute (600th s)
-
-keyLeft = 'a' # For left index finger button presses
-keyRight = 'g' # For right index finger button presses
-keyContinue = 'd' # For user to continue (middle keypad button)
-
-######## TMS stimulation times #################
-stimTime_BL = -500                               # the time at which to stimulate with TMS for baseline EMG measurement
-stimTimes_SRT_L = [-100, 'halfRT']                # the times at which to stimulate with TMS in SRT_L task, relative to imperative signal
-stimTimes_SRT_R = [-100, 'halfRT']                # the times at which to stimulate with TMS in SRT_L task, relative to imperative signal
-stimTimes_UCRT = [-100, 'halfRT']                 # the times at which to stimulate with TMS in UCRT task, relative to imperative signal
-stimTimes_ICRT = [-100, 'halfRT']                 # the times at which to stimulate with TMS in ICRT task, relative to imperative signal
-
-#NOTE: halfRT is in fact taskandhandspecificRT/3
+from settings import *                                              # the experiment settings, the keys and the trigger codes, see settings.py
 
 ############ paralell port trigger setup ############
-# Set trigger duration (minimum trigger duration depend on sampling rate of EEG system: e.g. 250hz == 8ms, 500hz == 4ms, 1000hz == 2ms)
-trig_wait = 0.001
-# Set parallel port address
-if not debug:
-    para = parallel.ParallelPort(address=0x378)
-    para.setData(0) #set all pins low
+# Markers are sent from a worker thread, so the trial loop never waits on the port
+def openMarkers():
+    """opens the parallel port, run by the preflight while the dialog is open"""
+    if simulate:
+        from simulation import SimMarkerPort
+        return SimMarkerPort(pulseWidth = trig_wait, clock = globalTimer.getTime)
+    markerBackend = NullBackend() if debug else ParallelBackend(address = parallelAddress)
+    return MarkerPort(markerBackend, pulseWidth = trig_wait, clock = globalTimer.getTime)   # marker edges are timestamped on the session clock
 
 def sendRemark(trigger):
-    if not debug:
-        para.setData(trigger)
-        core.wait(trig_wait)
-        para.setData(0)
-
-t_goLeft = 1
-t_goRight = 2
-
-t_SRT_gL = 11 # go left in SRT
-t_SRT_gR = 12 # go right in SRT
-
-t_UCRT_gL = 21 # go left in UCRT
-t_UCRT_gR = 22 # go right in UCRT
-
-t_ICRT_gL = 31 # go left in ICRT
-t_ICRT_gR = 32 # go right in ICRT
-
-t_pCue = 50 # preparatory cue
-
-t_X = 8 # catch signal X
-t_fixStart = 9 # fixation start
-t_respL = 65 # left hand response
-t_respR = 70 # right hand response
-t_respError = 75 # a response which is neither right nor left. (should not happen)
-
-t_timeout = 80 # trial timeout - if no response
-t_trialEnd = 99 # end of current trial
-t_TMS = 100 # TMS sent
-t_startExp = 111 # start of experiment
-t_startBlock = 112 # start of block
-t_pause = 113 #pause
-
-t_endExp = 255 # experiment finished
-
+    markers.send(trigger)
 
 ############ serial port TMS trigger setup ###########
-# Set serial send period to 1ms
-ser_wait = 0.001
-if not debug: 
-    ser = serial.Serial('COM1', baudrate = 9600, timeout = 0)
+def openTMS():
+    """opens the serial port, run by the preflight while the dialog is open"""
+    tmsBackend = NullSerialBackend() if debug or simulate else SerialBackend(serialPort, baudrate = serialBaudrate)
+    return TMSDriver(tmsBackend, code = t_TMS, pulseWidth = ser_wait, drain = True, clock = globalTimer.getTime)   # the pulse is pre-encoded, the port set back to 0 from a thread
 
 def sendTMS():
-    if not debug:
-        ser.write(100)
-        core.wait(ser_wait)
-        ser.write(0)
+    """sends the TMS trigger and returns the latency in ms until the byte has left the serial port"""
+    return tms.fire()
 #########################################################
 
-# %% Create log, info and data folders if not existing:
-for folder in ['info', 'log', 'data']:
-    if not os.path.exists(folder):
-        os.makedirs(folder)
+dir_path = os.path.dirname(os.path.realpath(__file__))     # Get the current directory of this script file. 
+if simulate:
+    dir_path = os.path.join(dir_path, 'sim_output')         # simulated sessions never mix with real data
+
+# %% The trial plan, see design.py
+def createTrialList(randomSeed, RTTrials, catchRatio, trialsPerStimtimePerCondition, baselinesPerCondition, tasks = ['SRT_L', 'SRT_R', 'UCRT', 'ICRT']):
+    """creates a list of tuples, eact tuple representing one set of conditions for each trial. See design.py
+
+    Args:
+        randomSeed (_int_): used for randomizing order of trials and tasks. The same seed always gives the same list.
+        RTTrials (_int_): number of "training" trials per hand per task used to calculate meanRT. 
+        catchRatio (_float_): between 0 and 1: a number of catch trials per non-catch trial,
+         which is added to the total number of trials. (ratio is really the wrong word but). 
+        trialsPerStimtimePerCondition (_int_): the number of trials per stimulation time per hand. 
+        baselinesPerCondition (_int_): the number of baseline trials per hand.
+        tasks (_list_): the tasks to include.
+
+    Returns:
+        _iterable_:  list of tuples, where one trial of the experiment is represented as one tuple
+            each tuple has the structure (task, right, tms_time, is_catch, is_train)
+    """
+    spec = designSpec(tasks, stimTimes, stimTime_BL, RTTrials, catchRatio, trialsPerStimtimePerCondition, baselinesPerCondition, maxRun = maxRun)
+    return createPlan(spec, randomSeed)
+
+# %% Preflight while the experimenter fills in the dialog: ports, output folders, display, trigger loopback, imports and trial plans
+likelyIDs = likelySubjects(dir_path)                           # the last Subject ID (to resume it) and the next one
+if simulate:
+    from simulation import argValue
+    likelyIDs.insert(0, argValue(sys.argv, '--subject', 0))    # what the simulated experimenter enters
+# Creating a global clock to keep track of time, the ports opened by the preflight timestamp on it from the start
+globalTimer = core.Clock()
+preflight = Preflight()
+preflight.add('output folders', lambda: checkFolders(dir_path))   # Create log, info and data folders if not existing
+preflight.add('parallel port', openMarkers, describe = lambda port: getattr(port.backend, 'name', 'simulated'))
+preflight.add('serial port', openTMS, describe = lambda driver: driver.backend.name)
+if not simulate:
+    preflight.add('display', checkDisplay, mainThread = True)       # pyglet, on the main thread once the dialog has closed
+    preflight.add('stimulus modules', lambda: __import__('psychopy.visual').__version__, describe = lambda v: f'psychopy {v}', mainThread = True)
+    preflight.add('trigger loopback', checkLoopback, required = False)   # the serial code path through a pseudo-terminal, Linux and macOS only
+preflight.add('trial plan', lambda: {ID: createTrialList(ID, RTtrials, catchRatio, trialsPerStimtimePerCondition, baselinesPerCondition, tasks) for ID in likelyIDs},
+              required = False, describe = lambda plans: f'built for Subject ID {", ".join(map(str, plans))}')
+preflight.start()
 
 # %% Get info from experimenter
-info = {"Observer":"BB", "ExpVersion": 2.1, "Group": ["Pilot", "Control"], "Subject ID":int(0), "Handedness" : ["Right", "Left", "Ambidextrous"], "Date and Time": str(datetime.now())[0:19], "Start from trial:":0}
-infoDlg = gui.DlgFromDict(dictionary=info,
-title="RT-experiment", fixed=["ExpVersion"])
+info = {"Observer":"BB", "ExpVersion": 2.1, "Group": ["Pilot", "Control"], "Subject ID":likelyIDs[0], "Handedness" : ["Right", "Left", "Ambidextrous"], "Date and Time": str(datetime.now())[0:19], "Start from trial:":0}
+infoDlg = startupTimer.dialog(lambda: gui.DlgFromDict(dictionary=info,
+title="RT-experiment", fixed=["ExpVersion"]))
+
+if simulate:
+    from simulation import argValue
+    info["Subject ID"] = argValue(sys.argv, '--subject', info["Subject ID"])
+    np.random.seed(info["Subject ID"])                         # simulated sessions are reproducible per Subject ID
 
 if infoDlg.OK:
     print(info)
@@ -121,49 +125,136 @@ else:
     print("\nUser Cancelled")
     core.quit()
 
-dir_path = os.path.dirname(os.path.realpath(__file__))     # Get the current directory of this script file. 
-sys.stdout = open(f'{dir_path}\log\log_{info["Subject ID"]}.txt', "w") # logging of python printout
+preflight.wait()
+startupTimer.mark('preflight')
+print(preflight.report())
+if not preflight.passed():
+    core.quit()
+markers = preflight.value('parallel port')
+tms = preflight.value('serial port')
+if not simulate:
+    from psychopy import visual                                 # imported already, by the preflight
+
+sys.stdout = RecordBuffer(os.path.join(dir_path, 'log', f'log_{info["Subject ID"]}.txt'), mode = "a", delimiter = None, fsyncEvery = 5) # logging of python printout, buffered in memory
+print(preflight.report())
 
 # %% Save the user inpur to a info_ID.csv file
 filename = f'info_{info["Subject ID"]}'
-while os.path.exists(f'{dir_path}\info\{filename}.csv'):    # ensure unique filename of info file
+while os.path.exists(os.path.join(dir_path, 'info', f'{filename}.csv')):    # ensure unique filename of info file
     filename = f'{filename}_new'
-datafile = open(f'{dir_path}\info\{filename}.csv', "w")
+datafile = open(os.path.join(dir_path, 'info', f'{filename}.csv'), "w")
 writer = csv.writer(datafile, delimiter = ";")
 writer.writerow(info.keys())
 writer.writerow(info.values())
 datafile.close()
 
-# %% Open data output file
+# %% Open data output file, or continue the file of a session which did not finish
 filename = f'RT_data_{info["Subject ID"]}'
-while os.path.exists(f'{dir_path}\data\{filename}.csv'):    # ensure unique filename of info file
+while os.path.exists(os.path.join(dir_path, 'data', f'{filename}_new.csv')):    # find the latest data file of this subject
     filename = f'{filename}_new'
-datafile = open(f'{dir_path}\data\{filename}.csv', "w")
-writer = csv.writer(datafile, delimiter = ";")
-writer.writerow (["trialnumber", "task", "right", "response", "responseTime", "correct", "tms_sent", "is_catch", "is_train", "time"]) # The collumn names in the csv file
+resume = None                                                      # the checkpoint to continue from, if any
+if info["Start from trial:"] == 0:
+    resume = lastCheckpoint(os.path.join(dir_path, 'data', f'{filename}.journal'))
+if resume:
+    truncateData(os.path.join(dir_path, 'data', f'{filename}.csv'), resume['dataBytes'])
+    datafile = RecordBuffer(os.path.join(dir_path, 'data', f'{filename}.csv'), mode = "a", delimiter = ";")
+    print(f'\n# Resuming {filename} at trial {resume["next"]}')
+else:
+    if os.path.exists(os.path.join(dir_path, 'data', f'{filename}.csv')):    # ensure unique filename of data file
+        filename = f'{filename}_new'
+    datafile = RecordBuffer(os.path.join(dir_path, 'data', f'{filename}.csv'), delimiter = ";")   # rows are kept in memory during a trial and fsynced after it
+writer = datafile
+journal = Journal(os.path.join(dir_path, 'data', f'{filename}.journal'))   # checkpoint after every trial
+if not resume:
+    writer.writerow (["trialnumber", "task", "right", "response", "responseTime", "correct", "tms_sent", "is_catch", "is_train", "tms_latency", "halfRT", "time", "mep_amplitude", "mep_latency", "emg_rms", "quality", "tms_planned"]) # The collumn names in the csv file
+flusher = Flusher([sys.stdout, datafile])                          # writes the buffers to disk, but never during a trial
+startupTimer.mark('files')
 
 #create a window
-mywin = visual.Window([1728, 1117], monitor="testMonitor", units="deg", color= (0,0,0), fullscr = True)
+windowOptions = {'dropRate': argValue(sys.argv, '--drop-rate', 0.0), 'dropSeed': info["Subject ID"]} if simulate else {}   # simulated dropped frames
+mywin = visual.Window([1728, 1117], monitor="testMonitor", units="deg", color= (0,0,0), fullscr = True, **windowOptions)
+frameDur = measureFrameDur(mywin)                                   # all trial events are locked to this refresh period
+print(f'# Frame duration: {frameDur*1000:.3f} ms')
+startupTimer.mark('window')
+timing = TimingLog(frameDur, markerGap = markers.gap)               # per-trial timing diagnostics, saved next to the data file
+quality = QualityCheck(qualityTolerances)                           # trials which miss their timing are re-queued
+timingFile = os.path.join(dir_path, 'data', f'{filename}_timing.npz')
+if resume and os.path.exists(timingFile):
+    timing.load(timingFile, before = resume['next'])
 
 # %% Defining visual stimuli for the RT tasks
-fixation = visual.TextStim(win = mywin, text = '+', color = [1,1,1], contrast=5.0, height = 1.5)
+fixation = visual.TextStim(win = mywin, name = 'fixation', text = '+', color = [1,1,1], contrast=5.0, height = 1.5)
 # Go for SRT
-SRTgoalStim = visual.ShapeStim(win = mywin, lineColor = [1,1,1], vertices = [[-0.3, 1.5], [-1.5, 1.5],[-1.5, -1.5], [-0.3,-1.5]], closeShape = False, lineWidth = 10, pos = (0, -1.5), ori = 90)
-SRTgoStim = visual.Circle(win = mywin, fillColor = [1,1,1], size = [1, 1], pos = (0, -3))
+SRTgoalStim = visual.ShapeStim(win = mywin, name = 'SRTgoal', lineColor = [1,1,1], vertices = [[-0.3, 1.5], [-1.5, 1.5],[-1.5, -1.5], [-0.3,-1.5]], closeShape = False, lineWidth = 10, pos = (0, -1.5), ori = 90)
+SRTgoStim = visual.Circle(win = mywin, name = 'SRTgo', fillColor = [1,1,1], size = [1, 1], pos = (0, -3))
 # Go right and left for UCRT & ICRT
-goRight = visual.Circle(win = mywin, fillColor = [1,1,1], size = [1,1], pos = (3, 0))
-goLeft = visual.Circle(win = mywin, fillColor = [1,1,1], size = [1,1], pos = (-3, 0))
+goRight = visual.Circle(win = mywin, name = 'goRight', fillColor = [1,1,1], size = [1,1], pos = (3, 0))
+goLeft = visual.Circle(win = mywin, name = 'goLeft', fillColor = [1,1,1], size = [1,1], pos = (-3, 0))
 # right and left "Goal" for UCRT & ICRT
-goalRight = visual.ShapeStim(win = mywin, lineColor = [1,1,1], vertices = [[-0.3, 1.5], [-1.5, 1.5],[-1.5, -1.5], [-0.3,-1.5]], closeShape = False, lineWidth = 10, pos = (1.75, 0))
-goalLeft = visual.ShapeStim(win = mywin, lineColor = [1,1,1], vertices = [[-0.3, 1.5], [-1.5, 1.5],[-1.5, -1.5], [-0.3,-1.5]], closeShape = False, lineWidth = 10, pos = (-1.75, 0), ori = 180)
+goalRight = visual.ShapeStim(win = mywin, name = 'goalRight', lineColor = [1,1,1], vertices = [[-0.3, 1.5], [-1.5, 1.5],[-1.5, -1.5], [-0.3,-1.5]], closeShape = False, lineWidth = 10, pos = (1.75, 0))
+goalLeft = visual.ShapeStim(win = mywin, name = 'goalLeft', lineColor = [1,1,1], vertices = [[-0.3, 1.5], [-1.5, 1.5],[-1.5, -1.5], [-0.3,-1.5]], closeShape = False, lineWidth = 10, pos = (-1.75, 0), ori = 180)
 # X for catch trials 
-catchX = visual.ShapeStim(win = mywin, lineColor = [1,1,1], vertices = [[-2,2], [2,-2], [0,0], [2,2], [-2,-2]], closeShape = False, lineWidth = 20)
+catchX = visual.ShapeStim(win = mywin, name = 'catchX', lineColor = [1,1,1], vertices = [[-2,2], [2,-2], [0,0], [2,2], [-2,-2]], closeShape = False, lineWidth = 20)
 # Just some info text
-infoStim = visual.TextStim(win = mywin, text = 'Info text', color = [1,1,1], wrapWidth = 22, height = 0.8)
-# Creating a global clock to keep track of time
-globalTimer = core.Clock()
+infoStim = visual.TextStim(win = mywin, name = 'infoStim', text = 'Info text', color = [1,1,1], wrapWidth = 22, height = 0.8)
+# Pre-rendering every composite frame of the tasks into a single image: cue_<task>_<L/R>, IS_<task>_<L/R> & catch
+frames = {'fixation': [fixation], 'catch': [catchX]}
+for task in ['SRT_L', 'SRT_R', 'UCRT', 'ICRT']:
+    for right in [False, True]:
+        if task in ("SRT_L", "SRT_R"):
+            goals, mainStim = [SRTgoalStim], SRTgoStim
+        elif task == "UCRT":
+            goals, mainStim = [goalLeft, goalRight], goRight if right else goLeft     # both goals are shown in UCRT
+        else:
+            goals, mainStim = [goalRight if right else goalLeft], goRight if right else goLeft
+        hand = 'R' if right else 'L'
+        frames[f'cue_{task}_{hand}'] = goals                                        # the preparatory cue
+        frames[f'IS_{task}_{hand}'] = [mainStim] + goals                            # the imperative signal and the cue again
+stimCache = StimulusCache(mywin, frames, visual)
+# Feedback texts are built once per RT and kept, instead of rebuilding the texture every trial. The likely RTs are
+# built ahead while the feedback of the first trials is shown, the others when they first occur
+feedback = FeedbackCache(mywin, visual, maxSize = 2*(maxRT+1), wrapWidth = 22, height = 0.8)
+feedbackBand = range(100, 600)                                     # RTs in ms built ahead of time
+startupTimer.mark('stimuli')
+# Sync markers between trials, fitted against the markers the EEG recorder writes, see clocksync.py
+if simulate:
+    from simulation import SimEEGRecorder
+    eegMarkers = SimEEGRecorder(markers, os.path.join(dir_path, 'data', f'{filename}_eeg.vmrk'), fs = eegRate, seed = info["Subject ID"], append = bool(resume))
+else:
+    eegMarkers = MarkerFileReader(eegMarkerFile) if eegMarkerFile else None
+clockSync = ClockSync(markers, t_sync, eegRate, eegMarkers, interval = syncInterval, clock = globalTimer.getTime, maxResidual = frameDur,
+                      eventsPath = os.path.join(dir_path, 'data', f'{filename}_events.csv'),   # every marker on the globalTimer and the EEG clock, appended between trials
+                      resume = resume.get('sync', {}) if resume else None)                   # the fit goes on after a resume
+# EMG is read and MEPs are measured in a separate process, see emg.py
+if simulate:
+    from simulation import SimulatedEMGSource
+    emgSource = SimulatedEMGSource(fs = emgRate, seed = info["Subject ID"])
+    emg = EMGStream(emgSource, emgRate, 1, clock = globalTimer.getTime, streamClock = core.getTime, process = False).start()
+    emg.pulseListeners.append(emgSource.pulse)                          # the simulated muscle responds to the pulses
+elif emgPort:
+    emg = EMGStream(SocketSource(emgChannels, emgRate, port = emgPort), emgRate, emgChannels, clock = globalTimer.getTime).start()
+else:
+    emg = None
+# Collecting timestamped key presses in the background, psychtoolbox keyboard queues if available
+if simulate:
+    from simulation import SimulatedParticipant
+    responseBackend = ScriptedBackend(globalTimer, waitKeys = [keyContinue])
+    responses = ResponseCollector(responseBackend, threaded = False)     # polled in step with the virtual clock
+    participant = SimulatedParticipant(responseBackend, keyLeft, keyRight, seed = info["Subject ID"])
+    mywin.flipListeners.append(participant.onFlip)                      # the participant sees every flip
+else:
+    try:
+        responses = ResponseCollector(KeyboardBackend(globalTimer))
+    except ImportError as e:                                            # no psychtoolbox: polled on the window thread
+        print(f'# Responses: {e}, using psychopy.event')
+        responses = ResponseCollector(EventBackend(globalTimer))
+# Trial results are published to the dashboard process through shared memory, see monitor.py
+monitor = Monitor((dashboard or 'web') if '--dashboard' in sys.argv else None if simulate else dashboard)   # off unless asked for
+# Garbage collection, priority and CPU pinning for the trials. A simulated session compares with --no-realtime
+realtimeMode = RealtimeMode(enabled = realtime and '--no-realtime' not in sys.argv)
 # Defining a visual representation of the clock, for debugging mainly
 globalTimerVisual = visual.TextStim(win=mywin, text = globalTimer.getTime(), color = [1,1,1], pos = (10,-10))
+startupTimer.mark('devices')
 
 # %% Defining the function to run trial and return results #################
 def trialRT1(trial_N = 0, task = 'SRT', tms_time = -100, fixDur = 500, maxRT = 1000, interDur = 900, right = True, is_catch = False, halfRT_R = 150, halfRT_L = 150, is_train = False):
@@ -190,97 +281,102 @@ def trialRT1(trial_N = 0, task = 'SRT', tms_time = -100, fixDur = 500, maxRT = 1
     # change values from ms to s representation #
     fixDur, maxRT, interDur, tms_time= np.array([fixDur, maxRT, interDur, tms_time])/1000
 
-    # Stimuli #
-    mainStim = goRight if right else goLeft                            # left or right goal and go stim
-    goalStim = goalRight if right else goalLeft   
-    if task in ("SRT_L", "SRT_R"):
-        goalStim, mainStim = SRTgoalStim, SRTgoStim
+    # Stimuli, pre-rendered #
+    hand = 'R' if right else 'L'
+    fixStim = stimCache['fixation']
+    cueStim = stimCache[f'cue_{task}_{hand}']                              # left or right goal
+    isStim = stimCache['catch'] if is_catch else stimCache[f'IS_{task}_{hand}']   # goal and go stim, or catch X
     
     # Helping variables #
-    responseTime, targetTime = math.nan, math.nan                         
-    tms_sent, correct, fixed, cued, goed = [False]*5
+    responseTime, targetTime, tmsTime, tms_latency = math.nan, math.nan, math.nan, math.nan
+    tms_sent, correct = False, False
     keyResp = []                                                          # all keys pressed during task
 
+    # Precomputed frame timeline #
+    timeline = buildTrialTimeline(frameDur, fixDur, interDur, maxRT, tms_time)
+    cueFrame, isFrame, tmsFrame = timeline.frame('cue'), timeline.frame('IS'), timeline.frame('TMS')
+    isTrigger = t_X if is_catch else (t_goRight if right else t_goLeft)
+    if tmsFrame is not None:
+        tms.arm()                                                         # empty the serial buffers before the trial
+
     ################## Running the trial ####################
     print(f'\n#### Start of trial_N: {trial_N}. Task: {task}. Catch: {is_catch}####', end ='')
-    startTime = globalTimer.getTime()                                     # saving time of trial start
-    while globalTimer.getTime()-startTime < fixDur + interDur + maxRT:    # the trial loop
+    startTime = math.nan
+    timing.startTrial()
+    edgeStart = len(markers.edges)                                        # markers sent from here on belong to this trial
+    for frameN in range(timeline.nFrames):                                # the trial loop, one pass per screen refresh
+        timing.loop()
+
+        ############# Draw stimuli of this frame ##############
+        if frameN < cueFrame:                                             # Draw the fixation cross for fixDur ms
+            fixStim.draw()
+        elif frameN < isFrame:                                            # Draw the preparatory cue
+            cueStim.draw()
+        else:                                                             # Draw the imperative signal (IS)/catchX
+            isStim.draw()
+
+        ########### EEG-triggers are sent on the flip ##########
+        if frameN == 0:
+            mywin.callOnFlip(sendRemark, t_fixStart)                      # Send fixation trigger to EEG
+        elif frameN == cueFrame:
+            mywin.callOnFlip(sendRemark, t_pCue)                          # Send eeg trigger for preparatory cue
+        elif frameN == isFrame:
+            mywin.callOnFlip(sendRemark, isTrigger)                       # Send eeg trigger for IS
+        flipTime = mywin.flip() - globalTimer.getLastResetTime()          # flip time on the globalTimer
+        timing.flip(flipTime)
+        if frameN == 0:
+            startTime = flipTime                                          # saving time of trial start
+        for name in ('fixation', 'cue', 'IS'):
+            if timeline.frame(name) == frameN:
+                timeline.markAchieved(name, flipTime - startTime)
+        if frameN == isFrame:
+            targetTime = flipTime                                         # Save the time of IS
 
         ########### Send trigger to TMS ##########
-        if (not tms_sent) and (not math.isnan(tms_time)) and globalTimer.getTime()-startTime >= fixDur + interDur + tms_time:  #Timing of TMS-signal is relative to IS
-            sendRemark(t_TMS) #Send tms marker via parallell to EEG
-            sendTMS() # Send TMS trigger via serial
-            tms_sent = (globalTimer.getTime()-startTime-fixDur-interDur)*1000
-            print(f'# Sending signal to TMS at t(IS) + {tms_sent} ms', end ='')
+        if frameN == tmsFrame:                                            # Timing of TMS-signal is relative to IS
+            tmsTarget = startTime + timeline.scheduled('TMS')
+            if not math.isnan(targetTime):                                # after the IS: relative to the IS as shown, a dropped frame before it moves both
+                tmsTarget = targetTime + timeline.scheduled('TMS') - timeline.scheduled('IS')
+            core.wait(max(tmsTarget - globalTimer.getTime(), 0), hogCPUperiod = 1)
+            sendRemark(t_TMS)                                             # Send tms marker via parallell to EEG
+            tmsTime = globalTimer.getTime()
+            tms_latency = sendTMS()                                       # Send TMS trigger via serial
+            timeline.markAchieved('TMS', tmsTime - startTime)
 
         ########### Look for keypresses ##########
-        keyResp = event.getKeys([keyLeft,keyRight, 'escape'], timeStamped = globalTimer)     # Look for new keypresses
-        if len(keyResp) > 0:                                              # check if keys were pressed and grab them with timestamp
-            responseTime = keyResp[-1][1]
-            if keyResp[-1][0] == keyLeft:            # Send response trigger to EEG:
+        found = responses.responsesSince(startTime, [keyLeft, keyRight, 'escape'])   # timestamped when pressed, not when polled
+        if any(e.key == 'escape' for e in found):
+            datafile.close()
+            mywin.close()
+            core.quit()
+        if len(found) > 0:                                                # check if keys were pressed and grab them with timestamp
+            keyResp = [[e.key, e.t] for e in found]
+            responseTime = keyResp[0][1]
+            if keyResp[0][0] == keyLeft:             # Send response trigger to EEG:
                 sendRemark(t_respL)
-            elif keyResp[-1][0] == keyRight:
+            elif keyResp[0][0] == keyRight:
                 sendRemark(t_respR)
             else:
                 sendRemark(t_respError)
             break                                                         # finish current trial and return to main script
-
-        ############# Draw stimuli in order ##############
-        if globalTimer.getTime()-startTime < fixDur and not fixed:        # Draw the fixation cross for fixDur ms
-            fixation.draw()
-            mywin.flip()
-            sendRemark(t_fixStart) #Send fixation trigger to EEG:
-            print(f' # Fixation started: {globalTimer.getTime()-startTime}', end ='')
-            fixed = True
-            
-        if (fixDur < globalTimer.getTime()-startTime < fixDur+interDur) and not cued: #preparatory period
-            if task == "UCRT":
-                goalLeft.draw()
-                goalRight.draw()
-            else:
-                goalStim.draw()                                               # Draw the preparatory cue
-            mywin.flip()
-            cued = True
-            sendRemark(t_pCue)#Send eeg trigger for preparatory cue
-            print(f' # PS shown: {globalTimer.getTime()-startTime}', end ='')
-
-        elif (globalTimer.getTime()-startTime >= fixDur+interDur) and not goed: #imperative signal/catchX
-                if is_catch: catchX.draw()
-                else:
-                    mainStim.draw()                                         # Draw the imperative signal (IS)
-                    if task == "UCRT":
-                        goalLeft.draw()
-                        goalRight.draw()
-                    else:
-                        goalStim.draw()                                               # Draw the preparatory cue again
-                mywin.flip()
-                goed = True
-
-                #Send eeg trigger for IS:
-                if is_catch:
-                    sendRemark(t_X)
-                elif right:
-                    sendRemark(t_goRight)
-                else:
-                    sendRemark(t_goLeft)
-                
-                if math.isnan(targetTime): targetTime = globalTimer.getTime()     # Save the time of IS
-                print(f' # IS shown: {targetTime-startTime}', end ='')
-
-        if event.getKeys(['escape']):
-            datafile.close()
-            mywin.close()
-            core.quit()
-        #print((time-globalTimer.getTime())*1000)                             # to test the speed of one while loop
-    mywin.flip()
+    endTime = mywin.flip() - globalTimer.getLastResetTime()
+    timing.flip(endTime)
     if math.isnan(responseTime):
+        timeline.markAchieved('timeout', endTime - startTime)
         sendRemark(t_timeout)  # send EEG info that trial ended by timeout 
+    if not math.isnan(tmsTime):                                               # TMS time relative to the IS flip, or the scheduled IS if not shown
+        isTime = targetTime if not math.isnan(targetTime) else startTime + timeline.scheduled('IS')
+        tms_sent = (tmsTime - isTime)*1000
+    print(f' {timeline.reportText()}', end ='')
+    if not markers.waitSent():                                                # the worker pulses the last markers of the trial
+        print(' # markers still queued,', end = '')
+    timing.endTrial(trial_N, timeline, tms_latency, markers.edges[edgeStart:])
 
     ############## Displaying feedback ################
     rt = (responseTime - targetTime)*1000                                     # representing rt in ms
 
     if (len(keyResp) > 0) and not is_catch:                                   # if not catch trial and response is given
-        correct = correctKey == keyResp[-1][0]                                # is is correct if correct key was pressed.
+        correct = correctKey == keyResp[0][0]                                 # is is correct if correct key was pressed first.
 
     if (len(keyResp) > 0) and math.isnan(rt):                                   # Any response which is not a number is false
         correct = False
@@ -290,133 +386,47 @@ def trialRT1(trial_N = 0, task = 'SRT', tms_time = -100, fixDur = 500, maxRT = 1
  
     rt = math.nan if math.isnan(rt) else math.floor(rt)                       # RT is nan if no key press, else round down to nearest ms
     print(f' # RT: {rt}ms: at {responseTime-startTime},')
-    infoStim.text = f'RT : {rt}ms'                                            # Show reaction time,
-    infoStim.color = [0,128,0] if correct else [255,0,0]                      # in green if correct button press, else in red
-    infoStim.draw()
+    feedback.get(rt, correct).draw()                                          # Show reaction time, in green if correct button press, else in red
     mywin.flip()
-    core.wait(0.5)
-
-    return trial_N, task, right, keyResp, rt, correct, tms_sent, is_catch, is_train
-
-def createTrialList(randomSeed, RTTrials, catchRatio, trialsPerStimtimePerCondition, baselinesPerCondition, tasks = ['SRT_L', 'SRT_R', 'UCRT', 'ICRT']):
-    """creates a list of tuples, eact tuple representing one set of conditions for each trial. 
-
-    Args:
-        ITI (_float_): intertrial interval represented in ms. 
-        randomSeed (_int_): used for randomizing order of trials and tasks. 
-        meanRTTrials (_int_): number of "training" trials per hand per task used to calculate meanRT. 
-        catchRatio (_float_): between 0 and 1: a number of catch trials per non-catch trial,
-         which is added to the total number of trials. (ratio is really the wrong word but). 
-        trialsPerStimTimePerHand (_int_): the number of trials per stimulation time per hand. 
-
-    Returns:
-        _iterable_:  list of tuples, where one trial of the experiment is represented as one tuple
-            each tuple has the structure (task, right, tms_time, is_catch, is_train)
-    """
-    random.seed(randomSeed)
-    trialList = []                     # all the trials, inlcuding "training" and experiment trials. 
-
-    ####### SRT_L trials #######
-    SRT_L_train = [('SRT_L', False, None, False, True)]*int(RTTrials) + [('SRT_L', False, None, True, True)]*int(RTTrials*catchRatio)
-    SRT_L_experiment = [('SRT_L', False, stimTime_BL, False, False)]*baselinesPerCondition  # add baseline trials
-    for stimTime in stimTimes_SRT_L:
-        SRT_L_experiment += [('SRT_L', False, stimTime, False, False)]*trialsPerStimtimePerCondition
-
-    SRT_L_experiment = SRT_L_experiment + [('SRT_L', True, None, True, False)]*int(len(SRT_L_experiment)*catchRatio) # Add catch trials
-    
-    random.shuffle(SRT_L_train)
-    random.shuffle(SRT_L_experiment)
-    SRT_L_trials = SRT_L_train + SRT_L_experiment
-
-    ####### SRT_R trials #######
-    SRT_R_train = [('SRT_R',  True, None, False, True)]*int(RTTrials) + [('SRT_R',  True, None, True, True)]*int(RTTrials*catchRatio)
-    SRT_R_experiment = [('SRT_R',  True, stimTime_BL, False, False)]*baselinesPerCondition  # Add baseline trials
-    for stimTime in stimTimes_SRT_R:
-        SRT_R_experiment += [('SRT_R',  True, stimTime, False, False)]*trialsPerStimtimePerCondition
-
-    SRT_R_experiment = SRT_R_experiment + [('SRT_R', True, None, True, False)]*int(len(SRT_R_experiment)*catchRatio/2) \
-         + [('SRT_R', False, None, True, False)]*int(len(SRT_R_experiment)*catchRatio/2) # Add L and R catch trials
-
-    random.seed(randomSeed+1) #change seed between creating each of the task lists
-    random.shuffle(SRT_R_train)
-    random.shuffle(SRT_R_experiment)
-    SRT_R_trials = SRT_R_train + SRT_R_experiment
-
-    ####### UCRT trials #########
-    UCRT_train = [('UCRT', True, None, False, True)]*int(RTTrials) \
-        + [('UCRT', True, None, True, True)]*int(RTTrials*catchRatio/2)\
-        + [('UCRT', False, None, False, True)]*int(RTTrials)\
-        + [('UCRT', False, None, True, True)]*int(RTTrials*catchRatio/2)
-    
-    UCRT_experiment = [('UCRT', True, stimTime_BL, False, False)]*baselinesPerCondition \
-        + [('UCRT', False, stimTime_BL, False, False)]*baselinesPerCondition
-    for stimTime in stimTimes_UCRT:
-        UCRT_experiment += [('UCRT', True, stimTime, False, False)]*trialsPerStimtimePerCondition \
-            + [('UCRT', False, stimTime, False, False)]*trialsPerStimtimePerCondition \
-    
-    UCRT_experiment = UCRT_experiment + [('UCRT', True, None, True, False)]*int(len(UCRT_experiment)*catchRatio/2)\
-         + [('UCRT', False, None, True, False)]*int(len(UCRT_experiment)*catchRatio/2) # Add L and R catch trials
-    
-    random.seed(randomSeed+2)
-    random.shuffle(UCRT_train)
-    random.shuffle(UCRT_experiment)
-    UCRT_trials = UCRT_train + UCRT_experiment
-
-        ####### ICRT trials #########
-    ICRT_train = [('ICRT', True, None, False, True)]*int(RTTrials) \
-        + [('ICRT', True, None, True, True)]*int(RTTrials*catchRatio/2)\
-        + [('ICRT', False, None, False, True)]*int(RTTrials)\
-        + [('ICRT', False, None, True, True)]*int(RTTrials*catchRatio/2)
-    
-    ICRT_experiment = [('ICRT', True, stimTime_BL, False, False)]*baselinesPerCondition \
-        + [('ICRT', False, stimTime_BL, False, False)]*baselinesPerCondition
-    for stimTime in stimTimes_ICRT:
-        ICRT_experiment += [('ICRT', True, stimTime, False, False)]*trialsPerStimtimePerCondition \
-            + [('ICRT', False, stimTime, False, False)]*trialsPerStimtimePerCondition \
-    
-    ICRT_experiment = ICRT_experiment + [('ICRT', True, None, True, False)]*int(len(ICRT_experiment)*catchRatio) # Add catch trials
-
-    random.seed(randomSeed+3)
-    random.shuffle(ICRT_train)
-    random.shuffle(ICRT_experiment)
-    ICRT_trials = ICRT_train + ICRT_experiment
-
-    ##### Randomise the order of the various tasks #####
-    sortList = [0,1,2,3]
-    random.shuffle(sortList)
-    for i in sortList:
-        if i == 0 and 'SRT_L' in tasks:
-            trialList += SRT_L_trials
-        elif i == 1 and 'SRT_R' in tasks:
-            trialList += SRT_R_trials
-        elif i == 2 and 'UCRT' in tasks:
-            trialList += UCRT_trials
-        elif i == 3 and 'ICRT' in tasks:
-            trialList += ICRT_trials
-
-    return trialList
-
-def runTrials(trialList, startFrom = 0, ITI = (4000, 4000), PCISI = (500, 500), maxRT = 1000):
-    trialN = startFrom                                     # trialN is where we begin
-    trialList = trialList[startFrom::]                     # Should not run everything again if instructed to start from anything other than 0
-    last_is_train = False
-    trainingRT_L = []                                      # to keep track of training RT, used for calculating half RT
-    trainingRT_R = []                                      # to keep track of training RT, used for calculating half RT
-    halfRT_L = 150                                         # should not be used before is redefined, but is defined as 150 by default
-    halfRT_R = 150 
+    feedbackEnd = globalTimer.getTime() + feedbackTime
+    for ok in (True, False):                                                  # build ahead the feedback of the likely RTs, in half the feedback time
+        feedback.prebuild(feedbackBand, ok, until = feedbackEnd - feedbackTime/2, clock = globalTimer.getTime)
+    core.wait(max(0, feedbackEnd - globalTimer.getTime()))
+    if emg is not None and not math.isnan(tmsTime):                           # MEPs are aligned on the TMS marker
+        tmsEdges = [e.set for e in markers.edges[edgeStart:] if e.code == t_TMS]
+        emg.pulse(trial_N, tmsEdges[0] if tmsEdges else tmsTime)
+
+    return trial_N, task, right, keyResp, rt, correct, tms_sent, is_catch, is_train, tms_latency
+
+def runTrials(trialList, startFrom = 0, ITI = (4000, 4000), PCISI = (500, 500), maxRT = 1000, seed = 0, resume = None):
+    digest = planDigest(trialList)                         # saved with every checkpoint, a resumed session must have the same plan
+    trials = list(trialList)                               # replacements of trials which missed their timing are inserted as we go
+    retries = [0]*len(trials)                              # how often each trial replaces an earlier one
+    requeued = []                                          # the trial numbers which were re-queued, saved with every checkpoint
+    trialN = startFrom                                     # trialN is where we begin, should not run everything again if instructed to start from anything other than 0
+    rtEstimator = RTEstimator(defaultRT = 450, maxRT = maxRT)   # running RT per task and hand, 450 ms (halfRT 150) until the first response
+    itiRng = np.random.default_rng(seed)                   # the random ITI and PC-IS intervals
 
     lastTask = None
     lastBreak = globalTimer.getTime()
-    for trial in trialList:
+    if resume:                                             # continue with the state of the checkpoint
+        rtEstimator.setState(resume['rt'])
+        itiRng.bit_generator.state = resume['rng']
+        lastBreak = globalTimer.getTime() - resume['sinceBreak']
+        for i in resume['requeued']:                       # the same re-queues give the same trials
+            retries.insert(requeue(trials, i, seed), retries[i] + 1)
+            requeued.append(i)
+    while trialN < len(trials):
+        trial = trials[trialN]
         if enableBreaks and (globalTimer.getTime() > lastBreak + breakInterval):
             sendRemark(t_pause)
             infoStim.text = "Now it is time for a short break \n Press the middle key when you are ready to continue"
             infoStim.color = [1,1,1]; infoStim.draw(); mywin.flip()
             print("\n # User is breaking - taking a break")
-            event.waitKeys(keyList = ['d'])            # Wait for user to press the middle key
+            responses.waitFor([keyContinue], globalTimer)            # Wait for user to press the middle key
 
-        randFix = np.random.uniform(ITI[0], ITI[1])      # random fixation time between ITImin and ITImax
-        randInt = np.random.uniform(PCISI[0], PCISI[1])    # random interval between PC and IS in ICRT
+        randFix = itiRng.uniform(ITI[0], ITI[1])         # random fixation time between ITImin and ITImax
+        randInt = itiRng.uniform(PCISI[0], PCISI[1])       # random interval between PC and IS in ICRT
         task = trial[0]
         right = trial[1]
         tms_time = trial[2]
@@ -424,9 +434,12 @@ def runTrials(trialList, startFrom = 0, ITI = (4000, 4000), PCISI = (500, 500),
         is_train = trial[4]
 
         if task != lastTask:
+            realtimeMode.collect()                                   # a full garbage collection between blocks
+            if lastTask is not None:
+                print(f'\n{timing.endBlock()}')                     # timing report of the block which just ended
             infoStim.text = "Now it is time for a new task. \n\nPress the middle key to read the instructions"
             infoStim.color = [1,1,1]; infoStim.draw(); mywin.flip()
-            start = event.waitKeys(keyList = ['d'])            # Wait for user to press the middle key to continue
+            responses.waitFor([keyContinue], globalTimer)            # Wait for user to press the middle key to continue
 
             ######## Show instructions ########
             if task == 'SRT_R':
@@ -442,79 +455,175 @@ def runTrials(trialList, startFrom = 0, ITI = (4000, 4000), PCISI = (500, 500),
                 infoStim.text = "Time for an informed choice reaction time task.\n\nRespond with *right index finger* on the *yellow* key or *left index finger* on the *red* key according to direction of ball and goal. \n\nDo not press before you see the ball. \n\nPress the middle key to begin"
                 print("# ICRT instructions")
             infoStim.color = [1,1,1]; infoStim.draw(); mywin.flip()
-            start = event.waitKeys(keyList = ['d'])              # Wait for user to press the middle key to begin block
+            responses.waitFor([keyContinue], globalTimer)              # Wait for user to press the middle key to begin block
             lastBreak = globalTimer.getTime()
             sendRemark(t_startBlock)  # start of block EEG marker
 
-        if last_is_train and (not is_train):                         # if last trial as training and current is not, meanRT shuld be calculated from previous trials
-            if len(trainingRT_L)>0:
-                halfRT_L = np.nanmean(trainingRT_L)/3
-                print(f' halfRT_L was calculated based on previous trials')
-            if len(trainingRT_R)>0:
-                halfRT_R = np.nanmean(trainingRT_R)/3
-                print(f' halfRT_R was calculated based on previous trials')
-            trainingRT_L = []                                      # reset for next task
-            trainingRT_R = []                                      # reset for next task
+        halfRT_L = rtEstimator.halfRT(task, False)                   # TMS at a third of the current RT of the hand in this task
+        halfRT_R = rtEstimator.halfRT(task, True)
         
         ###### Run and write the trial to file#######
+        if simulate:
+            participant.prepare(task, right, is_catch)
+        flusher.pause()                                                  # no disk I/O while the trial runs
+        realtimeMode.trialStart()                                        # and no garbage collection
         temp = trialRT1(trialN, task, tms_time, fixDur = randFix, maxRT = maxRT, interDur = randInt, right = right, is_catch = is_catch, halfRT_R=halfRT_R, halfRT_L=halfRT_L, is_train=is_train)
+        realtimeMode.trialEnd()                                          # collect the garbage of the trial while the feedback is shown
         temp = list(temp)
+        temp.append(halfRT_R if right else halfRT_L)                 # the halfRT of this trial
         temp.append(globalTimer.getTime())
+        mep = emg.measures(trialN) if emg is not None and temp[6] is not False else noMEP(trialN)
+        temp += [mep.amplitude, mep.latency, mep.rms]                # MEP of the TMS pulse, nan if none
+        failures = quality.check(timing.lastRow())                   # IS, TMS and markers on time?
+        temp.append(', '.join(failures))
+        temp.append((halfRT_R if right else halfRT_L) if tms_time == 'halfRT' else tms_time)   # the planned TMS time relative to IS, None if no TMS
+        if not math.isnan(mep.amplitude):
+            print(f' MEP {mep.amplitude:.0f} at {mep.latency:.1f} ms, pre-TMS EMG RMS {mep.rms:.1f}', end = '')
         writer.writerow(temp)
+        isError, tmsError = quality.errors(timing.lastRow())
+        monitor.publish(trialN = trialN, task = task, right = right, correct = temp[5], is_catch = is_catch, is_train = is_train,
+                        nFailures = len(failures), rt = temp[4], tmsSent = temp[6] if temp[6] is not False else None,
+                        isError = isError, tmsError = tmsError, halfRT = temp[10], mep = mep.amplitude, time = temp[11])
+        flusher.resume()                                                 # the trial is on disk before the next one starts
+        clockSync.poll()                                                 # fit the sync markers the EEG has recorded so far
+        clockSync.tick()
         
         #temp: trial_N, task, right, keyResp, rt, correct, tms_sent, is_catch
-        if is_train:
-            if temp[5]: #if response was correct
-                if right:
-                    trainingRT_R.append(temp[4]) # add rt to right RT list
-                    print(f' Added R RT to list')
-                else:
-                    trainingRT_L.append(temp[4]) # add rt to left RT list
-                    print(f' Added L RT to list')
-            else:
-                print(f' Response was incorrect, could not add RT to list')
+        rtUpdate = None
+        if temp[5] and not is_catch:                                 # if response was correct, update the RT estimate
+            accepted = rtEstimator.update(task, right, temp[4], trialN)
+            rtUpdate = rtEstimator.history[-1]                       # journaled, see checkpoint.rtHistory
+            print(f' RT {"added to" if accepted else "rejected from"} {task} {"R" if right else "L"} estimate: {rtEstimator.rt(task, right):.1f} ms', end = '')
+        else:
+            print(f' Response was incorrect, could not add RT to estimate', end = '')
+
+        if failures and not is_train and retries[trialN] < maxRequeues:   # training trials only serve the RT estimate
+            j = requeue(trials, trialN, seed)
+            retries.insert(j, retries[trialN] + 1)
+            requeued.append(trialN)
+            print(f' Timing missed ({", ".join(failures)}), re-queued as trial {j}', end = '')
 
         lastTask = task
-        last_is_train = is_train
         trialN += 1
+        timing.save(timingFile)                                      # the timing rows of the trial, before its checkpoint
+        journal.append({'next': trialN, 'digest': digest, 'dataBytes': datafile.size(), 'rt': rtEstimator.getState(),
+                        'rng': itiRng.bit_generator.state, 'sinceBreak': globalTimer.getTime() - lastBreak, 'requeued': requeued,
+                        'sync': clockSync.getState(), 'rtUpdate': rtUpdate})
+    print(f'\n{timing.endBlock()}')
+    print(quality.report(len(trials), len(requeued)))
+    return trials
 
 # %% A function to run pure TMS baseline measures. 
 def baselineMeasures(numberoftrials):
     infoStim.text = "Time for some baseline measures. Please relax. \n Press the middle key to begin"
     infoStim.draw()
     mywin.flip()
-    event.waitKeys(keyList = ['d'])            # Wait for user to press the middle key to press continue
+    responses.waitFor([keyContinue], globalTimer)            # Wait for user to press the middle key to press continue
     fixation.draw()
     mywin.flip()
+    blStart = globalTimer.getTime()
     for i in range(numberoftrials):
+        flusher.pause()                                                 # no disk I/O while the baseline trial runs
+        realtimeMode.trialStart()
         core.wait(random.randint(5,8))
+        tms.arm()
         sendRemark(t_TMS) #Send tms marker via parallell to EEG
-        sendTMS()#Send trigger to TMS via serial
-        print('# BL measure: sending signal to TMS')
-        temp = [f'BL: {i}', "BL", None, None, None, None, True, None, False, globalTimer.getTime()]
+        tmsTime = globalTimer.getTime()
+        tms_latency = sendTMS()#Send trigger to TMS via serial
+        print(f'# BL measure: sending signal to TMS, latency {tms_latency:.3f} ms')
+        mep = noMEP()
+        if emg is not None:
+            emg.pulse(f'BL: {i}', tmsTime)
+            core.wait(0.1)                                              # the MEP window has passed
+            mep = emg.measures(f'BL: {i}')
+        temp = [f'BL: {i}', "BL", None, None, None, None, True, None, False, tms_latency, None, globalTimer.getTime(), mep.amplitude, mep.latency, mep.rms, '', None]
         writer.writerow(temp) #write data to file
-        if event.getKeys(['escape']):
+        monitor.publish(trialN = i, task = 'BL', tmsSent = 0, mep = mep.amplitude, time = temp[11])
+        realtimeMode.trialEnd()
+        flusher.resume()                                                # the trial is on disk before the next one starts
+        clockSync.poll()
+        clockSync.tick()
+        if responses.escapePressed(since = blStart):
             datafile.close()
             mywin.close()
             core.quit()
     return
 
+# %% A function to pay the first-call costs of a trial before the first trial
+def warmUpSteps():
+    """returns the steps to warm up: every stimulus, the flip, the trigger and response paths and the code of a trial.
+    The stimuli are drawn and cleared unseen; the flip shows blank frames of the background color, which is all the
+    window shows before the first screen anyway. No marker or TMS pulse is sent."""
+    def drawAll():
+        for name in frames:
+            stimCache[name].draw()
+        for correct in (True, False):
+            feedback.get(math.nan, correct).draw()
+        infoStim.draw()
+        mywin.clearBuffer()                                             # nothing of it is shown
+    def blankFlip():
+        mywin.clearBuffer()
+        mywin.flip()                                                    # a blank frame, as before the first screen
+    def trialCode():
+        timeline = buildTrialTimeline(frameDur, 0.5, 0.9, maxRT/1000, 0.15)
+        timeline.markAchieved('IS', timeline.scheduled('IS'))
+        timeline.reportText()
+        timing.startTrial(); timing.loop(); timing.flip(globalTimer.getTime())
+    return {'stimuli': drawAll, 'flip': blankFlip, 'trial code': trialCode, 'tms': tms.arm,
+            'responses': lambda: responses.responsesSince(globalTimer.getTime(), [keyLeft, keyRight, 'escape'])}
+
 # %% Run the show
+sessionStart = time.perf_counter()
 mywin.mouseVisible = False
 ## Create the list of trials. This used subject ID as seed for randomization, so re-running the script for same participant whould return the same experiment. 
-trialList = createTrialList(info['Subject ID'], RTtrials, catchRatio, trialsPerStimtimePerCondition, baselinesPerCondition, tasks)
+trialList = (preflight.value('trial plan') or {}).get(info['Subject ID'])   # built while the dialog was open
+print(f'# Trial plan {"built during the dialog" if trialList else "built now"}', end = '')
+if trialList is None:
+    trialList = createTrialList(info['Subject ID'], RTtrials, catchRatio, trialsPerStimtimePerCondition, baselinesPerCondition, tasks)
+print(f': {len(trialList)} trials, digest {planDigest(trialList)}')
+if resume and resume['digest'] != planDigest(trialList):
+    print(f'\n# Can not resume {filename}: the trial plan has changed since it was started. Change the settings back or start from trial 1', file = sys.__stdout__)
+    core.quit()
 ## Run the trials created
+realtimeMode.start()
+realtimeMode.warmUp(warmUpSteps())
+startupTimer.mark('warm-up')
 sendRemark(t_startExp) # send start trigger to EEG 
-baselineMeasures(bl_before) #Baseline measures before
-runTrials(trialList, info['Start from trial:'], ITI = ITI, PCISI = PCISI, maxRT = maxRT) #Main experiment.
+mywin.callOnFlip(startupTimer.mark, 'first screen')                # the next flip shows the first instructions
+if not resume:
+    baselineMeasures(bl_before) #Baseline measures before
+trialsRun = runTrials(trialList, resume['next'] if resume else info['Start from trial:'], ITI = ITI, PCISI = PCISI, maxRT = maxRT, seed = info['Subject ID'], resume = resume) #Main experiment.
 baselineMeasures(bl_after) #Baselines measure after
+journal.finish()                                                   # a restart with this Subject ID begins a new session
 infoStim.text = "Experiment finished. \n Thank you for participating. \n \n Press the middle key to quit"
 infoStim.draw()
 mywin.flip()
 sendRemark(t_endExp) # EEG marker end of experiment
-event.waitKeys(keyList = ['d'])            # Wait for user to press the middle key to press continue
+responses.waitFor([keyContinue], globalTimer)            # Wait for user to press the middle key to press continue
 
 # %% Save, close and quit. 
+print(f'\n{monitor.render()}')
+monitor.close()
+realtimeMode.stop()
+print(f'\n{realtimeMode.report()}')
+print(startupTimer.report())
+loopStats = f'# Trial loop: median {timing.loopPercentile(50):.3f} ms, 99th percentile {timing.loopPercentile(99):.3f} ms, 99.9th {timing.loopPercentile(99.9):.3f} ms'
+print(loopStats)
+if simulate:
+    print(startupTimer.report(), realtimeMode.report(), loopStats, quality.report(len(trialsRun), len(trialsRun) - len(trialList)), sep = '\n', file = sys.__stdout__)
+    print(f'Simulated {globalTimer.getTime():.0f} s session of subject {info["Subject ID"]} in {time.perf_counter()-sessionStart:.2f} s: {os.path.join(dir_path, "data", filename)}.csv', file = sys.__stdout__)
+responses.close()
+print(f'\n# TMS latency (until the byte left the port): {tms.latencyStats()}')
+markers.close()
+clockSync.poll()
+clockSync.close()                                                  # the markers after the last sync marker
+print(f'\n{clockSync.report()}')
+if simulate:
+    print(clockSync.report(), f'(simulated EEG clock: offset {eegMarkers.offset} s, drift {eegMarkers.drift*1e6:.1f} ppm)', file = sys.__stdout__)
+tms.close()
+if emg is not None:
+    emg.close()
 datafile.close()
+journal.close()
 mywin.close()
 core.quit()
\ No newline at end of file
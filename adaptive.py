@@ -0,0 +1,127 @@
+"""
+Streaming RT estimation for the 'halfRT' TMS timing.
+
+runTrials used to compute halfRT once per task as mean(training RT)/3. The RTEstimator instead keeps running
+estimates per task x hand which are updated after every correct response, in training and experiment:
+an EWMA and the median of a sliding window. RTs below minRT, above maxRT, or further than rejectMADs median
+absolute deviations from the window median are rejected as outliers. Each update costs a few operations on a
+window of fixed size, and nothing runs inside the trial loop.
+
+Written for RT_tasks_v4.1.py
+"""
+import math, bisect
+from collections import deque
+
+
+class RunningRT:
+    """Running RT estimate of one task x hand."""
+
+    def __init__(self, window = 15, alpha = 0.2):
+        self.alpha = alpha
+        self.ewma = math.nan
+        self.window = deque(maxlen = window)                          # the last RTs, in order
+        self.sorted = []                                              # the same RTs, sorted
+        self.n = 0                                                    # accepted RTs
+        self.rejected = 0
+
+    def median(self):
+        k = len(self.sorted)
+        if k == 0:
+            return math.nan
+        return self.sorted[k//2] if k % 2 else (self.sorted[k//2 - 1] + self.sorted[k//2])/2
+
+    def mad(self):
+        """median absolute deviation of the window."""
+        m = self.median()
+        deviations = sorted(abs(x - m) for x in self.sorted)
+        k = len(deviations)
+        return deviations[k//2] if k % 2 else (deviations[k//2 - 1] + deviations[k//2])/2
+
+    def add(self, rt):
+        if len(self.window) == self.window.maxlen:
+            self.sorted.pop(bisect.bisect_left(self.sorted, self.window[0]))
+        self.window.append(rt)
+        bisect.insort(self.sorted, rt)
+        self.ewma = rt if math.isnan(self.ewma) else self.alpha*rt + (1 - self.alpha)*self.ewma
+        self.n += 1
+
+
+class RTEstimator:
+    """RT estimates per task and hand, feeding the 'halfRT' stimulation time.
+
+    Args:
+        defaultRT (_float_): RT in ms assumed before any response was seen (450 gives the old default halfRT of 150).
+        fraction (_float_): halfRT is fraction * RT.
+        method (_str_): 'median' (windowed median) or 'ewma'.
+        window (_int_): number of RTs in the sliding window.
+        alpha (_float_): weight of the newest RT in the EWMA.
+        minRT, maxRT (_float_): RTs outside this range (ms) are rejected.
+        rejectMADs (_float_): RTs further than this many MADs from the median are rejected, once minWindow RTs are in.
+        minWindow (_int_): number of RTs needed before the MAD rule is used.
+    """
+
+    def __init__(self, defaultRT = 450, fraction = 1/3, method = 'median', window = 15, alpha = 0.2, minRT = 100,
+                 maxRT = 1000, rejectMADs = 3.5, minWindow = 5):
+        if method not in ('median', 'ewma'):
+            raise ValueError(f"method must be 'median' or 'ewma', not {method}")
+        self.defaultRT = defaultRT
+        self.fraction = fraction
+        self.method = method
+        self.windowSize, self.alpha = window, alpha
+        self.minRT, self.maxRT = minRT, maxRT
+        self.rejectMADs, self.minWindow = rejectMADs, minWindow
+        self.estimates = {}                                           # (task, right): RunningRT
+        self.history = []                                             # (trialN, task, right, rt, accepted, estimate), journaled per trial
+
+    def _get(self, task, right):
+        key = (task, bool(right))
+        if key not in self.estimates:
+            self.estimates[key] = RunningRT(self.windowSize, self.alpha)
+        return self.estimates[key]
+
+    def isOutlier(self, task, right, rt):
+        if not (self.minRT <= rt <= self.maxRT):
+            return True
+        est = self._get(task, right)
+        if len(est.window) >= self.minWindow:
+            mad = max(est.mad(), 1.0)                                 # a window of identical RTs should not reject everything
+            return abs(rt - est.median()) > self.rejectMADs*1.4826*mad
+        return False
+
+    def update(self, task, right, rt, trialN = None):
+        """adds the RT (ms) of a correct response. Returns True if it was accepted."""
+        if rt is None or math.isnan(rt):
+            return False
+        est = self._get(task, right)
+        accepted = not self.isOutlier(task, right, rt)
+        if accepted:
+            est.add(rt)
+        else:
+            est.rejected += 1
+        self.history.append((trialN, task, bool(right), rt, accepted, self.rt(task, right)))
+        return accepted
+
+    def rt(self, task, right):
+        """the current RT estimate in ms."""
+        est = self.estimates.get((task, bool(right)))
+        if est is None or est.n == 0:
+            return self.defaultRT
+        return est.median() if self.method == 'median' else est.ewma
+
+    def halfRT(self, task, right):
+        """the TMS time in ms after IS for a 'halfRT' trial."""
+        return self.fraction*self.rt(task, right)
+
+    def getState(self):
+        """returns everything needed to continue estimating, as plain lists and numbers."""
+        return {f'{task}|{right}': {'window': list(e.window), 'ewma': e.ewma, 'n': e.n, 'rejected': e.rejected}
+                for (task, right), e in self.estimates.items()}
+
+    def setState(self, state):
+        self.estimates = {}
+        for key, s in state.items():
+            task, right = key.split('|')
+            est = self._get(task, right == 'True')
+            for rt in s['window']:
+                est.add(rt)
+            est.ewma, est.n, est.rejected = s['ewma'], s['n'], s['rejected']
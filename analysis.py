@@ -0,0 +1,204 @@
+"""
+Analysis of the RT tasks data of a whole cohort.
+
+Every session writes data/RT_data_<ID>[_new...].csv (semicolon delimited, with the key presses as a Python list
+and booleans as text) and info/info_<ID>.csv. parseData reads a data file in one pass and converts every column
+to a numpy array at once. A subject's _new files continue the first one: they are merged in order and a trial
+number which occurs twice keeps its last row. Subjects are summarized in parallel over a process pool, per task
+and hand: RT, accuracy, catch false alarms, TMS timing (against the planned time of the trial) and latency, MEPs and
+timing quality. Trials which failed a quality check are left out of the statistics and only counted.
+
+Parsed files are cached as columns in an .npz per file, together with the mtime and size they were parsed at,
+so a rerun on a growing cohort only parses the sessions which are new or changed.
+
+Run with:  python analysis.py [folder with data/ and info/] [--processes N]
+which writes <folder>/analysis/summary.csv
+
+Written for RT_tasks_v4.1.py
+"""
+import os, re, csv, sys, math
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+dataPattern = re.compile(r'RT_data_(\d+)((?:_new)*)\.csv$')
+infoPattern = re.compile(r'info_(\d+)((?:_new)*)\.csv$')
+summaryColumns = ['subject', 'group', 'handedness', 'task', 'hand', 'nTrials', 'accuracy', 'rtMean', 'rtMedian',
+                  'rtSD', 'nCatch', 'falseAlarms', 'nTMS', 'tmsErrorMedian', 'tmsErrorMax', 'tmsLatencyMean',
+                  'tmsLatencyMax', 'halfRTMean', 'mepMedian', 'qualityFailed']
+cacheVersion = 2                                                      # of the cached columns, raise it when parseData changes
+
+
+############ reading ############
+def _number(col):
+    """text column to float, '', None, False and nan become nan."""
+    return np.where(np.isin(col, ('', 'None', 'False', 'nan')), 'nan', col).astype(float)
+
+
+def parseData(path):
+    """returns the columns of one RT_data file as numpy arrays."""
+    with open(path, newline = '') as f:
+        rows = list(csv.reader(f, delimiter = ';'))
+    header, rows = rows[0], [r[:len(rows[0])] for r in rows[1:] if len(r) >= len(rows[0])]   # a torn last row is dropped
+    text = np.array(rows, dtype = str).reshape(len(rows), len(header))
+    col = lambda name: text[:, header.index(name)] if name in header else np.full(len(rows), '')
+    trial = col('trialnumber')
+    baseline = np.char.startswith(trial, 'BL')
+    return {'trialN': np.where(baseline, 'nan', trial).astype(float),
+            'baseline': baseline,
+            'task': col('task'),
+            'right': np.where(col('right') == 'True', 1.0, np.where(col('right') == 'False', 0.0, math.nan)),
+            'responded': ~np.isin(col('response'), ('', '[]', 'None')),
+            'rt': _number(col('responseTime')),
+            'correct': col('correct') == 'True',
+            'tmsSent': _number(np.where(baseline, '', col('tms_sent'))),   # baselines have no IS, only True
+            'tmsPlanned': _number(col('tms_planned')),
+            'is_catch': col('is_catch') == 'True',
+            'is_train': col('is_train') == 'True',
+            'tmsLatency': _number(col('tms_latency')),
+            'halfRT': _number(col('halfRT')),
+            'time': _number(col('time')),
+            'mepAmplitude': _number(col('mep_amplitude')),
+            'qualityFailed': col('quality') != ''}
+
+
+def loadData(path, cacheDir = None):
+    """parseData through the cache: the columns are parsed again only if the file changed since."""
+    if cacheDir is None:
+        return parseData(path)
+    stat = os.stat(path)
+    cached = os.path.join(cacheDir, os.path.basename(path)[:-4] + '.npz')
+    if os.path.exists(cached):
+        with np.load(cached) as c:
+            if c['_mtime'] == stat.st_mtime_ns and c['_size'] == stat.st_size and c.get('_version') == cacheVersion:
+                return {k: c[k] for k in c.files if not k.startswith('_')}
+    columns = parseData(path)
+    os.makedirs(cacheDir, exist_ok = True)
+    temp = cached[:-4] + f'.{os.getpid()}.tmp.npz'
+    np.savez(temp, _mtime = stat.st_mtime_ns, _size = stat.st_size, _version = cacheVersion, **columns)
+    os.replace(temp, cached)                                          # never a half written cache file
+    return columns
+
+
+def readInfo(path):
+    """returns the info dialog of a session as a dict."""
+    with open(path, newline = '') as f:
+        rows = list(csv.reader(f, delimiter = ';'))
+    return dict(zip(rows[0], rows[1])) if len(rows) > 1 else {}
+
+
+def subjectFiles(folder, pattern = dataPattern, sub = 'data'):
+    """returns {subject ID: [files]} of a folder, every subject's files in the order they were made."""
+    found = {}
+    if not os.path.isdir(os.path.join(folder, sub)):
+        return found
+    for name in os.listdir(os.path.join(folder, sub)):
+        m = pattern.match(name)
+        if m:
+            found.setdefault(int(m.group(1)), []).append((len(m.group(2)), os.path.join(folder, sub, name)))
+    return {s: [p for n, p in sorted(files)] for s, files in sorted(found.items())}
+
+
+def loadSubject(paths, cacheDir = None):
+    """merges the files of one subject. Of a trial number found in more than one file the last row is kept."""
+    parts = [loadData(p, cacheDir) for p in paths]
+    columns = {k: np.concatenate([p[k] for p in parts]) for k in parts[0]}
+    columns['session'] = np.concatenate([np.full(len(p['task']), i) for i, p in enumerate(parts)])
+    trialN = columns['trialN']
+    order = np.arange(len(trialN))
+    reversedN = trialN[::-1]
+    lastOf = len(trialN) - 1 - np.unique(reversedN, return_index = True)[1]   # last row of every trial number
+    keep = np.isnan(trialN) | np.isin(order, lastOf)
+    return {k: v[keep] for k, v in columns.items()}
+
+
+############ summaries ############
+def tmsError(tmsSent, tmsPlanned):
+    """the TMS time (relative to the IS) minus the planned time of the trial, in ms. nan in files written before
+    the tms_planned column."""
+    return tmsSent - tmsPlanned
+
+
+def summarize(columns):
+    """returns a summary dict per task and hand of the experimental trials of one subject. Trials which failed a
+    quality check (and were re-queued) are only counted in qualityFailed.
+
+    Args:
+        columns (_dict_): the columns of loadSubject.
+    """
+    c = columns
+    rows = []
+    experiment = ~c['baseline'] & ~c['is_train']
+    for task in sorted(set(c['task'][experiment])):
+        for hand, right in (('L', 0.0), ('R', 1.0)):
+            sel = experiment & (c['task'] == task) & (c['right'] == right)
+            if not sel.any():
+                continue
+            failed = sel & c['qualityFailed']
+            sel = sel & ~c['qualityFailed']
+            go, catch = sel & ~c['is_catch'], sel & c['is_catch']
+            rts = c['rt'][go & c['correct'] & ~np.isnan(c['rt'])]
+            tms = sel & ~np.isnan(c['tmsSent'])
+            error = tmsError(c['tmsSent'][tms], c['tmsPlanned'][tms])
+            error = error[~np.isnan(error)]
+            mean = lambda a: float(np.mean(a)) if len(a) else math.nan
+            rows.append({'task': task, 'hand': hand, 'nTrials': int(go.sum()),
+                         'accuracy': mean(c['correct'][go]), 'rtMean': mean(rts),
+                         'rtMedian': float(np.median(rts)) if len(rts) else math.nan,
+                         'rtSD': float(np.std(rts, ddof = 1)) if len(rts) > 1 else math.nan,
+                         'nCatch': int(catch.sum()), 'falseAlarms': mean(c['responded'][catch]),
+                         'nTMS': int(tms.sum()),
+                         'tmsErrorMedian': float(np.median(error)) if len(error) else math.nan,
+                         'tmsErrorMax': float(np.max(np.abs(error))) if len(error) else math.nan,
+                         'tmsLatencyMean': float(np.nanmean(c['tmsLatency'][tms])) if np.any(~np.isnan(c['tmsLatency'][tms])) else math.nan,
+                         'tmsLatencyMax': float(np.nanmax(c['tmsLatency'][tms])) if np.any(~np.isnan(c['tmsLatency'][tms])) else math.nan,
+                         'halfRTMean': mean(c['halfRT'][go]),
+                         'mepMedian': float(np.nanmedian(c['mepAmplitude'][tms])) if np.any(~np.isnan(c['mepAmplitude'][tms])) else math.nan,
+                         'qualityFailed': int(failed.sum())})
+    return rows
+
+
+def analyzeSubject(subject, dataPaths, infoPath = None, cacheDir = None):
+    """the summary rows of one subject, the work of one pool task."""
+    info = readInfo(infoPath) if infoPath else {}
+    rows = summarize(loadSubject(dataPaths, cacheDir))
+    for row in rows:
+        row.update(subject = subject, group = info.get('Group', ''), handedness = info.get('Handedness', ''))
+    return rows
+
+
+def analyze(folder, processes = None, cacheDir = None):
+    """summarizes every subject in folder/data, in parallel when processes > 1. Returns the summary rows."""
+    cacheDir = os.path.join(folder, 'analysis', 'cache') if cacheDir is None else cacheDir
+    data = subjectFiles(folder)
+    info = subjectFiles(folder, infoPattern, 'info')
+    args = [(s, paths, info.get(s, [None])[0], cacheDir) for s, paths in data.items()]
+    if processes is None or processes <= 1 or len(args) < 2:
+        results = [analyzeSubject(*a) for a in args]
+    else:
+        with ProcessPoolExecutor(processes) as pool:
+            results = list(pool.map(analyzeSubject, *zip(*args)))
+    return [row for rows in results for row in rows]
+
+
+def writeSummary(rows, path):
+    os.makedirs(os.path.dirname(path), exist_ok = True)
+    with open(path, 'w', newline = '') as f:
+        writer = csv.writer(f, delimiter = ';')
+        writer.writerow(summaryColumns)
+        for row in rows:
+            writer.writerow([row[c] for c in summaryColumns])
+
+
+if __name__ == '__main__':
+    import time
+    processes = os.cpu_count()
+    if '--processes' in sys.argv:
+        i = sys.argv.index('--processes')
+        processes = int(sys.argv.pop(i + 1))
+        sys.argv.pop(i)
+    folder = sys.argv[1] if len(sys.argv) > 1 else os.path.dirname(os.path.realpath(__file__))
+    start = time.perf_counter()
+    rows = analyze(folder, processes)
+    writeSummary(rows, os.path.join(folder, 'analysis', 'summary.csv'))
+    print(f'{len(set(r["subject"] for r in rows))} subjects, {len(rows)} task x hand summaries in {time.perf_counter()-start:.2f} s: {os.path.join(folder, "analysis", "summary.csv")}')
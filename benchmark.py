@@ -0,0 +1,290 @@
+"""
+Timing regression benchmarks of the trial engine of the RT tasks.
+
+Runs headless on any Linux box, without a screen, parallel port, stimulator or keyboard:
+- loop: a whole simulated session (RT_tasks_v4.1.py --simulate, see simulation.py) in a subprocess, the
+  percentiles of how long a pass of the trial loop took, from the histogram of its timing sidecar,
+- startup: the time from launch to the first instruction screen of those sessions, from their StartupTimer,
+- marker: queue-to-pin latency of the MarkerPort worker, on a RecordingBackend,
+- tms: write and arrival latency of a trigger through pyserial and a PtyLoopback (tms.measureLoopback). A pty
+  ignores the baud rate, so this is the software overhead, without the ~1 ms a byte takes on the line at 9600 baud,
+- keypress: time from a key press until the ResponseCollector has it on record, on a ScriptedBackend,
+- plan: time design.createPlan takes for the session design and for a large one with run length constraints,
+- io: the cost of one trial's output: the rows written during the trial (memory only), and the sync with fsync
+  and the journal entry after it.
+
+Every metric has a value and a limit. --save writes them to a baseline json, the limit being the value times the
+factor of its group plus an absolute slack, so the limits can be edited by hand. A run without --save compares
+with the baseline and exits with 1 if any metric is over its limit. Maxima are kept for the record but never
+checked, they mostly measure what else the machine was doing.
+
+The timings are absolute, so a baseline only holds for the machine it was saved on: its host name, CPU model and
+number of CPUs are saved with it, and a run on another machine refuses to compare (exit 2) unless --any-machine
+is given, which compares with a warning. Save a baseline of each machine with --baseline path.
+
+Run with:  python benchmark.py [--save] [--quick] [--baseline path] [--output results.json] [--any-machine]
+
+Written for RT_tasks_v4.1.py
+"""
+import os, sys, glob, json, time, shutil, platform, tempfile, subprocess
+from types import SimpleNamespace
+
+import numpy as np
+
+from startup import parseReport
+
+dir_path = os.path.dirname(os.path.realpath(__file__))
+baselinePath = os.path.join(dir_path, 'benchmark_baseline.json')
+benchSubject = 9001                                                   # the Subject ID of the benchmark sessions
+limits = {'loop': (3.0, 0.05), 'marker': (3.0, 0.2), 'tms': (3.0, 0.5),   # group: (factor, slack in the metric's unit)
+          'keypress': (3.0, 0.5), 'plan': (3.0, 5.0), 'io': (3.0, 1.0), 'startup': (2.0, 0.2)}
+
+
+def percentiles(values, name, unit = 'ms', qs = (50, 99)):
+    """returns {name.p50: ..., name.p99: ..., name.max: ...} of values."""
+    values = np.asarray(values, dtype = float)
+    result = {f'{name}.p{q}': (float(np.percentile(values, q)), unit) for q in qs}
+    result[f'{name}.max'] = (float(values.max()), unit)
+    return result
+
+
+############ benchmarks ############
+def benchLoop(sessions = 3):
+    """loop pass times of simulated sessions, in ms."""
+    simDir = os.path.join(dir_path, 'sim_output')
+    pattern = [os.path.join(simDir, sub, f'{prefix}_{benchSubject}*') for sub, prefix in
+               (('data', 'RT_data'), ('info', 'info'), ('log', 'log'))]
+    clean = lambda: [os.remove(p) for pat in pattern for p in glob.glob(pat)]
+    hist, binWidth, nTrials, wall, startup = None, None, 0, [], []
+    for i in range(sessions):
+        clean()                                                       # a left over session would be resumed
+        start = time.perf_counter()
+        output = subprocess.run([sys.executable, os.path.join(dir_path, 'RT_tasks_v4.1.py'), '--simulate', '--subject',
+                                 str(benchSubject)], check = True, stdout = subprocess.PIPE, stderr = subprocess.DEVNULL,
+                                cwd = dir_path, timeout = 600, text = True).stdout
+        wall.append(time.perf_counter() - start)
+        startup.append(parseReport(output)['machine'])
+        with np.load(os.path.join(simDir, 'data', f'RT_data_{benchSubject}_timing.npz')) as saved:
+            hist = saved['loopHist'] if hist is None else hist + saved['loopHist']
+            binWidth = float(saved['loopHistBinWidth'])
+            nTrials += len(saved['trialN'])
+    clean()
+    cumulative = np.cumsum(hist)
+    binOf = lambda q: (np.searchsorted(cumulative, q/100*cumulative[-1]) + 0.5)*binWidth*1000
+    result = {f'loop.p{q}': (float(binOf(q)), 'ms') for q in (50, 99, 99.9)}
+    result['loop.max'] = (float((np.nonzero(hist)[0][-1] + 1)*binWidth*1000), 'ms')
+    result['loop.session'] = (float(np.median(wall)*1000/(nTrials/sessions)), 'ms/trial')   # the whole script, imports included
+    result['startup.firstScreen'] = (float(np.median(startup)), 's')
+    return result
+
+
+def benchMarkers(n = 500, interval = 0.003):
+    """latency from MarkerPort.send to the pins being set, in ms."""
+    from markers import MarkerPort, RecordingBackend
+    port = MarkerPort(RecordingBackend())
+    for i in range(n):
+        port.send(1 + i % 2)                                          # alternating codes are never merged
+        time.sleep(interval)
+    port.flush()
+    port.close()
+    return percentiles([(e.set - e.requested)*1000 for e in port.edges], 'marker')
+
+
+def benchTMS(n = 300):
+    """write and arrival latency of TMS triggers through a pseudo-terminal, in ms. Without pyserial or a pty
+    only the write latency on a NullBackend."""
+    try:
+        from tms import measureLoopback
+        result = measureLoopback(n)
+    except (ImportError, OSError) as e:
+        print(f'# tms: no pyserial loopback ({e}), measuring the write call only')
+        from tms import TMSDriver, NullBackend
+        driver = TMSDriver(NullBackend())
+        for i in range(n):
+            driver.arm()
+            driver.fire()
+        driver.close()
+        return percentiles([(p.written - p.start)*1000 for p in driver.pulses], 'tms.write')
+    return {f'tms.{kind}.{stat}': (result[kind][stat if stat != 'p50' else 'median'], 'ms')
+            for kind in ('write', 'arrival') for stat in ('p50', 'p99', 'max')}
+
+
+def benchKeypress(n = 500):
+    """time from a key press until responsesSince returns it, in ms."""
+    from responses import ResponseCollector, ScriptedBackend
+    clock = SimpleNamespace(getTime = time.perf_counter)
+    collector = ResponseCollector(ScriptedBackend(clock), threaded = True)
+    latencies = []
+    for i in range(n):
+        time.sleep(0.0005*(i % 5))                                    # presses at every phase of the poll interval
+        pressed = clock.getTime()
+        collector.backend.press('left', pressed)
+        while not collector.responsesSince(pressed):
+            time.sleep(0.0001)                                        # the trial loop waits in flip, it never holds the GIL
+        latencies.append((clock.getTime() - pressed)*1000)
+        collector.clear()
+    collector.close()
+    return percentiles(latencies, 'keypress')
+
+
+def benchPlan(repeats = 5):
+    """time createPlan takes for the session design and a large design, in ms."""
+    from design import designSpec, createPlan, taskHands
+    tasks = ['SRT_L', 'SRT_R', 'UCRT', 'ICRT']
+    designs = {'session': designSpec(tasks, {t: [-100, 'halfRT'] for t in tasks}, -500, 20, 0.1, 20, 5,
+                                     maxRun = {'right': 4, 'tms_time': 3}),
+               'large': designSpec(tasks, {t: [-300, -200, -100, 'halfRT'] for t in taskHands}, -500, 50, 0.1, 250, 20,
+                                   maxRun = {'right': 4, 'tms_time': 3})}
+    result = {}
+    for name, spec in designs.items():
+        times = []
+        for seed in range(repeats):
+            start = time.perf_counter()
+            plan = createPlan(spec, seed)
+            times.append((time.perf_counter() - start)*1000)
+        result[f'plan.{name}'] = (float(np.median(times)), 'ms')
+        result[f'plan.{name}.trials'] = (len(plan), 'trials')
+    return result
+
+
+def benchIO(n = 200):
+    """cost of the output of one trial: writing the rows during the trial, then the sync and the journal entry."""
+    from recordio import RecordBuffer, Flusher
+    from checkpoint import Journal
+    folder = tempfile.mkdtemp(prefix = 'rt_benchmark_')
+    try:
+        data = RecordBuffer(os.path.join(folder, 'data.csv'))
+        log = RecordBuffer(os.path.join(folder, 'log.txt'), delimiter = None)
+        flusher = Flusher([data, log], interval = 3600)               # only the syncs after the trials
+        journal = Journal(os.path.join(folder, 'data.journal'))
+        row = [0, 'UCRT', True, ['right'], 312.5, True, -100.0, False, False, 0.012, 150.0, 12.3, 850.0, 23.1, 11.2, '']
+        inTrial, after = [], []
+        for i in range(n):
+            flusher.pause()
+            start = time.perf_counter()
+            row[0] = i
+            data.writerow(row)
+            log.write(f'# trial {i}: IS 1000.0/1000.2ms TMS 900.0/900.1ms\n')
+            inTrial.append((time.perf_counter() - start)*1000)
+            start = time.perf_counter()
+            flusher.resume()
+            journal.append({'next': i + 1, 'digest': '0'*64, 'dataBytes': data.size(), 'rt': 312.5})
+            after.append((time.perf_counter() - start)*1000)
+        flusher.stop()
+        journal.close()
+        data.close()
+        log.close()
+    finally:
+        shutil.rmtree(folder, ignore_errors = True)
+    return {**percentiles(inTrial, 'io.inTrial'), **percentiles(after, 'io.afterTrial')}
+
+
+benchmarks = {'loop': benchLoop, 'marker': benchMarkers, 'tms': benchTMS, 'keypress': benchKeypress,
+              'plan': benchPlan, 'io': benchIO}
+
+
+############ baselines ############
+def run(quick = False, only = None):
+    """runs the benchmarks and returns {metric: (value, unit)}."""
+    sizes = {'loop': {'sessions': 1}, 'marker': {'n': 100}, 'tms': {'n': 100}, 'keypress': {'n': 100},
+             'plan': {'repeats': 2}, 'io': {'n': 50}} if quick else {}
+    results = {}
+    for name, bench in benchmarks.items():
+        if only and name not in only:
+            continue
+        start = time.perf_counter()
+        results.update(bench(**sizes.get(name, {})))
+        print(f'# {name} in {time.perf_counter() - start:.1f} s', flush = True)
+    return results
+
+
+def checked(metric):
+    """maxima and counts are kept for the record only."""
+    return not metric.endswith(('.max', '.trials'))
+
+
+def cpuModel():
+    """the model name of the CPU, from /proc/cpuinfo on Linux."""
+    try:
+        with open('/proc/cpuinfo') as f:
+            for line in f:
+                if line.startswith('model name'):
+                    return line.split(':', 1)[1].strip()
+    except OSError:
+        pass
+    return platform.processor() or platform.machine()
+
+
+def machine():
+    return {'host': platform.node(), 'cpu': cpuModel(), 'cpus': os.cpu_count(), 'platform': platform.platform(),
+            'python': platform.python_version(), 'numpy': np.__version__}
+
+
+def machineMismatch(baseline):
+    """returns how this machine differs from the one the baseline was saved on: (differences the timings depend on,
+    other differences), as lists of text."""
+    saved, here = baseline.get('machine', {}), machine()
+    differ = lambda keys: [f'{k} {saved.get(k, "not recorded")} here {here[k]}' for k in keys if saved.get(k) != here[k]]
+    return differ(('host', 'cpu', 'cpus')), differ(('platform', 'python', 'numpy'))
+
+
+def makeBaseline(results):
+    baseline = {'machine': machine(), 'created': time.strftime('%Y-%m-%d %H:%M:%S'), 'metrics': {}}
+    for metric, (value, unit) in sorted(results.items()):
+        factor, slack = limits[metric.split('.')[0]]
+        baseline['metrics'][metric] = {'value': round(value, 6), 'unit': unit,
+                                       'limit': round(value*factor + slack, 6) if checked(metric) else None}
+    return baseline
+
+
+def compare(results, baseline):
+    """returns the report lines and the metrics over their limit."""
+    lines, failed = [f'{"metric":28} {"value":>12} {"baseline":>12} {"limit":>12}'], []
+    for metric, (value, unit) in sorted(results.items()):
+        entry = baseline['metrics'].get(metric, {}) if baseline else {}
+        limit = entry.get('limit')
+        over = limit is not None and value > limit
+        if over:
+            failed.append(metric)
+        show = lambda v: f'{v:12.4f}' if v is not None else f'{"-":>12}'
+        lines.append(f'{metric:28} {show(value)} {show(entry.get("value"))} {show(limit)} {unit}{"  REGRESSION" if over else ""}')
+    return lines, failed
+
+
+if __name__ == '__main__':
+    from simulation import argValue
+    quick, save = '--quick' in sys.argv, '--save' in sys.argv
+    path = argValue(sys.argv, '--baseline', baselinePath)
+    only = [a for a in sys.argv[1:] if a in benchmarks]
+    baseline = None
+    if os.path.exists(path):
+        with open(path) as f:
+            baseline = json.load(f)
+    if baseline is not None and not save:
+        hardware, software = machineMismatch(baseline)
+        if software:
+            print(f'# warning: the baseline was saved with another setup: {", ".join(software)}')
+        if hardware and '--any-machine' not in sys.argv:
+            print(f'the baseline {path} was saved on another machine ({", ".join(hardware)}), its timings do not hold here.'
+                  f' Save a baseline of this machine with --save --baseline <path>, or compare anyway with --any-machine')
+            sys.exit(2)
+        if hardware:
+            print(f'# warning: comparing with the baseline of another machine: {", ".join(hardware)}')
+    results = run(quick, only)
+    lines, failed = compare(results, baseline)
+    print('\n'.join(lines))
+    if '--output' in sys.argv:
+        with open(argValue(sys.argv, '--output', 'benchmark_results.json'), 'w') as f:
+            json.dump({'machine': machine(), 'created': time.strftime('%Y-%m-%d %H:%M:%S'),
+                       'metrics': {m: {'value': v, 'unit': u} for m, (v, u) in results.items()}}, f, indent = 1)
+    if save:
+        with open(path, 'w') as f:
+            json.dump(makeBaseline(results), f, indent = 1)
+        print(f'baseline saved to {path}')
+    elif baseline is None:
+        print(f'no baseline at {path}, run with --save to make one')
+    elif failed:
+        print(f'{len(failed)} metrics regressed: {", ".join(failed)}')
+        sys.exit(1)
+    else:
+        print(f'no regressions against the baseline of {baseline["created"]} ({baseline["machine"].get("host")}, {baseline["machine"].get("cpu")})')
@@ -0,0 +1,87 @@
+"""
+Checkpointing of a running session, so a crashed session continues where it stopped.
+
+After every trial runTrials appends one JSON line to a journal next to the data file: the next trial index, the
+digest of the trial plan, the length of the data file, the RT estimator state, the ITI random generator state, the
+time since the last break and the RT estimator update of the trial (see adaptive.RTEstimator.history), so that
+rtHistory can read back how the halfRT adapted over the whole session. Lines are only appended and fsynced, so at
+worst the last line is torn, and lastCheckpoint skips it. Restarting with the same Subject ID reads the journal
+from its end, truncates the data file to the recorded length and continues the same file at the next trial.
+
+Written for RT_tasks_v4.1.py
+"""
+import os, json
+
+
+class Journal:
+    """An append-only file of JSON lines, fsynced on every append."""
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'a')
+        if self.file.tell() and not _endsWithNewline(path):       # a torn line of a crash stays on a line of its own
+            self.file.write('\n')
+
+    def append(self, entry):
+        self.file.write(json.dumps(entry, separators = (',', ':')) + '\n')
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def finish(self):
+        """marks the session as finished, it will not be resumed."""
+        self.append({'finished': True})
+
+    def close(self):
+        self.file.close()
+
+
+def _endsWithNewline(path):
+    with open(path, 'rb') as f:
+        f.seek(-1, os.SEEK_END)
+        return f.read(1) == b'\n'
+
+
+def lastEntry(path, tail = 65536):
+    """returns the last complete entry of a journal, or None. Only the end of the file is read."""
+    if not os.path.exists(path):
+        return None
+    with open(path, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+        f.seek(max(size - tail, 0))
+        lines = f.read().splitlines()
+    for line in reversed(lines):
+        try:
+            return json.loads(line)
+        except ValueError:                                            # torn last line of a crash
+            continue
+    return None
+
+
+def lastCheckpoint(path):
+    """returns the checkpoint to resume from, or None if there is no journal or the session finished."""
+    entry = lastEntry(path)
+    if entry is None or entry.get('finished'):
+        return None
+    return entry
+
+
+def rtHistory(path):
+    """returns the RT estimator updates of every trial in the journal, in order, as
+    (trialN, task, right, rt, accepted, estimate). A torn line of a crash is skipped."""
+    history = []
+    with open(path) as f:
+        for line in f:
+            try:
+                update = json.loads(line).get('rtUpdate')
+            except ValueError:
+                continue
+            if update:
+                history.append(tuple(update))
+    return history
+
+
+def truncateData(path, size):
+    """cuts the data file back to the length it had at the checkpoint, dropping a half written row."""
+    if os.path.getsize(path) > size:
+        os.truncate(path, size)
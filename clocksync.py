@@ -0,0 +1,321 @@
+"""
+Clock synchronization between the globalTimer and the sample clock of the EEG recording.
+
+Every event is timestamped on the globalTimer, while the EEG recorder only sees the parallel port codes at its own
+sample indices, and the two clocks run apart by tens of ppm. A ClockSync sends a sync marker every interval
+seconds between trials, reads the markers the recorder wrote (the BrainVision .vmrk, or a sample;code csv, as it
+grows), pairs every recorded sync marker with the edge the port sent, and fits eegTime = offset + rate*localTime
+online. The first recorded sync markers are placed by the intervals between them, so a recording which started
+late or missed one is not paired one interval off, and a fit whose residuals are above a frame is rejected.
+Between trials every marker the fit reaches is appended to an events file with its time in both clocks, ready for
+batch epoching. The fit is saved in the journal, so after a resume it goes on with the same drift and a new
+offset for the new local clock, and the events file is continued.
+
+The fit is an online least squares line (running means and co-moments), so adding a sync point costs a few
+operations, and pairs off the line by more than the tolerance are left out once a few points are in.
+
+Written for RT_tasks_v4.1.py
+"""
+import os, csv, math
+from bisect import bisect_left
+
+
+class LinearClock:
+    """Online least squares fit of y = offset + rate*x.
+
+    The pairs can come in segments whose x have different origins, e.g. the parts of a session before and after a
+    resume: the segments share the rate, every segment has its own offset, and offset is that of the last one.
+
+    Args:
+        tolerance (_float_): pairs further than this from the line are rejected, once minPoints are in.
+        minPoints (_int_): number of pairs before rejection starts.
+    """
+
+    def __init__(self, tolerance = 0.005, minPoints = 3):
+        self.tolerance, self.minPoints = tolerance, minPoints
+        self.n = 0                                                    # pairs of all segments
+        self.nSegment = 0                                             # pairs of the current segment
+        self.closed = 0                                               # earlier segments with pairs
+        self.meanX = self.meanY = 0.0                                 # of the current segment
+        self.sxx = self.sxy = self.syy = 0.0                         # co-moments around the segment means, summed
+        self.rejected = 0
+
+    @property
+    def segments(self):
+        return self.closed + (self.nSegment > 0)
+
+    @property
+    def rate(self):
+        return self.sxy/self.sxx if self.sxx > 0 else 1.0
+
+    @property
+    def offset(self):
+        return self.meanY - self.rate*self.meanX if self.nSegment else math.nan
+
+    def predict(self, x):
+        return self.offset + self.rate*x
+
+    def invert(self, y):
+        return (y - self.offset)/self.rate
+
+    def residualRMS(self):
+        dof = self.n - self.segments - 1
+        if dof < 1 or self.sxx <= 0:
+            return math.nan
+        return math.sqrt(max(self.syy - self.sxy**2/self.sxx, 0)/dof)
+
+    def add(self, x, y):
+        """adds a pair. Returns False if it was rejected as off the line."""
+        if self.nSegment and self.n >= self.minPoints and abs(y - self.predict(x)) > self.tolerance:
+            self.rejected += 1
+            return False
+        self.n += 1
+        self.nSegment += 1
+        dx, dy = x - self.meanX, y - self.meanY
+        self.meanX += dx/self.nSegment
+        self.meanY += dy/self.nSegment
+        self.sxx += dx*(x - self.meanX)
+        self.sxy += dx*(y - self.meanY)
+        self.syy += dy*(y - self.meanY)
+        return True
+
+    def getState(self):
+        """the fit as a dict of numbers, for the journal. A fit continued from it starts a new segment."""
+        return {'n': self.n, 'segments': self.segments, 'sxx': self.sxx, 'sxy': self.sxy, 'syy': self.syy,
+                'rejected': self.rejected}
+
+    def setState(self, state):
+        self.n, self.closed, self.rejected = state['n'], state['segments'], state['rejected']
+        self.sxx, self.sxy, self.syy = state['sxx'], state['sxy'], state['syy']
+        self.nSegment = 0
+        self.meanX = self.meanY = 0.0
+
+
+class MarkerFileReader:
+    """Reads the markers an EEG recorder appends to its marker file, only the lines added since the last read.
+
+    Understands BrainVision .vmrk lines (Mk2=Stimulus,S120,12345,1,0) and 'sample;code' or 'sample,code' lines.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.pos = 0
+        self.partial = ''
+
+    def read(self):
+        """returns the new markers as (sample, code)."""
+        if not os.path.exists(self.path):
+            return []
+        with open(self.path, 'r', errors = 'replace') as f:
+            f.seek(self.pos)
+            text = self.partial + f.read()
+            self.pos = f.tell()
+        lines = text.split('\n')
+        self.partial = lines.pop()                                    # a line still being written
+        return [m for m in map(parseMarker, lines) if m is not None]
+
+    def getState(self):
+        return {'pos': self.pos, 'partial': self.partial}
+
+    def setState(self, state):
+        """continues reading where a crashed session stopped, so its markers are not read again."""
+        self.pos, self.partial = state['pos'], state['partial']
+
+
+def parseMarker(line):
+    """returns (sample, code) of a marker line, or None if it is no stimulus marker."""
+    line = line.strip()
+    if line.startswith('Mk') and '=' in line:                         # BrainVision
+        fields = line.split('=', 1)[1].split(',')
+        if len(fields) < 3 or fields[0] != 'Stimulus':
+            return None
+        try:
+            return int(fields[2]), int(fields[1].lstrip('Ss '))
+        except ValueError:
+            return None
+    fields = line.replace(',', ';').split(';')
+    try:
+        return int(fields[0]), int(fields[1])
+    except (ValueError, IndexError):                                 # header or comment
+        return None
+
+
+def _nearest(times, t):
+    """index of the value of the sorted list times nearest to t."""
+    i = bisect_left(times, t)
+    return min((k for k in (i - 1, i) if 0 <= k < len(times)), key = lambda k: abs(times[k] - t))
+
+
+class ClockSync:
+    """Sends sync markers and fits the EEG clock against the globalTimer.
+
+    Args:
+        markers (_MarkerPort_): the marker port, its edges give the local send times.
+        code (_int_): the marker code of sync markers.
+        fs (_float_): sampling rate of the EEG in Hz.
+        reader: something with read() returning the new (sample, code) of the recording, e.g. a MarkerFileReader.
+            None only sends sync markers.
+        interval (_float_): seconds between sync markers.
+        clock: the local clock, the clock of the marker edges.
+        tolerance (_float_): sync pairs further off the fitted line are left out, in s.
+        maxResidual (_float_): a fit with a larger residual RMS is rejected, in s, e.g. a frame. None never rejects.
+        eventsPath (_str_): csv the markers are appended to with their time in both clocks, as the fit reaches them.
+        resume (_dict_): the getState of a crashed session to continue: the fit goes on and eventsPath is appended to
+            (also if it is empty, for a journal without a fit).
+    """
+
+    minAnchor = 3                                                     # recorded sync markers needed to place them
+    maxDrift = 200e-6                                                 # largest clock rate difference assumed
+
+    def __init__(self, markers, code, fs, reader = None, interval = 30, clock = None, tolerance = 0.005,
+                 maxResidual = None, eventsPath = None, resume = None):
+        self.markers, self.code, self.fs = markers, code, fs
+        self.reader = reader
+        self.interval = interval
+        self.clock = clock or markers.clock
+        self.model = LinearClock(tolerance)
+        self.maxResidual = maxResidual
+        self.lastSync = -math.inf
+        self.matched = set()                                          # indices of the local sync edges which are paired
+        self.unmatched = 0                                            # recorded sync markers without a local edge
+        self.pending = []                                             # recorded sync markers not placed yet, EEG time
+        self.lastPaired = -math.inf                                   # local time of the last paired sync edge
+        self.segment = 0                                              # number of resumes before this part
+        self.written = 0                                              # marker edges in the events file
+        if resume:
+            self.model.setState(resume['fit'])
+            self.unmatched = resume['unmatched']
+            self.segment = resume['segment'] + 1
+            if resume.get('reader') and hasattr(reader, 'setState'):
+                reader.setState(resume['reader'])
+        self.events = None
+        if eventsPath:
+            self.events = open(eventsPath, 'a' if resume is not None else 'w', newline = '')
+            self._writer = csv.writer(self.events, delimiter = ';')
+            if self.events.tell() == 0:
+                self._writer.writerow(['segment', 'code', 'local_time', 'eeg_time', 'eeg_sample'])
+
+    def tick(self):
+        """sends a sync marker if interval has passed. Call between trials, never inside one."""
+        now = self.clock()
+        if now - self.lastSync >= self.interval:
+            self.markers.send(self.code)
+            self.lastSync = now
+
+    def localSyncs(self):
+        return [e.set for e in self.markers.edges if e.code == self.code]
+
+    def poll(self):
+        """reads the new markers of the recording, adds the sync markers among them to the fit and appends the
+        markers the fit reaches to the events file. Call between trials."""
+        if self.reader is None:
+            return 0
+        new = [sample/self.fs for sample, code in self.reader.read() if code == self.code]
+        self.pending += new
+        local = self.localSyncs()
+        if self.model.nSegment == 0:                                  # the first ones are placed by their intervals
+            pairs = self._anchor(self.pending, local)
+            if pairs is None:
+                return len(new)
+            for eegTime, k in pairs:
+                self._add(local, k, eegTime)
+        else:
+            for eegTime in self.pending:
+                k = self._pair(eegTime, local)
+                if k is None:
+                    self.unmatched += 1
+                    continue
+                self._add(local, k, eegTime)
+        self.pending = []
+        self.writeEvents()
+        return len(new)
+
+    def _add(self, local, k, eegTime):
+        self.matched.add(k)
+        if self.model.add(local[k], eegTime):
+            self.lastPaired = max(self.lastPaired, local[k])
+
+    def _anchor(self, eegTimes, local):
+        """pairs the first recorded sync markers with the sent ones by the intervals between them, so a recording
+        which started late or missed a marker is not paired one interval off. The first recorded marker is tried
+        on every sent one; a placement at which every recorded marker falls on a sent one (within the tolerance
+        plus maxDrift of the time since the first) is taken if it is the only one. Returns [(eegTime, k)] or None."""
+        while len(eegTimes) >= self.minAnchor:
+            found = []
+            for k0 in range(len(local)):
+                pairs = []
+                for t in eegTimes:
+                    k = _nearest(local, local[k0] + t - eegTimes[0])
+                    if abs(local[k] - (local[k0] + t - eegTimes[0])) > self.model.tolerance + self.maxDrift*(t - eegTimes[0]):
+                        break
+                    pairs.append((t, k))
+                else:
+                    if len({k for t, k in pairs}) == len(pairs):
+                        found.append(pairs)
+            if len(found) == 1:
+                return found[0]
+            if found:                                                 # more than one fits, wait for the next
+                return None
+            eegTimes.pop(0)                                           # a recorded marker which was never sent
+            self.unmatched += 1
+        return None
+
+    def _pair(self, eegTime, local):
+        """index of the local sync edge nearest to where the fit puts a recorded sync marker."""
+        free = [k for k in range(len(local)) if k not in self.matched]
+        if not free:
+            return None
+        guess = self.model.invert(eegTime)
+        k = min(free, key = lambda k: abs(local[k] - guess))
+        return k if abs(local[k] - guess) < self.interval/2 else None
+
+    def valid(self):
+        """True if the fit places the current part of the session and its residuals are within maxResidual."""
+        rms = self.model.residualRMS()
+        return self.model.nSegment > 0 and not (self.maxResidual is not None and rms > self.maxResidual)
+
+    def toEEG(self, t):
+        """the EEG time in s of local time t."""
+        return self.model.predict(t)
+
+    def toSample(self, t):
+        return round(self.toEEG(t)*self.fs)
+
+    def getState(self):
+        """the fit and the read position of the recording, saved in the journal after every trial."""
+        return {'fit': self.model.getState(), 'unmatched': self.unmatched, 'segment': self.segment,
+                'reader': self.reader.getState() if hasattr(self.reader, 'getState') else None}
+
+    def report(self):
+        if self.model.nSegment == 0:
+            return (f'# Clock sync: {len(self.localSyncs())} sync markers sent, {len(self.pending)} recorded '
+                    f'but not placed yet' if self.pending else f'# Clock sync: {len(self.localSyncs())} sync markers sent, none placed')
+        text = (f'# Clock sync: {self.model.nSegment} of {len(self.localSyncs())} sync markers fitted'
+                f'{f" ({self.model.n} with the {self.segment} part(s) before the resume)" if self.segment else ""}, '
+                f'offset {self.model.offset:.4f} s, drift {(self.model.rate - 1)*1e6:.1f} ppm, residual RMS '
+                f'{self.model.residualRMS()*1000:.3f} ms, {self.model.rejected} rejected, {self.unmatched} unpaired')
+        if not self.valid():
+            text += f'. REJECTED: the residual RMS is above {self.maxResidual*1000:.3f} ms, no EEG times are written'
+        return text
+
+    def writeEvents(self, final = False):
+        """appends the markers sent up to the last paired sync marker to the events file, with their time in both
+        clocks. final appends the rest, also if there is no valid fit (then without EEG times)."""
+        if self.events is None or not (final or self.valid()):
+            return
+        edges, upTo = self.markers.edges, math.inf if final else self.lastPaired
+        valid = self.valid()
+        while self.written < len(edges) and edges[self.written].set <= upTo:
+            e = edges[self.written]
+            self._writer.writerow([self.segment, e.code, e.set, self.toEEG(e.set) if valid else None,
+                                   self.toSample(e.set) if valid else None])
+            self.written += 1
+        self.events.flush()
+        os.fsync(self.events.fileno())
+
+    def close(self):
+        """appends the markers not written yet and closes the events file."""
+        if self.events is not None:
+            self.writeEvents(final = True)
+            self.events.close()
+            self.events = None
@@ -0,0 +1,214 @@
+"""
+Declarative trial-design engine for the RT tasks.
+
+A design is a dict (see designSpec) saying which tasks to run, which hands respond in each, the TMS stimulation
+times, the number of baseline, experimental, training and catch trials, and optional constraints on how many
+trials in a row may share the same hand or stimulation time. createPlan turns a spec and a seed into the list of
+trial tuples (task, right, tms_time, is_catch, is_train) that runTrials runs.
+
+Every task block is built from condition arrays with numpy and shuffled by its own generator spawned from the
+seed, so a plan only depends on (spec, seed): the same Subject ID always gets the same session. Catch trials are
+split evenly over the hands of a task. Run-length constraints are met by drawing batches of permutations at once
+and keeping the first one which satisfies them all, or for tight limits (and long blocks, where a shuffle rarely
+passes) by drawing trials one at a time among those which keep every run within its limit. During the session
+requeue puts a replacement of a trial which missed its timing later in the same block; the run length constraints
+are not checked again for it.
+
+Written for RT_tasks_v4.1.py
+"""
+import hashlib
+from bisect import bisect_right
+from itertools import accumulate
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+taskHands = {'SRT_L': [False], 'SRT_R': [True], 'UCRT': [True, False], 'ICRT': [True, False]}   # right: True/False
+catchCode = 'catch'                                                   # the stimTime value of catch trials in constraints
+
+
+def designSpec(tasks, stimTimes, stimTime_BL, trainingTrials, catchRatio, trialsPerStimtimePerCondition,
+               baselinesPerCondition, maxRun = None):
+    """returns a design spec.
+
+    Args:
+        tasks (_list_): the tasks to run, e.g. ['SRT_L', 'SRT_R', 'UCRT', 'ICRT'].
+        stimTimes (_dict_): task: list of TMS times relative to IS in ms, or 'halfRT'.
+        stimTime_BL (_int_): TMS time of the baseline trials.
+        trainingTrials (_int_): number of training trials per hand per task, used to determine RT.
+        catchRatio (_float_): catch trials added per non-catch trial, in training and experiment.
+        trialsPerStimtimePerCondition (_int_): trials per stimulation time per hand per task.
+        baselinesPerCondition (_int_): baseline trials per hand per task.
+        maxRun (_dict_): optional maximum run length of the same 'right' and/or 'tms_time' in the experimental trials.
+    """
+    for task in tasks:
+        if task not in taskHands:
+            raise ValueError(f'Unknown task {task}, must be one of {list(taskHands)}')
+    return {'tasks': list(tasks), 'hands': {t: taskHands[t] for t in tasks},
+            'stimTimes': {t: list(stimTimes[t]) for t in tasks}, 'stimTime_BL': stimTime_BL,
+            'trainingTrials': int(trainingTrials), 'catchRatio': catchRatio,
+            'trialsPerStimtimePerCondition': int(trialsPerStimtimePerCondition),
+            'baselinesPerCondition': int(baselinesPerCondition), 'maxRun': dict(maxRun or {})}
+
+
+def _conditions(hands, stimTimes, nPer, catchRatio):
+    """returns the right, tms_time and is_catch arrays of a part of a block: nPer[i] trials per hand at
+    stimTimes[i], then the catch trials."""
+    hands, nHands = np.array(hands, dtype = bool), len(hands)
+    stims = np.empty(len(stimTimes), dtype = object)
+    stims[:] = stimTimes
+    nPer = np.asarray(nPer, dtype = np.int64)
+    right = np.repeat(np.tile(hands, len(stims)), np.repeat(nPer, nHands))
+    tms = np.repeat(stims, nPer*nHands)
+    nCatch = int(len(right)*catchRatio)
+    right = np.r_[right, hands[np.arange(nCatch) % nHands]]          # catch trials split evenly over the hands
+    tms = np.r_[tms, np.full(nCatch, None, dtype = object)]
+    isCatch = np.r_[np.zeros(len(right) - nCatch, bool), np.ones(nCatch, bool)]
+    return right, tms, isCatch
+
+
+def runLengths(values):
+    """returns the longest run of equal values in every row of a 2D array."""
+    values = np.atleast_2d(values)
+    current = np.ones(values.shape[0], dtype = np.int64)
+    longest = current.copy()
+    same = values[:, 1:] == values[:, :-1]
+    for k in range(same.shape[1]):
+        current = np.where(same[:, k], current + 1, 1)
+        longest = np.maximum(longest, current)
+    return longest
+
+
+def _constrainedPermutation(rng, columns, maxRun, batch = 256, maxBatches = 3, maxAttempts = 20):
+    """returns a permutation of range(n) under which no column has a run longer than its limit."""
+    n = len(next(iter(columns.values()))) if columns else 0
+    checks = []
+    for name, limit in maxRun.items():
+        codes = np.unique(columns[name], return_inverse = True)[1]
+        if len(np.unique(codes)) > 1:                                 # a constant column (e.g. hand in SRT) can't alternate
+            counts = np.bincount(codes)
+            if counts.max() > (n - counts.max() + 1)*limit:
+                raise ValueError(f'maxRun {name}={limit} cannot be met with {counts.max()} of {n} trials equal')
+            checks.append((codes, limit))
+    if not checks or n < 2:
+        return rng.permutation(n)
+    for i in range(maxBatches if _shuffleLikely(checks, n) else 0):   # a plain shuffle usually works for loose limits
+        perms = rng.permuted(np.tile(np.arange(n), (batch, 1)), axis = 1)
+        ok = np.ones(batch, dtype = bool)
+        for codes, limit in checks:
+            ok &= runLengths(codes[perms]) <= limit
+        if ok.any():
+            return perms[np.argmax(ok)]
+    for i in range(maxAttempts):                                      # tight limits: build the order trial by trial
+        order = _sequentialPermutation(rng, checks, n)
+        if order is not None:
+            return order
+    raise ValueError(f'No order of {n} trials found meeting maxRun {maxRun} in {maxAttempts} attempts, '
+                     f'loosen maxRun or change the number of trials per condition')
+
+
+def _shuffleLikely(checks, n, maxExcess = 3):
+    """True if a plain shuffle is likely to meet the limits: in a shuffle of n trials a code making up a fraction
+    p of them starts about n*(1-p)*p**(limit+1) runs longer than the limit, which must stay below maxExcess."""
+    for codes, limit in checks:
+        p = np.bincount(codes)/n
+        if np.sum(n*(1 - p)*p**(limit + 1)) > maxExcess:
+            return False
+    return True
+
+
+def _sequentialPermutation(rng, checks, n):
+    """draws trials one at a time among those which do not break a run limit. Returns None at a dead end.
+
+    Trials with the same codes in every check are interchangeable, so the draw is made over those groups (a few
+    dozen at most) instead of over all trials: a group is drawn with a weight of the trials it has left, which is
+    the same as drawing one of the allowed trials, and the trial is the next of the group's shuffled pool."""
+    groupCodes, groupOf = np.unique(np.array([c for c, limit in checks]).T, axis = 0, return_inverse = True)
+    groupOf = groupOf.ravel()
+    pools = [rng.permutation(np.flatnonzero(groupOf == g)).tolist() for g in range(len(groupCodes))]
+    groupCodes = [tuple(codes) for codes in groupCodes.tolist()]
+    withCode = [{} for c in checks]                                   # check: code: the groups with that code
+    for g, codes in enumerate(groupCodes):
+        for i, code in enumerate(codes):
+            withCode[i].setdefault(code, set()).add(g)
+    limits = [limit for c, limit in checks]
+    left = [len(pool) for pool in pools]
+    run, last = [0]*len(checks), [-1]*len(checks)
+    draws = rng.random(n).tolist()
+    order = []
+    for k in range(n):
+        blocked = set().union(*(withCode[i][last[i]] for i in range(len(checks)) if run[i] >= limits[i]))
+        weights = list(accumulate(0 if g in blocked else l for g, l in enumerate(left)))
+        if weights[-1] == 0:
+            return None
+        g = bisect_right(weights, draws[k]*weights[-1])
+        order.append(pools[g][len(pools[g]) - left[g]])
+        left[g] -= 1
+        run = [r + 1 if c == l else 1 for r, c, l in zip(run, groupCodes[g], last)]
+        last = list(groupCodes[g])
+    return np.array(order, dtype = np.int64)
+
+
+def _block(spec, task, rng):
+    """returns the trials of one task: the shuffled training trials, then the shuffled experimental trials."""
+    hands, stimTimes = spec['hands'][task], spec['stimTimes'][task]
+    train = _conditions(hands, [None], [spec['trainingTrials']], spec['catchRatio'])
+    right, tms, isCatch = _conditions(hands, [spec['stimTime_BL']] + stimTimes,
+                                      [spec['baselinesPerCondition']] + [spec['trialsPerStimtimePerCondition']]*len(stimTimes),
+                                      spec['catchRatio'])
+
+    trainOrder = rng.permutation(len(train[0]))
+    stimKey = np.array([catchCode if c else str(t) for t, c in zip(tms, isCatch)])
+    order = _constrainedPermutation(rng, {'right': right, 'tms_time': stimKey}, spec['maxRun'])
+    trials = [(task, bool(train[0][i]), None, bool(train[2][i]), True) for i in trainOrder]
+    trials += [(task, bool(right[i]), tms[i], bool(isCatch[i]), False) for i in order]
+    return trials
+
+
+def createPlan(spec, seed):
+    """returns the list of trials of one session: (task, right, tms_time, is_catch, is_train) tuples.
+    Training trials come first in each task block, the task blocks come in random order."""
+    seeds = np.random.SeedSequence(int(seed)).spawn(len(spec['tasks']) + 1)
+    blocks = [_block(spec, task, np.random.default_rng(s)) for task, s in zip(spec['tasks'], seeds)]
+    taskOrder = np.random.default_rng(seeds[-1]).permutation(len(blocks))
+    return [trial for i in taskOrder for trial in blocks[i]]
+
+
+def requeue(plan, i, seed):
+    """inserts a copy of trial i at a random place later in its task block, to replace it. The place only depends
+    on (seed, i), so replaying the same re-queues on the plan gives the same session. Returns the new index."""
+    end = i + 1
+    while end < len(plan) and plan[end][0] == plan[i][0]:
+        end += 1
+    j = int(np.random.default_rng([int(seed), i]).integers(i + 1, end + 1))
+    plan.insert(j, plan[i])
+    return j
+
+
+def planDigest(plan):
+    """returns a sha256 of a plan, equal for equal plans on any machine or Python run."""
+    return hashlib.sha256(repr(plan).encode()).hexdigest()
+
+
+def checkReproducible(spec, seed, runs = 3):
+    """builds the plan of seed in runs fresh processes and returns its digest. Raises if any differ."""
+    with ProcessPoolExecutor(runs) as pool:
+        digests = set(pool.map(_digestOf, [spec]*runs, [seed]*runs))
+    digests.add(planDigest(createPlan(spec, seed)))
+    if len(digests) != 1:
+        raise AssertionError(f'Plan of seed {seed} differs between runs: {digests}')
+    return digests.pop()
+
+
+def _digestOf(spec, seed):
+    return planDigest(createPlan(spec, seed))
+
+
+if __name__ == '__main__':
+    import sys, time
+    spec = designSpec(['SRT_L', 'SRT_R', 'UCRT', 'ICRT'], {t: [-100, 'halfRT'] for t in taskHands}, -500, 20, 0.1, 20, 5,
+                      maxRun = {'right': 4, 'tms_time': 3})
+    for seed in [int(a) for a in sys.argv[1:]] or [0, 1, 2]:
+        start = time.perf_counter()
+        plan = createPlan(spec, seed)
+        print(f'seed {seed}: {len(plan)} trials in {(time.perf_counter()-start)*1000:.1f} ms, identical in fresh processes: {checkReproducible(spec, seed)}')
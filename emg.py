@@ -0,0 +1,418 @@
+"""
+Real-time EMG/EEG acquisition and online MEP extraction for the RT tasks.
+
+The script fires TMS but never saw the muscle response. Here a separate process reads a sample stream (a TCP
+stream from the amplifier bridge, or a recording replayed from file) into a ring buffer in shared memory. Every
+TMS pulse is sent to that process with its marker time, and once the samples after the pulse are in, it measures
+the MEP of all waiting pulses at once with vectorized windows: peak-to-peak amplitude and onset latency in the
+MEP window, and the RMS of the EMG before the pulse. The results come back on a queue and are written with the
+trial. Nothing of this runs in the trial loop, trialRT1 only sees the marker queue.
+
+The ring buffer has one writer (the acquisition process) and any number of readers, and needs no lock: the
+samples are written first and the sample counter in the header after, so a reader never sees samples which are
+not there yet, and a reader which falls a full buffer behind notices it from the counter.
+
+Sources: SocketSource (float32 samples over TCP), FileSource (replays a .npy or raw float32 file in real time)
+and, for simulated sessions, simulation.SimulatedEMGSource. 'python emg.py serve recording.npy' streams a
+recording like an amplifier would, as a stand-in for testing.
+
+Written for RT_tasks_v4.1.py
+"""
+import sys, time, math, queue, atexit, socket
+import multiprocessing as mp
+from collections import namedtuple
+from multiprocessing import shared_memory
+
+import numpy as np
+
+MEP = namedtuple('MEP', ['trialN', 'pulse', 'amplitude', 'latency', 'rms'])   # pulse in s on the stream clock, latency in ms
+noMEP = lambda trialN = None: MEP(trialN, math.nan, math.nan, math.nan, math.nan)
+
+
+class SampleRing:
+    """Timestamped samples in a ring buffer in shared memory.
+
+    Args:
+        nChannels (_int_): number of channels.
+        capacity (_int_): number of samples kept.
+        name (_str_): the shared memory block to attach to. None creates a new one.
+    """
+
+    def __init__(self, nChannels, capacity, name = None):
+        self.nChannels, self.capacity = nChannels, capacity
+        size = 8 + capacity*8 + capacity*nChannels*4
+        self.owner = name is None
+        self.shm = shared_memory.SharedMemory(name = name, create = self.owner, size = size)
+        self._count = np.ndarray(1, np.int64, buffer = self.shm.buf)  # samples written since the start
+        self.times = np.ndarray(capacity, np.float64, buffer = self.shm.buf, offset = 8)
+        self.data = np.ndarray((capacity, nChannels), np.float32, buffer = self.shm.buf, offset = 8 + capacity*8)
+        if self.owner:
+            self._count[0] = 0
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    @property
+    def written(self):
+        return int(self._count[0])
+
+    def write(self, times, samples):
+        """appends samples (n x nChannels) with their times. Only one process may write."""
+        n = len(times)
+        if n > self.capacity:
+            times, samples, n = times[-self.capacity:], samples[-self.capacity:], self.capacity
+        start = self.written % self.capacity
+        first = min(n, self.capacity - start)
+        self.times[start:start + first] = times[:first]
+        self.data[start:start + first] = samples[:first]
+        self.times[:n - first] = times[first:]
+        self.data[:n - first] = samples[first:]
+        self._count[0] = self.written + n                             # published after the samples are in place
+
+    def read(self, start, stop = None):
+        """returns copies of the times and samples with index start to stop (counted from the start of the stream),
+        without the part which was overwritten while reading."""
+        stop = self.written if stop is None else stop
+        start = max(start, stop - self.capacity, 0)
+        idx = np.arange(start, stop) % self.capacity
+        times, data = self.times[idx], self.data[idx]
+        lost = self.written - self.capacity - start                   # the writer lapped the reader meanwhile
+        if lost > 0:
+            times, data = times[lost:], data[lost:]
+        return times, data
+
+    def latest(self, n):
+        """returns the last n samples."""
+        return self.read(self.written - n)
+
+    def lastTime(self):
+        n = self.written
+        return self.times[(n - 1) % self.capacity] if n else -math.inf
+
+    def close(self):
+        self._count = self.times = self.data = None
+        self.shm.close()
+        if self.owner:                                                # only the creator unlinks the block
+            self.shm.unlink()
+
+
+class MEPExtractor:
+    """Measures MEPs in the EMG of one channel.
+
+    Args:
+        fs (_float_): sampling rate in Hz.
+        channel (_int_): the EMG channel of the target muscle.
+        pre (_tuple_): window before the pulse for the baseline and RMS, in s relative to the pulse.
+        window (_tuple_): the MEP window in s relative to the pulse, after the TMS artefact.
+        onsetSDs (_float_): the MEP starts where the EMG leaves the baseline by this many SDs.
+    """
+
+    def __init__(self, fs, channel = 0, pre = (-0.1, -0.005), window = (0.015, 0.06), onsetSDs = 5):
+        self.fs, self.channel = fs, channel
+        self.pre, self.window = pre, window
+        self.onsetSDs = onsetSDs
+        self.preOffsets = np.arange(round(pre[0]*fs), round(pre[1]*fs))
+        self.winOffsets = np.arange(round(window[0]*fs), round(window[1]*fs))
+
+    def measure(self, times, data, pulses):
+        """returns the amplitude, latency (ms) and pre-pulse RMS of every pulse, as arrays. nan where the samples
+        around a pulse are missing."""
+        pulses = np.asarray(pulses, dtype = float)
+        x = data[:, self.channel].astype(np.float64)
+        at = np.searchsorted(times, pulses)                           # the first sample at or after each pulse
+        valid = (at + self.preOffsets[0] >= 0) & (at + self.winOffsets[-1] < len(x))
+        amplitude, latency, rms = (np.full(len(pulses), math.nan) for i in range(3))
+        if not valid.any():
+            return amplitude, latency, rms
+        at, t = at[valid], pulses[valid]                              # only pulses with all their samples are indexed
+        preX = x[at[:, None] + self.preOffsets]                       # (pulses, samples)
+        winX = x[at[:, None] + self.winOffsets]
+        baseline = preX.mean(axis = 1)
+        rms[valid] = np.sqrt(((preX - baseline[:, None])**2).mean(axis = 1))
+        amplitude[valid] = winX.max(axis = 1) - winX.min(axis = 1)
+        above = np.abs(winX - baseline[:, None]) > self.onsetSDs*np.maximum(rms[valid], 1e-12)[:, None]
+        first = above.argmax(axis = 1)
+        onset = (self.winOffsets[first]/self.fs + times[at] - t)*1000
+        latency[valid] = np.where(above.any(axis = 1), onset, math.nan)
+        return amplitude, latency, rms
+
+
+############ sources ############
+class FileSource:
+    """Replays a recording in real time: a .npy of samples x channels, or raw interleaved float32.
+
+    Args:
+        path (_str_): the recording.
+        fs (_float_): its sampling rate in Hz.
+        nChannels (_int_): number of channels of a raw file.
+        loop (_bool_): start over at the end.
+    """
+
+    def __init__(self, path, fs, nChannels = 1, loop = True, clock = time.perf_counter):
+        self.path, self.fs, self.nChannels, self.loop = path, fs, nChannels, loop
+        self.clock = clock
+
+    def open(self):
+        if self.path.endswith('.npy'):
+            self.samples = np.atleast_2d(np.load(self.path, mmap_mode = 'r').T).T
+        else:
+            self.samples = np.memmap(self.path, dtype = np.float32, mode = 'r').reshape(-1, self.nChannels)
+        self.start = self.clock()
+        self.sent = 0
+
+    def read(self):
+        due = int((self.clock() - self.start)*self.fs)
+        if due <= self.sent or (not self.loop and self.sent >= len(self.samples)):
+            return None
+        idx = np.arange(self.sent, due)
+        if self.loop:
+            idx %= len(self.samples)
+        else:
+            idx = idx[idx < len(self.samples)]
+        times = self.start + np.arange(self.sent, self.sent + len(idx))/self.fs
+        self.sent += len(idx)
+        return times, np.asarray(self.samples[idx], dtype = np.float32)
+
+    def close(self):
+        self.samples = None
+
+
+class SocketSource:
+    """Reads interleaved little-endian float32 samples from a TCP stream.
+
+    Samples are timestamped by their index from a start time, which is moved back whenever a packet arrives
+    earlier than its samples would have been taken, so the timestamps follow the earliest arrivals and not the
+    jitter of the network.
+
+    Args:
+        nChannels (_int_): channels per sample.
+        fs (_float_): sampling rate in Hz.
+        host, port: where the amplifier bridge listens.
+    """
+
+    def __init__(self, nChannels, fs, host = '127.0.0.1', port = 5555, clock = time.perf_counter):
+        self.nChannels, self.fs = nChannels, fs
+        self.host, self.port = host, port
+        self.clock = clock
+
+    def open(self):
+        self.sock = socket.create_connection((self.host, self.port), timeout = 5)
+        self.sock.setblocking(False)
+        self.pending = b''
+        self.received = 0
+        self.start = None
+
+    def read(self):
+        try:
+            chunk = self.sock.recv(1 << 16)
+        except BlockingIOError:
+            return None
+        arrival = self.clock()
+        if not chunk:
+            raise ConnectionError('The EMG stream was closed')
+        self.pending += chunk
+        frame = 4*self.nChannels
+        n = len(self.pending)//frame
+        if n == 0:
+            return None
+        samples = np.frombuffer(self.pending[:n*frame], dtype = '<f4').reshape(n, self.nChannels)
+        self.pending = self.pending[n*frame:]
+        if self.start is None:
+            self.start = arrival - (n - 1)/self.fs
+        times = self.start + np.arange(self.received, self.received + n)/self.fs
+        if times[-1] > arrival:                                       # samples can't arrive before they are taken
+            self.start -= times[-1] - arrival
+            times -= times[-1] - arrival
+        self.received += n
+        return times, samples
+
+    def close(self):
+        self.sock.close()
+
+
+############ consumer ############
+class Consumer:
+    """Moves samples from a source into the ring and measures the MEPs of the pulses whose window is complete."""
+
+    def __init__(self, source, ring, extractor):
+        self.source, self.ring, self.extractor = source, ring, extractor
+        self.pending = []                                             # (trialN, pulse time) waiting for samples
+
+    def step(self):
+        """returns (read something, list of MEPs)."""
+        chunk = self.source.read()
+        if chunk is not None and len(chunk[0]):
+            self.ring.write(*chunk)
+        if not self.pending:
+            return chunk is not None, []
+        last = self.ring.lastTime()
+        ready = [p for p in self.pending if p[1] + self.extractor.window[1] <= last]
+        if not ready:
+            return chunk is not None, []
+        self.pending = [p for p in self.pending if p not in ready]
+        first = min(t for n, t in ready) + self.extractor.pre[0]
+        n = min(int((last - first)*self.extractor.fs) + 2, self.ring.capacity)
+        times, data = self.ring.latest(n)
+        amplitude, latency, rms = self.extractor.measure(times, data, [t for n, t in ready])
+        return True, [MEP(trialN, t, float(a), float(l), float(r)) for (trialN, t), a, l, r in zip(ready, amplitude, latency, rms)]
+
+
+def _run(source, ringName, nChannels, capacity, extractor, pulses, results, stop):
+    """the acquisition process."""
+    ring = SampleRing(nChannels, capacity, name = ringName)
+    consumer = Consumer(source, ring, extractor)
+    source.open()
+    try:
+        while not stop.is_set():
+            try:
+                while True:
+                    consumer.pending.append(pulses.get_nowait())
+            except queue.Empty:
+                pass
+            busy, meps = consumer.step()
+            for m in meps:
+                results.put(m)
+            if not busy:
+                time.sleep(0.0005)
+    finally:
+        source.close()
+        ring.close()
+
+
+def startWithoutMain(process):
+    """starts a spawned process without running the main script again in it, the experiment script has no
+    'if __name__ == "__main__"' guard."""
+    main = sys.modules['__main__']
+    mainFile = main.__dict__.pop('__file__', None)
+    try:
+        process.start()
+    finally:
+        if mainFile is not None:
+            main.__file__ = mainFile
+
+
+class EMGStream:
+    """The experiment side of the acquisition.
+
+    pulse() tells the acquisition process when TMS fired, measures() returns the MEP of a trial.
+
+    Args:
+        source: where the samples come from, opened in the acquisition process.
+        fs (_float_): sampling rate in Hz.
+        nChannels (_int_): number of channels.
+        extractor (_MEPExtractor_): how MEPs are measured. Default channel 0 with the default windows.
+        seconds (_float_): length of the ring buffer.
+        clock: the clock of the pulse times, e.g. globalTimer.getTime.
+        streamClock: the clock of the source's timestamps.
+        process (_bool_): run the acquisition in a separate process. False steps it in measures() instead, for
+            simulated sessions on a virtual clock.
+    """
+
+    def __init__(self, source, fs, nChannels, extractor = None, seconds = 10, clock = time.perf_counter,
+                 streamClock = time.perf_counter, process = True):
+        self.source, self.fs, self.nChannels = source, fs, nChannels
+        self.extractor = extractor or MEPExtractor(fs)
+        self.capacity = int(seconds*fs)
+        self.clock, self.streamClock = clock, streamClock
+        self.process = process
+        self.pulseListeners = []                                      # called as listener(trialN, time on the stream clock)
+        self.results = {}                                             # trialN: MEP
+        self.offset = 0.0
+        self.ring = None
+
+    def start(self):
+        self.ring = SampleRing(self.nChannels, self.capacity)
+        if self.process:
+            ctx = mp.get_context('spawn')                             # no fork of a process holding the window and threads
+            self._pulses, self._results, self._stop = ctx.Queue(), ctx.Queue(), ctx.Event()
+            self._process = ctx.Process(target = _run, name = 'EMGStream', daemon = True,
+                                        args = (self.source, self.ring.name, self.nChannels, self.capacity,
+                                                self.extractor, self._pulses, self._results, self._stop))
+            startWithoutMain(self._process)
+        else:
+            self._consumer = Consumer(self.source, self.ring, self.extractor)
+            self.source.open()
+        self.syncClock()
+        atexit.register(self.close)                                   # also on core.quit()
+        return self
+
+    def syncClock(self, n = 20):
+        """measures the offset of the stream clock to the pulse clock, from the narrowest of n readings."""
+        best = math.inf
+        for i in range(n):
+            a = self.streamClock()
+            t = self.clock()
+            b = self.streamClock()
+            if b - a < best:
+                best, self.offset = b - a, (a + b)/2 - t
+        return self.offset
+
+    def pulse(self, trialN, t):
+        """call after a TMS pulse at time t on the pulse clock."""
+        tStream = t + self.offset
+        for listener in self.pulseListeners:
+            listener(trialN, tStream)
+        if self.process:
+            self._pulses.put((trialN, tStream))
+        else:
+            self._consumer.pending.append((trialN, tStream))
+
+    def _collect(self, meps):
+        for m in meps:
+            self.results[m.trialN] = m
+
+    def measures(self, trialN, timeout = 0.2):
+        """returns the MEP of a trial, waiting up to timeout s for the acquisition. A MEP of nans if there is none."""
+        if trialN in self.results:
+            return self.results.pop(trialN)
+        if self.process:
+            deadline = time.perf_counter() + timeout
+            while trialN not in self.results:
+                try:
+                    self._collect([self._results.get(timeout = max(deadline - time.perf_counter(), 0))])
+                except queue.Empty:
+                    break
+        else:
+            busy = True
+            while busy and trialN not in self.results:
+                busy, meps = self._consumer.step()
+                self._collect(meps)
+        return self.results.pop(trialN, noMEP(trialN))
+
+    def close(self):
+        if self.ring is None:
+            return
+        if self.process:
+            self._stop.set()
+            self._process.join(2)
+        else:
+            self.source.close()
+        self.ring.close()
+        self.ring = None
+
+
+def serve(path, port = 5555, fs = 5000, nChannels = 1, chunk = 0.005):
+    """streams a recording over TCP as float32 at the sampling rate, like an amplifier bridge."""
+    source = FileSource(path, fs, nChannels)
+    with socket.create_server(('127.0.0.1', port)) as server:
+        print(f'Streaming {path} at {fs} Hz on port {port}')
+        while True:                                                   # one session after the other
+            conn, addr = server.accept()
+            source.open()
+            with conn:
+                try:
+                    while True:
+                        samples = source.read()
+                        if samples is not None:
+                            conn.sendall(np.ascontiguousarray(samples[1], dtype = '<f4').tobytes())
+                        time.sleep(chunk)
+                except (BrokenPipeError, ConnectionResetError):
+                    print(f'{addr} disconnected')
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 2 and sys.argv[1] == 'serve':
+        serve(sys.argv[2], *[int(a) for a in sys.argv[3:]])
+    else:
+        print('usage: python emg.py serve recording.npy [port fs nChannels]')
@@ -0,0 +1,160 @@
+"""
+Per-trial timing instrumentation for the RT tasks.
+
+For every trial the TimingLog keeps the intended and achieved onsets of fixation, cue, IS and TMS, the
+flip-to-flip intervals and dropped frames, the trigger write latencies, and a session histogram of how long each
+pass of the trial loop took. The rows are kept as columns in memory and saved as a compressed .npz sidecar next
+to the data csv, one array per column, so they load straight into numpy/pandas for reviewers. The sidecar is
+rewritten after every trial, before its checkpoint, so a resumed session keeps the rows of every trial in the csv.
+
+Loop iteration times are measured on time.perf_counter, so they show the real cost of the loop also when the
+session runs on a virtual clock.
+
+Written for RT_tasks_v4.1.py
+"""
+import os, math, time
+
+import numpy as np
+
+events = ('fixation', 'cue', 'IS', 'TMS')
+columns = (['trialN'] + [f'{e}_{k}' for e in events for k in ('scheduled', 'actual')]
+           + ['nFlips', 'flipMean', 'flipMax', 'droppedFrames', 'tmsLatency', 'markerLatencyMax', 'nMarkers',
+              'loopMedian', 'loopMax'])
+
+
+class TimingLog:
+    """Collects timing diagnostics of every trial.
+
+    Args:
+        frameDur (_float_): the expected refresh period in s. A flip interval above 1.5 frames is a dropped frame.
+        binWidth (_float_): width of the loop time histogram bins in s.
+        histMax (_float_): loop times above this go into the last bin.
+        markerGap (_float_): the time the marker port keeps the pins low between two markers, in s, see markers.MarkerPort.
+    """
+
+    def __init__(self, frameDur, binWidth = 0.00001, histMax = 0.05, markerGap = 0.001):
+        self.frameDur = frameDur
+        self.markerGap = markerGap
+        self.binWidth = binWidth
+        self.loopHist = np.zeros(int(round(histMax/binWidth)) + 1, dtype = np.int64)
+        self.data = {c: [] for c in columns}
+        self.blockStart = 0                                           # first row of the current block
+        self._flips = []
+        self._loops = []
+        self._lastLoop = None
+
+    ############ called from the trial loop, kept cheap ############
+    def startTrial(self):
+        self._flips = []
+        self._loops = []
+        self._lastLoop = None
+
+    def flip(self, t):
+        """saves the time a flip returned, in s."""
+        self._flips.append(t)
+
+    def loop(self):
+        """call once per pass of the trial loop."""
+        now = time.perf_counter()
+        if self._lastLoop is not None:
+            self._loops.append(now - self._lastLoop)
+        self._lastLoop = now
+
+    ############ called after the trial ############
+    def endTrial(self, trialN, timeline, tmsLatency = math.nan, edges = ()):
+        """adds the row of a finished trial.
+
+        Args:
+            trialN (_int_): trial number.
+            timeline (_scheduler.TrialTimeline_): scheduled and achieved times of the trial.
+            tmsLatency (_float_): TMS latency in ms, see tms.TMSDriver.lastLatency.
+            edges (_list_): markers.Edge of the markers sent during the trial.
+        """
+        row = {'trialN': trialN}
+        for e in events:
+            inTimeline = e in timeline.events
+            row[f'{e}_scheduled'] = timeline.scheduled(e)*1000 if inTimeline else math.nan
+            row[f'{e}_actual'] = timeline.achieved(e)*1000 if inTimeline else math.nan
+
+        intervals = np.diff(self._flips)*1000
+        row['nFlips'] = len(self._flips)
+        row['flipMean'] = intervals.mean() if len(intervals) else math.nan
+        row['flipMax'] = intervals.max() if len(intervals) else math.nan
+        row['droppedFrames'] = int(np.sum(intervals > 1.5*self.frameDur*1000))
+        row['tmsLatency'] = tmsLatency
+        # a marker sent while the port was still busy waits for the previous pulse and the gap by design, so only
+        # the first marker of each burst shows how long the port took
+        first = [e for i, e in enumerate(edges) if i == 0 or e.requested >= edges[i-1].clear + self.markerGap]
+        markerLatency = [(e.set - e.requested)*1000 for e in first]
+        row['markerLatencyMax'] = max(markerLatency) if markerLatency else math.nan
+        row['nMarkers'] = len(edges)
+
+        loops = np.array(self._loops)
+        row['loopMedian'] = np.median(loops)*1000 if len(loops) else math.nan
+        row['loopMax'] = loops.max()*1000 if len(loops) else math.nan
+        if len(loops):
+            bins = np.minimum((loops/self.binWidth).astype(np.int64), len(self.loopHist) - 1)
+            self.loopHist += np.bincount(bins, minlength = len(self.loopHist))
+
+        for c in columns:
+            self.data[c].append(row[c])
+        return row
+
+    def lastRow(self):
+        """the row of the last trial, as a dict."""
+        return {c: self.data[c][-1] for c in columns}
+
+    ############ reports ############
+    def loopPercentile(self, q):
+        """percentile q (0-100) of all loop iteration times so far, in ms, from the histogram."""
+        total = self.loopHist.sum()
+        if total == 0:
+            return math.nan
+        n = np.searchsorted(np.cumsum(self.loopHist), q/100*total)
+        return (n + 0.5)*self.binWidth*1000
+
+    def summary(self, start = None):
+        """returns a one paragraph report of the rows from start (default the current block) on."""
+        start = self.blockStart if start is None else start
+        col = lambda c: np.array(self.data[c][start:], dtype = float)
+        n = len(self.data['trialN']) - start
+        if n == 0:
+            return '# Timing: no trials'
+        isErr = np.abs(col('IS_actual') - col('IS_scheduled'))
+        tmsErr = np.abs(col('TMS_actual') - col('TMS_scheduled'))
+        nanMax = lambda a: np.nanmax(a) if np.any(~np.isnan(a)) else math.nan
+        return (f'# Timing of {n} trials: IS error mean {np.nanmean(isErr):.2f} max {nanMax(isErr):.2f} ms,'
+                f' TMS error max {nanMax(tmsErr):.2f} ms, dropped frames {int(np.nansum(col("droppedFrames")))},'
+                f' flip interval max {nanMax(col("flipMax")):.2f} ms, TMS latency max {nanMax(col("tmsLatency")):.3f} ms,'
+                f' marker latency max {nanMax(col("markerLatencyMax")):.3f} ms,'
+                f' loop p50/p99 {self.loopPercentile(50):.3f}/{self.loopPercentile(99):.3f} ms')
+
+    def endBlock(self):
+        """returns the summary of the block which just ended and starts a new one."""
+        text = self.summary()
+        self.blockStart = len(self.data['trialN'])
+        return text
+
+    def load(self, path, before = None):
+        """puts the rows and loop histogram of an earlier save in front, when a session is resumed.
+        Only rows of trials before trial number before are kept."""
+        saved = np.load(path)
+        keep = saved['trialN'] < before if before is not None else slice(None)
+        for c in columns:
+            self.data[c] = list(saved[c][keep]) + self.data[c]
+        if len(saved['loopHist']) == len(self.loopHist):
+            self.loopHist += saved['loopHist']
+        self.blockStart = len(self.data['trialN'])
+
+    def save(self, path):
+        """writes all rows and the loop histogram to a compressed .npz file. The file is replaced as a whole, a crash
+        while saving leaves the previous save."""
+        arrays = {c: np.array(v, dtype = float) for c, v in self.data.items()}
+        arrays['loopHist'] = self.loopHist
+        arrays['loopHistBinWidth'] = np.array(self.binWidth)
+        arrays['frameDur'] = np.array(self.frameDur)
+        with open(path + '.tmp', 'wb') as f:
+            np.savez_compressed(f, **arrays)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + '.tmp', path)
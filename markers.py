@@ -0,0 +1,158 @@
+"""
+Asynchronous EEG marker output for the RT tasks.
+
+sendRemark used to set the parallel port, block for the pulse width and clear the pins inside the trial loop.
+Here markers are put on a queue and a dedicated worker thread owns the port: it holds each code for the pulse
+width, keeps back-to-back markers apart with a low gap so codes never overlap, and timestamps every set and
+clear edge. The stimulus loop only pays for a queue put.
+
+Backends: ParallelBackend (psychopy.parallel), NullBackend (no hardware) and RecordingBackend (keeps every
+write in memory, for benchmarks and simulation).
+
+Written for RT_tasks_v4.1.py
+"""
+import os, sys, time, queue, threading
+from collections import namedtuple
+
+Edge = namedtuple('Edge', ['code', 'requested', 'set', 'clear'])     # one marker pulse, times on the port clock
+
+
+class NullBackend:
+    """A port that does nothing. Used when debugging without hardware."""
+    name = 'null'
+
+    def setData(self, code):
+        pass
+
+    def close(self):
+        pass
+
+
+class RecordingBackend:
+    """A port that records every write with a timestamp, so marker timing can be checked without hardware."""
+    name = 'recording'
+
+    def __init__(self, clock = time.perf_counter):
+        self.clock = clock
+        self.writes = []                                              # (time, code) of every pin change
+
+    def setData(self, code):
+        self.writes.append((self.clock(), code))
+
+    def close(self):
+        pass
+
+
+class ParallelBackend:
+    """The parallel port of the EEG system."""
+    name = 'parallel'
+
+    def __init__(self, address = 0x378):
+        from psychopy import parallel                                 # only needed when real hardware is used
+        self.port = parallel.ParallelPort(address = address)
+        self.port.setData(0)                                          # set all pins low
+
+    def setData(self, code):
+        self.port.setData(code)
+
+    def close(self):
+        self.port.setData(0)
+
+
+def raiseThreadPriority():
+    """tries to give the calling thread real-time priority. Returns True if it worked."""
+    try:
+        if sys.platform == 'win32':
+            import ctypes
+            kernel32 = ctypes.windll.kernel32
+            return bool(kernel32.SetThreadPriority(kernel32.GetCurrentThread(), 15))   # THREAD_PRIORITY_TIME_CRITICAL
+        os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(os.sched_get_priority_min(os.SCHED_FIFO)))
+        return True                                                   # on Linux pid 0 is the calling thread
+    except (AttributeError, OSError):
+        return False
+
+
+class MarkerPort:
+    """Sends EEG markers from a worker thread.
+
+    Args:
+        backend (_object_): anything with setData(code) and close().
+        pulseWidth (_float_): how long a code is held high, in s.
+        gap (_float_): minimum time the pins are low between two markers, in s. Defaults to the pulse width.
+        clock (_callable_): returns the current time in s, used for all timestamps.
+    """
+
+    def __init__(self, backend, pulseWidth = 0.001, gap = None, clock = time.perf_counter):
+        self.backend = backend
+        self.pulseWidth = pulseWidth
+        self.gap = pulseWidth if gap is None else gap
+        self.clock = clock
+        self.edges = []                                               # Edge of every pulse sent, appended by the worker
+        self.merged = 0                                               # number of markers merged into the pulse before
+        self.highPriority = False
+        self._sent = 0                                                # markers queued, only counted by the sending thread
+        self._done = 0                                                # markers pulsed or merged by the worker
+        self._idle = threading.Condition()
+        self._queue = queue.SimpleQueue()
+        self._worker = threading.Thread(target = self._run, name = 'MarkerPort', daemon = True)
+        self._worker.start()
+
+    def send(self, code):
+        """queues a marker. Never blocks."""
+        self._sent += 1
+        self._queue.put((code, self.clock()))
+
+    def _waitUntil(self, t):
+        remaining = t - self.clock()
+        if remaining > 0.002:
+            time.sleep(remaining - 0.002)                             # sleep most of it, spin the rest
+        while self.clock() < t:
+            pass
+
+    def _run(self):
+        self.highPriority = raiseThreadPriority()
+        lastClear = -float('inf')
+        pending = None                                                # a marker taken off the queue while merging
+        while True:
+            code, requested = pending if pending else self._queue.get()
+            pending = None
+            if code is None:
+                break
+            merged = 0
+            self._waitUntil(lastClear + self.gap)                      # pins stay low for at least gap
+            self.backend.setData(code)
+            tSet = self.clock()
+            self._waitUntil(tSet + self.pulseWidth)
+            while pending is None:                                    # the same code queued while high is the same pulse
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item[0] == code:
+                    self.merged += 1
+                    merged += 1
+                else:
+                    pending = item
+            self.backend.setData(0)
+            lastClear = self.clock()
+            self.edges.append(Edge(code, requested, tSet, lastClear))
+            with self._idle:
+                self._done += 1 + merged
+                self._idle.notify_all()
+
+    def waitSent(self, timeout = 0.05):
+        """blocks until every marker queued so far has its Edge in edges, at most timeout s. Returns False on a
+        timeout. Costs about a pulse width after the last marker, call it before reading the edges of a trial."""
+        target = self._sent
+        with self._idle:
+            return self._idle.wait_for(lambda: self._done >= target, timeout)
+
+    def flush(self, timeout = 1.0):
+        """blocks until every queued marker has been sent. Only call this outside the trial loop."""
+        self.waitSent(timeout)
+
+    def close(self):
+        """sends the remaining markers, stops the worker and releases the port."""
+        self._queue.put((None, None))
+        self._worker.join(timeout = 2.0)
+        self.backend.close()
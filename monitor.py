@@ -0,0 +1,227 @@
+"""
+Live experimenter dashboard for the RT tasks, in a separate process.
+
+The experimenter used to see nothing but the log file, and drawing anything extra on the stimulus window costs
+stimulus time. Here the experiment publishes one record per trial (RT, correctness, TMS offset, timing errors,
+halfRT, MEP) into a ring of fixed-size records in shared memory: the fields are written straight into the next
+slot and the record counter is raised after, no lock, no queue and no pickling, between trials only. A dashboard
+process with low priority, off the core of the trial loop, reads the new records and renders running accuracy,
+RT distributions per task and hand, halfRT and timing health, in its terminal or as a local web page.
+
+Run a dashboard on a running session by hand with:  python monitor.py <shared memory name> [web]
+
+Written for RT_tasks_v4.1.py
+"""
+import os, sys, time, math, atexit
+import multiprocessing as mp
+from multiprocessing import shared_memory, resource_tracker
+
+import numpy as np
+
+from emg import startWithoutMain
+
+taskNames = ('SRT_L', 'SRT_R', 'UCRT', 'ICRT', 'BL')
+record = np.dtype([('trialN', np.int32), ('task', np.int8), ('right', np.int8), ('correct', np.int8),
+                   ('is_catch', np.int8), ('is_train', np.int8), ('nFailures', np.int8), ('rt', np.float32),
+                   ('tmsSent', np.float32), ('isError', np.float32), ('tmsError', np.float32),
+                   ('halfRT', np.float32), ('mep', np.float32), ('time', np.float64)])
+
+
+class RecordRing:
+    """Trial records in a ring buffer in shared memory, one writer, no locks.
+
+    Args:
+        capacity (_int_): number of records kept.
+        name (_str_): the shared memory block to attach to. None creates a new one.
+    """
+
+    def __init__(self, capacity = 4096, name = None):
+        self.owner = name is None
+        self.shm = shared_memory.SharedMemory(name = name, create = self.owner, size = 16 + capacity*record.itemsize)
+        if not self.owner and mp.parent_process() is None:           # a dashboard started by hand must not unlink the block
+            resource_tracker.unregister(self.shm._name, 'shared_memory')
+        self._header = np.ndarray(2, np.int64, buffer = self.shm.buf)  # records written, capacity
+        if self.owner:
+            self._header[:] = 0, capacity
+        self.capacity = int(self._header[1])
+        self.records = np.ndarray(self.capacity, record, buffer = self.shm.buf, offset = 16)
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    @property
+    def written(self):
+        return int(self._header[0])
+
+    def publish(self, **fields):
+        """writes one record into the next slot, missing fields are nan or 0."""
+        n = self.written
+        slot = self.records[n % self.capacity:n % self.capacity + 1]  # a view of the slot
+        slot[0] = 0
+        for key in ('rt', 'tmsSent', 'isError', 'tmsError', 'halfRT', 'mep', 'time'):
+            slot[key] = math.nan
+        for key, value in fields.items():
+            slot[key] = math.nan if value is None else value
+        self._header[0] = n + 1                                       # published after the record is complete
+
+    def read(self, start):
+        """returns a copy of the records from number start on, and the number to continue from."""
+        stop = self.written
+        start = max(start, stop - self.capacity + 1)                  # the oldest slot may be being rewritten
+        records = self.records[np.arange(start, stop) % self.capacity].copy()
+        return records, stop
+
+    def close(self):
+        self._header = self.records = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+class Dashboard:
+    """Keeps every record read from a RecordRing and renders them as text."""
+
+    def __init__(self, ring, recent = 20):
+        self.ring = ring
+        self.recent = recent
+        self.seen = 0
+        self.records = np.zeros(0, record)
+        self.started = time.perf_counter()
+
+    def update(self):
+        new, self.seen = self.ring.read(self.seen)
+        if len(new):
+            self.records = np.concatenate([self.records, new])
+        return self.render()
+
+    def render(self):
+        r = self.records
+        lines = [f'RT tasks - {len(r)} trials, dashboard up {time.perf_counter() - self.started:.0f} s']
+        if len(r) == 0:
+            return '\n'.join(lines + ['waiting for the first trial'])
+        trials = r[r['task'] != taskNames.index('BL')]
+        if len(trials):
+            last = trials[-1]
+            lines.append(f'last trial {last["trialN"]}: {taskNames[last["task"]]} {"R" if last["right"] else "L"}, '
+                         f'RT {last["rt"]:.0f} ms, {"correct" if last["correct"] else "WRONG"}, TMS at {last["tmsSent"]:.1f} ms')
+            recent = trials[-self.recent:]
+            lines.append(f'accuracy {trials["correct"].mean()*100:.1f} % overall, {recent["correct"].mean()*100:.1f} % of the last {len(recent)}')
+        lines += ['', f'{"task":6} hand     n  correct  median RT    IQR   halfRT  RT distribution 100-1000 ms']
+        for t, task in enumerate(taskNames[:-1]):
+            for right in (0, 1):
+                sel = trials[(trials['task'] == t) & (trials['right'] == right) & (trials['is_catch'] == 0)]
+                if len(sel) == 0:
+                    continue
+                rts = sel['rt'][(sel['correct'] == 1) & ~np.isnan(sel['rt'])]
+                q1, med, q3 = np.percentile(rts, [25, 50, 75]) if len(rts) else (math.nan,)*3
+                lines.append(f'{task:6} {"R" if right else "L":4} {len(sel):5} {sel["correct"].mean()*100:7.0f} % '
+                             f'{med:8.0f} ms {q3 - q1:5.0f} {sel["halfRT"][-1]:7.0f}   {histogram(rts)}')
+        mep = r['mep'][~np.isnan(r['mep'])]
+        if len(mep):
+            lines += ['', f'MEPs: {len(mep)}, median {np.median(mep):.0f}, last {mep[-1]:.0f}']
+        isError, tmsError = np.abs(r['isError']), np.abs(r['tmsError'])
+        nanMax = lambda a: np.nanmax(a) if np.any(~np.isnan(a)) else math.nan
+        lines += ['', f'timing: IS error max {nanMax(isError):.1f} ms, TMS error max {nanMax(tmsError):.1f} ms, '
+                      f'{int((r["nFailures"] > 0).sum())} trials failed the quality checks']
+        return '\n'.join(lines)
+
+
+def histogram(values, low = 100, high = 1000, bins = 18):
+    """a one line histogram of values."""
+    if len(values) == 0:
+        return ''
+    counts = np.histogram(np.clip(values, low, high - 1e-9), bins = bins, range = (low, high))[0]
+    return ''.join(' .:-=+*#%@'[min(int(math.ceil(c/counts.max()*9)), 9)] for c in counts)
+
+
+def lowerPriority():
+    """makes the calling process nice and keeps it off the last core, where the trial loop runs."""
+    try:
+        if sys.platform == 'win32':
+            import ctypes
+            kernel32 = ctypes.windll.kernel32
+            kernel32.SetPriorityClass(kernel32.GetCurrentProcess(), 0x4000)   # BELOW_NORMAL_PRIORITY_CLASS
+        else:
+            os.nice(10)
+            cores = sorted(os.sched_getaffinity(0))
+            if len(cores) > 1:
+                os.sched_setaffinity(0, cores[:-1])
+    except (AttributeError, OSError):
+        pass
+
+
+def serveWeb(board, port = 8765, interval = 1.0):
+    """serves the dashboard as a page which reloads itself every interval s."""
+    from http.server import BaseHTTPRequestHandler, HTTPServer         # only the dashboard process needs it
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            text = board.update().replace('&', '&amp;').replace('<', '&lt;')
+            page = (f'<html><head><meta http-equiv="refresh" content="{interval}"><title>RT tasks</title></head>'
+                    f'<body style="background:#111;color:#ddd"><pre style="font-size:16px">{text}</pre></body></html>')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/html; charset=utf-8')
+            self.end_headers()
+            self.wfile.write(page.encode())
+
+        def log_message(self, *args):
+            pass
+
+    HTTPServer(('127.0.0.1', port), Handler).serve_forever()             # one request at a time, the board is not thread safe
+
+
+def _run(ringName, mode = 'terminal', port = 8765, interval = 1.0):
+    """the dashboard process."""
+    lowerPriority()
+    board = Dashboard(RecordRing(name = ringName))
+    if mode == 'web':
+        serveWeb(board, port, interval)
+    while True:
+        print('\033[H\033[J' + board.update(), flush = True)         # clear the terminal and draw again
+        time.sleep(interval)
+
+
+class Monitor:
+    """The experiment side: publishes trial records, and starts the dashboard process.
+
+    Args:
+        mode (_str_): 'terminal', 'web' or None for no dashboard process (the records are still kept).
+        port (_int_): port of the web page, http://127.0.0.1:port
+        capacity (_int_): number of records in the ring.
+    """
+
+    def __init__(self, mode = None, port = 8765, capacity = 4096):
+        self.mode, self.port = mode, port
+        self.ring = RecordRing(capacity)
+        self._process = None
+        if mode:
+            self._process = mp.get_context('spawn').Process(target = _run, args = (self.ring.name, mode, port),
+                                                            name = 'Dashboard', daemon = True)
+            startWithoutMain(self._process)
+        atexit.register(self.close)                                   # also on core.quit()
+
+    def publish(self, **fields):
+        """call between trials, e.g. publish(trialN = 3, task = 'UCRT', rt = 312, correct = True)."""
+        if 'task' in fields:
+            fields['task'] = taskNames.index(fields['task'])
+        self.ring.publish(**fields)
+
+    def render(self):
+        """the dashboard as text, rendered in this process."""
+        return Dashboard(self.ring).update()
+
+    def close(self):
+        if self._process is not None:
+            self._process.terminate()
+            self._process.join(1)
+            self._process = None
+        if self.ring is not None:
+            self.ring.close()
+            self.ring = None
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print('usage: python monitor.py <shared memory name> [web]')
+    else:
+        _run(sys.argv[1], sys.argv[2] if len(sys.argv) > 2 else 'terminal')
@@ -0,0 +1,301 @@
+"""
+Monte-Carlo simulation of the RT tasks protocol, for session length, TMS timing and power.
+
+RTtrials, catchRatio, trialsPerStimtimePerCondition, ITI, PCISI, breakInterval and the halfRT = RT/3 rule are
+picked by hand. Here thousands of sessions are simulated without running the experiment: every session gets
+the trial plan of its Subject ID (design.createPlan, the same plan as the real session) and a synthetic
+participant, whose RTs come from an ex-Gaussian per task (simulation.rtModels) with a speed of its own, and who
+misses, errs and responds to catch trials at given rates. The halfRT TMS time follows the running median per task
+and hand of the RTEstimator, the session clock follows runTrials: ITI, PC-IS interval, response or timeout,
+feedback, instructions at every task block and, as in runTrials, a break before every trial once breakInterval
+has passed since the start of the task block.
+
+Sessions are simulated in chunks of a fixed size, each chunk a numpy array computation over all its sessions at
+once, in parallel over a process pool. Every chunk has its own generator spawned from the seed, so the results
+only depend on the seed and not on the number of processes.
+
+Reported: the session duration and number of breaks, the TMS time relative to the response, the number of usable
+trials per condition (correct, and the pulse at least minLead ms before the response), and the power to find an
+MEP difference of effect standard deviations between each stimulation time and the baseline stimulation time of
+the block, with a Welch t-test per session. The MAD outlier rule of the RTEstimator is left out.
+
+Run with:  python montecarlo.py [--sessions N] [--seed S] [--processes P] [--trials N] [--training N] [--effect d]
+The protocol is read from settings.py, the same settings the experiment runs with; --trials, --training,
+--baselines and --break-interval override them.
+
+Written for RT_tasks_v4.1.py
+"""
+import os, sys, time, math
+from statistics import NormalDist
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from design import createPlan
+from adaptive import RTEstimator
+from simulation import rtModels
+
+chunkSize = 250                                                       # sessions per chunk, fixed so results do not depend on the processes
+
+
+def protocolSpec(design, ITI = (4000, 5000), PCISI = (900, 900), maxRT = 1000, breakInterval = 10*60, enableBreaks = True,
+                 blBefore = 0, blAfter = 0, instructionTime = 20, breakTime = 60, feedbackTime = 0.5):
+    """returns a protocol: a design spec and the timing of the session.
+
+    Args:
+        design (_dict_): a design.designSpec.
+        ITI, PCISI (_tuple_): ranges of the fixation and the PC-IS interval in ms, as in runTrials.
+        maxRT (_float_): the time to respond after the IS in ms.
+        breakInterval (_float_): seconds between breaks.
+        enableBreaks (_bool_): breaks at all.
+        blBefore, blAfter (_int_): baseline measures before and after the tasks (5-8 s each).
+        instructionTime (_float_): seconds the instruction screens of a task block take.
+        breakTime (_float_): seconds a break takes.
+        feedbackTime (_float_): seconds the RT feedback is shown.
+    """
+    return {'design': design, 'ITI': tuple(ITI), 'PCISI': tuple(PCISI), 'maxRT': maxRT, 'breakInterval': breakInterval,
+            'enableBreaks': enableBreaks, 'blBefore': blBefore, 'blAfter': blAfter, 'instructionTime': instructionTime,
+            'breakTime': breakTime, 'feedbackTime': feedbackTime}
+
+
+def participantModel(rtModels = rtModels, betweenSD = 30, tauSD = 0.25, pError = 0.03, pFalseAlarm = 0.1, pMiss = 0.01,
+                     effect = 0.5, minLead = 0):
+    """returns the synthetic participants.
+
+    Args:
+        rtModels (_dict_): task: (mu, sigma, tau) of the ex-Gaussian RT in ms.
+        betweenSD (_float_): SD in ms of the speed of a participant, added to mu of every task.
+        tauSD (_float_): SD of the log of a participant's factor on tau.
+        pError, pFalseAlarm, pMiss (_float_): chances of the wrong key, a response to a catch trial and no response.
+        effect (_float_): the MEP difference between a stimulation time and the baseline time, in single trial SDs.
+        minLead (_float_): ms a pulse must come before the response for the trial to be usable.
+    """
+    return {'rtModels': dict(rtModels), 'betweenSD': betweenSD, 'tauSD': tauSD, 'pError': pError,
+            'pFalseAlarm': pFalseAlarm, 'pMiss': pMiss, 'effect': effect, 'minLead': minLead}
+
+
+def conditions(design):
+    """the (task, right, stimulation time) of every TMS condition, the baseline time first in every task x hand."""
+    return [(task, right, stim) for task in design['tasks'] for right in design['hands'][task]
+            for stim in [design['stimTime_BL']] + design['stimTimes'][task]]
+
+
+def planArrays(plans, tasks):
+    """turns plans of equal length into arrays: task index, right, stimulation label, TMS time (nan for none),
+    is_halfRT, is_catch and is_train, each (sessions, trials)."""
+    task = np.array([[tasks.index(t[0]) for t in plan] for plan in plans])
+    right = np.array([[t[1] for t in plan] for plan in plans], dtype = bool)
+    label = np.array([[str(t[2]) for t in plan] for plan in plans])
+    isHalf = label == 'halfRT'
+    tms = np.array([[math.nan if t[2] is None or t[2] == 'halfRT' else t[2] for t in plan] for plan in plans], dtype = float)
+    isCatch = np.array([[t[3] for t in plan] for plan in plans], dtype = bool)
+    isTrain = np.array([[t[4] for t in plan] for plan in plans], dtype = bool)
+    return task, right, label, tms, isHalf, isCatch, isTrain
+
+
+def runningMedian(rt, valid, window, default):
+    """the median of the last window valid RTs before every trial, row by row; default before the first.
+
+    Args:
+        rt (_ndarray_): (sessions, trials) RTs of one task x hand, in trial order.
+        valid (_ndarray_): which RTs are added to the estimate.
+    """
+    n, k = rt.shape
+    order = np.argsort(~valid, axis = 1, kind = 'stable')             # the valid RTs first, in trial order
+    packed = np.where(np.take_along_axis(valid, order, 1), np.take_along_axis(rt, order, 1), np.nan)
+    padded = np.concatenate([np.full((n, window), np.nan), packed], axis = 1)
+    windows = np.lib.stride_tricks.sliding_window_view(padded, window, axis = 1)[:, :k + 1]   # window c: the valid RTs c-window..c-1
+    counts = np.sum(~np.isnan(windows), axis = 2)
+    medians = np.where(counts > 0, _nanMedian(np.where(np.isnan(windows), np.inf, windows), counts), default)
+    before = np.cumsum(valid, axis = 1) - valid                       # valid RTs before every trial
+    return np.take_along_axis(medians, before, 1)
+
+
+def _nanMedian(values, counts):
+    """the median of the first counts of the sorted values of every window, the nans sorted last as inf."""
+    ordered = np.sort(values, axis = -1)
+    low = np.take_along_axis(ordered, np.maximum((counts - 1)//2, 0)[..., None], -1)[..., 0]
+    high = np.take_along_axis(ordered, np.maximum(counts//2, 0)[..., None], -1)[..., 0]
+    return (low + high)/2
+
+
+def tCritical(df, alpha = 0.05):
+    """two sided critical t for df degrees of freedom, by the Cornish-Fisher expansion (Abramowitz & Stegun 26.7.5)."""
+    z = NormalDist().inv_cdf(1 - alpha/2)
+    g = [(z**3 + z)/4, (5*z**5 + 16*z**3 + 3*z)/96, (3*z**7 + 19*z**5 + 17*z**3 - 15*z)/384,
+         (79*z**9 + 776*z**7 + 1482*z**5 - 1920*z**3 - 945*z)/92160]
+    return z + sum(gi/df**(i + 1) for i, gi in enumerate(g))
+
+
+def welch(y, a, b, alpha = 0.05):
+    """Welch t-test of the values of y in mask a against those in mask b, row by row. Returns significant
+    (nan where a group has fewer than 2 values)."""
+    na, nb = a.sum(1), b.sum(1)
+    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+        ma, mb = (y*a).sum(1)/na, (y*b).sum(1)/nb
+        va = (((y - ma[:, None])**2)*a).sum(1)/(na - 1)
+        vb = (((y - mb[:, None])**2)*b).sum(1)/(nb - 1)
+        se2 = va/na + vb/nb
+        t = (ma - mb)/np.sqrt(se2)
+        df = se2**2/((va/na)**2/(na - 1) + (vb/nb)**2/(nb - 1))
+        significant = (np.abs(t) > tCritical(np.maximum(df, 1), alpha)).astype(float)
+    return np.where((na >= 2) & (nb >= 2), significant, np.nan)
+
+
+############ one chunk of sessions ############
+def simulateChunk(protocol, participant, subjects, seed):
+    """simulates the sessions of subjects (their Subject IDs seed the plans). Returns a dict of arrays."""
+    design = protocol['design']
+    tasks = design['tasks']
+    plans = [createPlan(design, s) for s in subjects]
+    task, right, label, tms, isHalf, isCatch, isTrain = planArrays(plans, tasks)
+    rng = np.random.default_rng(seed)
+    n, T = task.shape
+    p = participant
+    maxRT = protocol['maxRT']
+
+    # the participants and their responses
+    models = np.array([p['rtModels'][t] for t in tasks], dtype = float)   # (tasks, 3)
+    speed = rng.normal(0, p['betweenSD'], (n, 1))
+    tauScale = np.exp(rng.normal(0, p['tauSD'], (n, 1)))
+    mu, sigma, tau = (models[task, i] for i in range(3))
+    rt = np.maximum(rng.normal(mu + speed, sigma) + rng.exponential(1.0, (n, T))*tau*tauScale, 80.0)
+    respond = np.where(isCatch, rng.random((n, T)) < p['pFalseAlarm'], rng.random((n, T)) >= p['pMiss'])
+    responded = respond & (rt <= maxRT)                               # later than maxRT is a timeout
+    error = rng.random((n, T)) < p['pError']
+    correct = np.where(isCatch, ~responded, responded & ~error)
+    rt = np.where(responded, np.floor(rt), np.nan)
+
+    # the halfRT TMS times, from the running RT estimate per task and hand
+    estimator = RTEstimator(maxRT = maxRT)
+    valid = correct & ~isCatch & (rt >= estimator.minRT) & (rt <= estimator.maxRT)
+    estimate = np.full((n, T), np.nan)
+    for t in range(len(tasks)):
+        for hand in (False, True):
+            group = (task == t) & (right == hand)
+            k = int(group[0].sum())
+            if k == 0:
+                continue
+            cols = np.argsort(~group, axis = 1, kind = 'stable')[:, :k]   # the trials of the group, in order
+            medians = runningMedian(np.take_along_axis(rt, cols, 1), np.take_along_axis(valid, cols, 1),
+                                    estimator.windowSize, estimator.defaultRT)
+            np.put_along_axis(estimate, cols, medians, 1)
+    tms = np.where(isHalf, estimator.fraction*estimate, tms)
+    sent = ~np.isnan(tms) & np.where(responded, tms < rt, tms < maxRT)   # the trial ends at the response
+    offset = np.where(sent & responded, tms - rt, np.nan)              # negative: before the response
+
+    # the session clock
+    fix = rng.uniform(*protocol['ITI'], (n, T))
+    inter = rng.uniform(*protocol['PCISI'], (n, T))
+    trialTime = (fix + inter + np.where(responded, rt, maxRT))/1000 + protocol['feedbackTime']
+    newBlock = np.c_[np.ones((n, 1), bool), task[:, 1:] != task[:, :-1]]
+    baselineTime = lambda k: rng.integers(5, 9, (n, k)).sum(1) + (protocol['instructionTime']/2 if k else 0)
+    now = baselineTime(protocol['blBefore']).astype(float)
+    lastBreak = now.copy()
+    breaks = np.zeros(n, dtype = np.int64)
+    for j in range(T):
+        if protocol['enableBreaks']:
+            due = now > lastBreak + protocol['breakInterval']
+            now += due*protocol['breakTime']                          # runTrials only resets lastBreak at a new block
+            breaks += due
+        now += newBlock[:, j]*protocol['instructionTime']
+        lastBreak = np.where(newBlock[:, j], now, lastBreak)
+        now += trialTime[:, j]
+    now += baselineTime(protocol['blAfter'])
+
+    # usable trials and power per condition
+    usable = correct & ~isTrain & ~isCatch & sent & ~(tms > np.nan_to_num(rt, nan = np.inf) - p['minLead'])
+    conds = conditions(design)
+    counts = np.zeros((n, len(conds)), dtype = np.int64)
+    significant = np.full((n, len(conds)), np.nan)
+    mep = rng.normal(0, 1, (n, T)) + p['effect']*(label != str(design['stimTime_BL']))
+    for c, (t, hand, stim) in enumerate(conds):
+        inCond = (task == tasks.index(t)) & (right == hand) & (label == str(stim)) & usable
+        counts[:, c] = inCond.sum(1)
+        if stim != design['stimTime_BL']:
+            baseline = (task == tasks.index(t)) & (right == hand) & (label == str(design['stimTime_BL'])) & usable
+            significant[:, c] = welch(mep, inCond, baseline)
+    experiment = ~isTrain & ~isCatch
+    return {'duration': now, 'breaks': breaks, 'counts': counts, 'significant': significant,
+            'offset': offset[experiment & sent & responded], 'offsetLabel': label[experiment & sent & responded],
+            'ratio': (tms/rt)[experiment & isHalf & sent & responded],
+            'nTMS': np.array([np.sum(experiment & ~np.isnan(tms) & (label == str(s))) for s in _labels(design)]),
+            'nSent': np.array([np.sum(experiment & sent & (label == str(s))) for s in _labels(design)]),
+            'nLate': np.array([np.sum(experiment & ~np.isnan(tms) & ~sent & (label == str(s))) for s in _labels(design)])}
+
+
+def _labels(design):
+    """the stimulation time labels of a design, baseline first."""
+    labels = [str(design['stimTime_BL'])]
+    for task in design['tasks']:
+        labels += [str(s) for s in design['stimTimes'][task] if str(s) not in labels]
+    return labels
+
+
+############ many sessions ############
+def simulateSessions(protocol, participant, nSessions = 1000, seed = 0, processes = None, firstSubject = 0):
+    """simulates nSessions sessions, Subject IDs firstSubject on, in parallel when processes > 1. Returns the
+    results of all chunks joined."""
+    subjects = np.arange(firstSubject, firstSubject + nSessions)
+    chunks = [subjects[i:i + chunkSize].tolist() for i in range(0, nSessions, chunkSize)]
+    seeds = np.random.SeedSequence(int(seed)).spawn(len(chunks))
+    args = [(protocol, participant, chunk, s) for chunk, s in zip(chunks, seeds)]
+    if processes is None or processes <= 1 or len(args) < 2:
+        parts = [simulateChunk(*a) for a in args]
+    else:
+        with ProcessPoolExecutor(min(processes, len(args))) as pool:
+            parts = list(pool.map(simulateChunk, *zip(*args)))
+    joined = {k: np.concatenate([p[k] for p in parts]) for k in parts[0] if k not in ('nTMS', 'nSent', 'nLate')}
+    for k in ('nTMS', 'nSent', 'nLate'):
+        joined[k] = sum(p[k] for p in parts)
+    joined['conditions'] = conditions(protocol['design'])
+    joined['labels'] = _labels(protocol['design'])
+    return joined
+
+
+def report(results):
+    """the results as text."""
+    r = results
+    n = len(r['duration'])
+    minutes = r['duration']/60
+    q = lambda a, qs = (5, 50, 95): ' / '.join(f'{v:.0f}' for v in np.percentile(a, qs)) if len(a) else '-'
+    breakCounts = np.bincount(r['breaks'])
+    lines = [f'# {n} simulated sessions',
+             f'Duration: mean {minutes.mean():.1f} min, SD {minutes.std():.1f}, 5th / 95th percentile {np.percentile(minutes, 5):.1f} / {np.percentile(minutes, 95):.1f} min',
+             f'Breaks: mean {r["breaks"].mean():.2f}, ' + ', '.join(f'{k}: {c/n*100:.0f} %' for k, c in enumerate(breakCounts) if c),
+             '', f'{"TMS time":10} {"pulses":>8} {"sent":>7} {"response first":>15}   pulse - response 5th / 50th / 95th percentile (ms)']
+    for i, label in enumerate(r['labels']):
+        if r['nTMS'][i] == 0:
+            continue
+        offsets = r['offset'][r['offsetLabel'] == label]
+        lines.append(f'{label:10} {r["nTMS"][i]:8} {r["nSent"][i]/r["nTMS"][i]*100:6.1f}% {r["nLate"][i]/r["nTMS"][i]*100:14.1f}%   {q(offsets)}')
+    if len(r['ratio']):
+        lines.append(f'halfRT pulses at {" / ".join(f"{v:.2f}" for v in np.percentile(r["ratio"], (5, 50, 95)))} of the RT (5th / 50th / 95th percentile)')
+    lines += ['', f'{"task":6} {"hand":4} {"TMS time":9} {"usable trials: mean":>20} {"5th pct":>8} {"min":>5} {"power":>7}']
+    for c, (task, right, stim) in enumerate(r['conditions']):
+        counts, sig = r['counts'][:, c], r['significant'][:, c]
+        if str(stim) == r['labels'][0]:
+            power = f'{"-":>7}'                                       # the baseline time the others are tested against
+        else:
+            power = f'{np.nanmean(sig)*100:6.1f}%' if np.any(~np.isnan(sig)) else f'{"n < 2":>7}'
+        lines.append(f'{task:6} {"R" if right else "L":4} {str(stim):9} {counts.mean():20.1f} {np.percentile(counts, 5):8.0f} {counts.min():5} {power}')
+    lines.append('power: sessions in which a Welch t-test finds the MEP difference to the baseline time (p < 0.05)')
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    from design import designSpec
+    from simulation import argValue
+    import settings as S                                              # the settings of RT_tasks_v4.1.py, --trials etc. override them
+    design = designSpec(S.tasks, S.stimTimes, S.stimTime_BL, argValue(sys.argv, '--training', S.RTtrials), S.catchRatio,
+                        argValue(sys.argv, '--trials', S.trialsPerStimtimePerCondition),
+                        argValue(sys.argv, '--baselines', S.baselinesPerCondition), maxRun = S.maxRun)
+    protocol = protocolSpec(design, S.ITI, S.PCISI, S.maxRT, argValue(sys.argv, '--break-interval', S.breakInterval),
+                            S.enableBreaks, S.bl_before, S.bl_after, feedbackTime = S.feedbackTime)
+    participant = participantModel(effect = argValue(sys.argv, '--effect', 0.5))
+    start = time.perf_counter()
+    nSessions = argValue(sys.argv, '--sessions', 2000)
+    results = simulateSessions(protocol, participant, nSessions, argValue(sys.argv, '--seed', 0),
+                               argValue(sys.argv, '--processes', os.cpu_count()))
+    print(report(results))
+    print(f'# {nSessions} sessions in {time.perf_counter() - start:.1f} s')
@@ -0,0 +1,57 @@
+"""
+Per-trial timing quality checks for the RT tasks.
+
+A trial whose IS came late, whose TMS pulse went off its target, whose markers were held back or which dropped
+frames does not count: QualityCheck compares the timing row the TimingLog made of the trial with the tolerances
+and names what missed. runTrials writes the names in the 'quality' column and puts a replacement trial of the
+same condition later in the same task block (see design.requeue), so every condition still gets its quota.
+
+Written for RT_tasks_v4.1.py
+"""
+import math
+
+defaultTolerances = {'IS': 5, 'TMS': 2, 'marker': 2, 'droppedFrames': None}   # ms, and frames for droppedFrames
+
+
+class QualityCheck:
+    """Tolerances a trial must meet to count.
+
+    The IS is checked against the cue and the TMS pulse against the IS, as those intervals are what the tasks
+    depend on: a frame dropped during the fixation only makes the random fixation a frame longer.
+
+    Args:
+        tolerances (_dict_): any of 'IS' (ms the cue-IS interval may be off), 'TMS' (ms the pulse may be off its
+            time relative to the IS), 'marker' (ms the first marker of a burst may wait for the port; the markers
+            sent while the port is busy wait for it by design) and 'droppedFrames' (frames dropped anywhere in the
+            trial). Missing keys take the defaults, None switches a check off.
+    """
+
+    def __init__(self, tolerances = None):
+        self.tolerances = dict(defaultTolerances, **(tolerances or {}))
+        self.failed = {}                                              # check: number of trials which failed it
+
+    @staticmethod
+    def errors(row):
+        """returns the IS error (against the cue) and TMS error (against the IS) of a TimingLog row, in ms."""
+        return tuple((row[f'{event}_actual'] - row[f'{reference}_actual'])
+                     - (row[f'{event}_scheduled'] - row[f'{reference}_scheduled'])
+                     for event, reference in (('IS', 'cue'), ('TMS', 'IS')))
+
+    def check(self, row):
+        """returns what the trial with this TimingLog row missed, an empty list if nothing."""
+        failures = []
+        tol = self.tolerances
+        for event, error in zip(('IS', 'TMS'), self.errors(row)):
+            if tol[event] is not None and not math.isnan(error) and abs(error) > tol[event]:
+                failures.append((event, f'{event} {error:+.1f} ms'))
+        if tol['marker'] is not None and row['markerLatencyMax'] > tol['marker']:
+            failures.append(('marker', f'marker {row["markerLatencyMax"]:.1f} ms late'))
+        if tol['droppedFrames'] is not None and row['droppedFrames'] > tol['droppedFrames']:
+            failures.append(('droppedFrames', f'{row["droppedFrames"]} dropped frames'))
+        for check, text in failures:
+            self.failed[check] = self.failed.get(check, 0) + 1
+        return [text for check, text in failures]
+
+    def report(self, nTrials, nRequeued):
+        failed = ', '.join(f'{n} {check}' for check, n in self.failed.items()) or 'none'
+        return f'# Quality: {nRequeued} of {nTrials} trials re-queued. Failed checks: {failed}'
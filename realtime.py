@@ -0,0 +1,147 @@
+"""
+Real-time execution mode for the RT tasks.
+
+The garbage collector, the OS scheduler and first-call costs used to land inside trialRT1 at random. The
+RealtimeMode keeps them out of the trials:
+- the garbage collector is off while a trial runs, and collects the young generations right after it, before the
+  next fixation; a full collection runs between task blocks, and everything which exists after the warm-up is
+  frozen out of the collections,
+- the main thread gets high priority: SCHED_RR or else a lower nice value, which on Linux both apply to the calling
+  thread only; on Windows the whole process gets HIGH_PRIORITY_CLASS. The threads started before (the marker
+  worker raises its own priority, see markers.raiseThreadPriority; TMS clear, flusher) keep theirs,
+- on Linux the main thread is pinned to one core (the marker, TMS and flusher threads keep the others),
+- warmUp runs every stimulus, trigger and code path once before the first real trial.
+Each measure is tried and report() says which took effect, as most need permissions a lab PC may not give.
+
+Written for RT_tasks_v4.1.py
+"""
+import os, sys, gc, time
+
+
+class RealtimeMode:
+    """Real-time measures around the trials.
+
+    Args:
+        gcControl (_bool_): disable the garbage collector during trials and collect in between.
+        priority (_bool_): raise the priority of the main thread (of the process on Windows).
+        cpu (_int_): the core to pin the main thread to, -1 for the last one, None to not pin.
+        collectGeneration (_int_): the generations collected after every trial (0-2).
+        enabled (_bool_): False makes every method do nothing, to compare with and without.
+    """
+
+    def __init__(self, gcControl = True, priority = True, cpu = -1, collectGeneration = 1, enabled = True):
+        self.gcControl, self.priority, self.cpu = gcControl, priority, cpu
+        self.collectGeneration = collectGeneration
+        self.enabled = enabled
+        self.effects = {}                                             # measure: what happened
+        self.collections = []                                         # duration of every collection between trials, in s
+        self.warmUps = {}                                             # step: (first call, later calls) in s
+        self._restore = []                                            # functions undoing the measures
+
+    ############ session ############
+    def start(self):
+        if not self.enabled:
+            self.effects['realtime'] = 'disabled'
+            return self
+        if self.priority:
+            self.effects['priority'] = self._raisePriority()
+        if self.cpu is not None:
+            self.effects['affinity'] = self._pin()
+        if self.gcControl:
+            self.effects['gc'] = f'off during trials, generation {self.collectGeneration} collected after each'
+        return self
+
+    def _raisePriority(self):
+        if sys.platform == 'win32':
+            try:
+                import ctypes
+                kernel32 = ctypes.windll.kernel32
+                process = kernel32.GetCurrentProcess()
+                old = kernel32.GetPriorityClass(process)
+                if kernel32.SetPriorityClass(process, 0x80):          # HIGH_PRIORITY_CLASS
+                    self._restore.append(lambda: kernel32.SetPriorityClass(process, old))
+                    return 'HIGH_PRIORITY_CLASS'
+            except (AttributeError, OSError):
+                pass
+            return 'not permitted'
+        try:
+            old = os.sched_getscheduler(0), os.sched_getparam(0)
+            os.sched_setscheduler(0, os.SCHED_RR, os.sched_param(os.sched_get_priority_min(os.SCHED_RR)))
+            self._restore.append(lambda: os.sched_setscheduler(0, old[0], old[1]))
+            return 'SCHED_RR (main thread)'                              # on Linux pid 0 is the calling thread
+        except (AttributeError, OSError):
+            pass
+        try:
+            old = os.getpriority(os.PRIO_PROCESS, 0)
+            os.setpriority(os.PRIO_PROCESS, 0, old - 10)
+            self._restore.append(lambda: os.setpriority(os.PRIO_PROCESS, 0, old))
+            return f'nice {old} -> {old - 10}' + (' (main thread)' if sys.platform.startswith('linux') else '')
+        except (AttributeError, OSError):
+            return 'not permitted'
+
+    def _pin(self):
+        try:
+            old = os.sched_getaffinity(0)
+            cpu = sorted(old)[self.cpu] if self.cpu < 0 else self.cpu
+            if len(old) < 2:
+                return 'one core only, not pinned'
+            os.sched_setaffinity(0, {cpu})                            # pid 0 is the calling thread on Linux
+            self._restore.append(lambda: os.sched_setaffinity(0, old))
+            return f'main thread on core {cpu}'
+        except (AttributeError, OSError, IndexError):
+            return 'not available'
+
+    def warmUp(self, steps, repeats = 3):
+        """runs every step (name: function) repeats times before the first trial, then freezes what exists."""
+        if not self.enabled:
+            return
+        for name, step in steps.items():
+            times = []
+            for i in range(repeats):
+                start = time.perf_counter()
+                step()
+                times.append(time.perf_counter() - start)
+            self.warmUps[name] = (times[0], min(times[1:], default = times[0]))
+        if self.gcControl:
+            gc.collect()
+            gc.freeze()                                               # the stimuli, modules etc. are never collected
+        self.effects['warm-up'] = f'{len(steps)} steps, first calls {sum(t[0] for t in self.warmUps.values())*1000:.1f} ms in total'
+
+    def stop(self):
+        """undoes every measure."""
+        if self.enabled and self.gcControl:
+            gc.unfreeze()
+            gc.enable()
+        while self._restore:
+            try:
+                self._restore.pop()()
+            except OSError:
+                pass
+
+    ############ trials ############
+    def trialStart(self):
+        """call right before a trial."""
+        if self.enabled and self.gcControl:
+            gc.disable()
+
+    def trialEnd(self, generation = None):
+        """call right after a trial, collects the garbage of the trial."""
+        if self.enabled and self.gcControl:
+            start = time.perf_counter()
+            gc.collect(self.collectGeneration if generation is None else generation)
+            self.collections.append(time.perf_counter() - start)
+            gc.enable()
+
+    def collect(self):
+        """a full collection, e.g. between blocks."""
+        self.trialEnd(2)
+
+    ############ reports ############
+    def report(self):
+        lines = [f'#   {measure}: {effect}' for measure, effect in self.effects.items()]
+        if self.collections:
+            lines.append(f'#   {len(self.collections)} collections between trials, mean {sum(self.collections)/len(self.collections)*1000:.2f} ms, max {max(self.collections)*1000:.2f} ms')
+        slowest = sorted(self.warmUps.items(), key = lambda w: -w[1][0])[:3]
+        if slowest:
+            lines.append('#   slowest first calls: ' + ', '.join(f'{name} {first*1000:.1f} ms (then {later*1000:.2f} ms)' for name, (first, later) in slowest))
+        return '# Real-time mode:\n' + '\n'.join(lines)
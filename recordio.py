@@ -0,0 +1,180 @@
+"""
+Buffered, crash-safe output for the RT tasks.
+
+During a trial nothing may touch the disk. A RecordBuffer stands in for a file (and for sys.stdout and
+csv.writer): writes are appended to a preallocated in-memory ring buffer and only reach the file when the buffer
+is synced. A Flusher syncs all buffers on a background thread while no trial is running, and right away when a
+trial has ended, with fsync so a finished trial survives a crash of the PC.
+
+Written for RT_tasks_v4.1.py
+"""
+import os, io, csv, time, atexit, threading
+
+
+class RingBuffer:
+    """A fixed set of slots written round robin. If the reader falls behind it doubles in size, it never drops
+    records."""
+
+    def __init__(self, capacity = 4096):
+        self._slots = [None]*capacity
+        self._head = 0                                                # next slot to write
+        self._size = 0
+        self._lock = threading.Lock()
+        self.grown = 0                                                # number of times the buffer had to grow
+
+    def append(self, item):
+        with self._lock:
+            capacity = len(self._slots)
+            if self._size == capacity:
+                self._grow()
+                capacity = len(self._slots)
+            self._slots[self._head] = item
+            self._head = (self._head + 1) % capacity
+            self._size += 1
+
+    def _grow(self):
+        items = self._ordered()
+        self._slots = items + [None]*len(items)
+        self._head = len(items)
+        self.grown += 1
+
+    def _ordered(self):
+        capacity = len(self._slots)
+        tail = (self._head - self._size) % capacity
+        return [self._slots[(tail + i) % capacity] for i in range(self._size)]
+
+    def drain(self):
+        """returns and removes every item, oldest first."""
+        with self._lock:
+            items = self._ordered()
+            self._size = 0
+            return items
+
+    def __len__(self):
+        return self._size
+
+
+class RecordBuffer:
+    """A file written through a RingBuffer.
+
+    write(text) and writerow(row) only append to memory, flush() does nothing so it can replace sys.stdout.
+    sync() writes everything pending to the file.
+
+    Args:
+        path (_str_): the file to write.
+        mode (_str_): 'w' or 'a'.
+        delimiter (_str_): delimiter of rows written with writerow.
+        fsyncEvery (_float_): seconds between fsyncs. 0 fsyncs on every sync that wrote something.
+        capacity (_int_): initial number of slots of the ring buffer.
+    """
+
+    def __init__(self, path, mode = 'w', delimiter = ';', fsyncEvery = 0, capacity = 4096):
+        self.path = path
+        self.file = open(path, mode, newline = '' if delimiter else None)
+        self.delimiter = delimiter
+        self.fsyncEvery = fsyncEvery
+        self.ring = RingBuffer(capacity)
+        self.closed = False
+        self._lastFsync = time.perf_counter()
+        self._lock = threading.Lock()                                 # one sync at a time
+        self._text = io.StringIO()
+        self._csv = csv.writer(self._text, delimiter = delimiter) if delimiter else None
+
+    ############ called from the experiment, memory only ############
+    def write(self, text):
+        self.ring.append(text)
+        return len(text)
+
+    def writerow(self, row):
+        self.ring.append(list(row))                                   # a copy, the caller may reuse the list
+
+    def flush(self):
+        pass
+
+    ############ disk ############
+    def sync(self, fsync = None):
+        """writes pending records to the file. fsyncs if asked, or when fsyncEvery has passed."""
+        with self._lock:
+            if self.closed:
+                return 0
+            items = self.ring.drain()
+            if items:
+                for item in items:
+                    if isinstance(item, str):
+                        self._text.write(item)
+                    else:
+                        self._csv.writerow(item)
+                self.file.write(self._text.getvalue())
+                self._text.seek(0)
+                self._text.truncate()
+                self.file.flush()
+            now = time.perf_counter()
+            if fsync is None:
+                fsync = bool(items) and now - self._lastFsync >= self.fsyncEvery
+            if fsync:
+                os.fsync(self.file.fileno())
+                self._lastFsync = now
+            return len(items)
+
+    def size(self):
+        """the length of the file in bytes, as far as it has been synced."""
+        with self._lock:
+            return os.fstat(self.file.fileno()).st_size
+
+    def close(self):
+        self.sync(fsync = True)
+        with self._lock:
+            if not self.closed:
+                self.file.close()
+                self.closed = True
+
+
+class Flusher:
+    """Syncs RecordBuffers on a background thread, but never while a trial is running.
+
+    Args:
+        buffers (_list_): the RecordBuffers to sync.
+        interval (_float_): seconds between background syncs.
+    """
+
+    def __init__(self, buffers, interval = 0.5):
+        self.buffers = list(buffers)
+        self.interval = interval
+        self._idle = threading.Event()
+        self._idle.set()
+        self._lock = threading.Lock()                                 # held while syncing
+        self._running = True
+        self._thread = threading.Thread(target = self._run, name = 'Flusher', daemon = True)
+        self._thread.start()
+        atexit.register(self.stop)                                    # also on core.quit()
+
+    def _run(self):
+        while self._running:
+            self._idle.wait()
+            with self._lock:
+                if self._idle.is_set():
+                    self._syncAll()
+            time.sleep(self.interval)
+
+    def _syncAll(self, fsync = None):
+        for b in self.buffers:
+            b.sync(fsync)
+
+    def pause(self):
+        """call before a trial. Waits for a running sync to finish, then keeps the disk quiet."""
+        with self._lock:
+            self._idle.clear()
+
+    def resume(self, syncNow = True):
+        """call after a trial. Syncs right away in the calling thread, so the trial is on disk before the next."""
+        if syncNow:
+            with self._lock:
+                self._syncAll()
+        self._idle.set()
+
+    def stop(self):
+        """syncs and fsyncs everything and stops the thread."""
+        self._running = False
+        self._idle.set()
+        with self._lock:
+            self._syncAll(fsync = True)
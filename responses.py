@@ -0,0 +1,173 @@
+"""
+Response collection for the RT tasks.
+
+Key presses are timestamped when they happen, not when the trial loop gets around to asking for them. The
+KeyboardBackend uses psychopy.hardware.keyboard, which on the lab PC reads psychtoolbox keyboard queues with
+per-event timestamps. A ResponseCollector drains the backend on its own thread and keeps every event, so the
+trial loop only asks for "responses since t" and RT accuracy no longer depends on loop speed.
+
+Backends: KeyboardBackend (psychtoolbox queues, thread safe, raises ImportError without psychtoolbox), EventBackend
+(psychopy.event, polled from the calling thread) and ScriptedBackend (key presses at given times, for testing and
+simulation).
+
+Written for RT_tasks_v4.1.py
+"""
+import time, threading
+from collections import namedtuple
+
+KeyEvent = namedtuple('KeyEvent', ['key', 't', 'recorded'])         # key name, time of the press and time it was collected
+
+
+class KeyboardBackend:
+    """psychtoolbox keyboard queue. The timestamps come from the key events, not from polling.
+
+    Without psychtoolbox psychopy.hardware.keyboard silently falls back to psychopy.event, which is neither
+    timestamped per event nor safe off the window thread, so then this raises ImportError: use the EventBackend.
+    """
+    name = 'keyboard'
+
+    def __init__(self, clock):
+        from psychopy.hardware import keyboard
+        self.kb = keyboard.Keyboard(clock = clock)
+        backend = getattr(self.kb, '_backend', None) or ('ptb' if getattr(keyboard, 'havePTB', False) else 'event')
+        if backend != 'ptb':
+            raise ImportError(f'psychopy.hardware.keyboard uses its {backend} backend, psychtoolbox is not available')
+        self.threadSafe = True                                        # psychtoolbox queues can be drained from any thread
+        self.clock = clock
+
+    def poll(self):
+        now = self.clock.getTime()
+        return [KeyEvent(k.name, k.rt, now) for k in self.kb.getKeys(waitRelease = False, clear = True)]
+
+    def clear(self):
+        self.kb.clearEvents()
+
+
+class EventBackend:
+    """psychopy.event, for setups without psychtoolbox. Only timestamps on polling, and must be polled from
+    the thread which owns the window."""
+    name = 'event'
+    threadSafe = False
+
+    def __init__(self, clock):
+        from psychopy import event
+        self.event = event
+        self.clock = clock
+
+    def poll(self):
+        now = self.clock.getTime()
+        return [KeyEvent(key, t, now) for key, t in self.event.getKeys(timeStamped = self.clock)]
+
+    def clear(self):
+        self.event.clearEvents()
+
+
+class ScriptedBackend:
+    """Key presses at scheduled times, for testing without a keyboard.
+
+    Args:
+        clock (_object_): anything with getTime().
+        waitKeys (_list_): keys which are pressed right away when the collector waits for them (e.g. the continue key).
+    """
+    name = 'scripted'
+    threadSafe = True
+
+    def __init__(self, clock, waitKeys = ()):
+        self.clock = clock
+        self.waitKeys = list(waitKeys)
+        self._script = []                                             # (time, key) not yet released, sorted
+        self._lock = threading.Lock()
+
+    def press(self, key, t = None):
+        """schedules a key press at time t on the clock, now if t is None."""
+        with self._lock:
+            self._script.append((self.clock.getTime() if t is None else t, key))
+            self._script.sort()
+
+    def respondToWait(self, keys):
+        for key in self.waitKeys:
+            if key in keys:
+                self.press(key)
+                return
+
+    def poll(self):
+        now = self.clock.getTime()
+        with self._lock:
+            n = 0
+            while n < len(self._script) and self._script[n][0] <= now:
+                n += 1
+            due, self._script = self._script[:n], self._script[n:]
+        return [KeyEvent(key, t, now) for t, key in due]
+
+    def clear(self):
+        with self._lock:
+            self._script = []
+
+
+class ResponseCollector:
+    """Collects timestamped key presses from a backend.
+
+    Args:
+        backend (_object_): one of the backends above.
+        pollInterval (_float_): how often the collector thread drains the backend, in s.
+        threaded (_bool_): drain on a thread of its own. Defaults to backend.threadSafe.
+    """
+
+    def __init__(self, backend, pollInterval = 0.0005, threaded = None):
+        self.backend = backend
+        self.pollInterval = pollInterval
+        self.threaded = backend.threadSafe if threaded is None else threaded
+        self.events = []                                              # every KeyEvent, in order of arrival
+        self._lock = threading.Lock()
+        self._running = self.threaded
+        if self.threaded:
+            self._thread = threading.Thread(target = self._run, name = 'ResponseCollector', daemon = True)
+            self._thread.start()
+
+    def _run(self):
+        while self._running:
+            self._collect()
+            time.sleep(self.pollInterval)
+
+    def _collect(self):
+        new = self.backend.poll()
+        if new:
+            with self._lock:
+                self.events.extend(new)
+
+    def responsesSince(self, t, keys = None):
+        """returns the key presses at or after time t, optionally only those in keys. Never blocks."""
+        if not self.threaded:
+            self._collect()
+        with self._lock:
+            n = len(self.events)
+            i = n
+            while i > 0 and self.events[i-1].t >= t:                 # new events are at the end
+                i -= 1
+            found = self.events[i:n]
+        return [e for e in found if keys is None or e.key in keys]
+
+    def escapePressed(self, since = float('-inf')):
+        return len(self.responsesSince(since, ['escape'])) > 0
+
+    def waitFor(self, keys, clock):
+        """blocks until one of keys is pressed and returns its KeyEvent. Only for instructions and breaks."""
+        since = clock.getTime()
+        if hasattr(self.backend, 'respondToWait'):
+            self.backend.respondToWait(keys)
+        while True:
+            found = self.responsesSince(since, keys)
+            if found:
+                return found[0]
+            time.sleep(0.001)
+
+    def clear(self):
+        """drops all events collected so far."""
+        self.backend.clear()
+        with self._lock:
+            self.events = []
+
+    def close(self):
+        self._running = False
+        if self.threaded:
+            self._thread.join(timeout = 1.0)
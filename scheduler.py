@@ -0,0 +1,103 @@
+"""
+Frame-locked trial scheduling for the RT tasks.
+
+A trial is turned into a timeline of frame indices before it starts. Visual events (fixation, preparatory cue,
+imperative signal/catch X, timeout) are snapped to the nearest screen refresh, while the TMS pulse keeps a
+sub-frame offset relative to the flip of the frame it falls in. The trial loop then only counts flips, so
+stimulus onsets and the TMS pulse no longer depend on how long the previous loop pass took.
+
+Written for RT_tasks_v4.1.py
+"""
+import math
+
+
+def measureFrameDur(win, fallback = 1/60):
+    """returns the duration of one screen refresh in s, as measured by the window.
+
+    Args:
+        win (_visual.Window_): the window the stimuli are drawn in.
+        fallback (_float_): used if the frame rate could not be measured.
+
+    Returns:
+        _float_: duration of one frame in s.
+    """
+    frameRate = win.getActualFrameRate(nIdentical = 10, nMaxFrames = 120, nWarmUpFrames = 10)
+    if frameRate is None or frameRate <= 0:
+        return fallback
+    return 1.0/round(frameRate)                                       # refresh rates are integers, the measurement is not
+
+
+class TrialTimeline:
+    """The precomputed timeline of one trial. Times are in s relative to the first flip of the trial."""
+
+    def __init__(self, frameDur):
+        self.frameDur = frameDur
+        self.events = {}                                              # name: [frame, offset, scheduled, achieved]
+        self.nFrames = 0
+
+    def add(self, name, t, subFrame = False, minFrame = 0):
+        """schedules an event at time t. Visual events are snapped to the nearest frame, sub-frame events keep
+        their offset relative to the flip of the frame they fall in. Returns the frame index of the event."""
+        if subFrame:
+            frame = int(math.floor(t/self.frameDur + 1e-9))
+            offset = t - frame*self.frameDur
+            offset = 0.0 if offset < 1e-9 else offset                 # float noise when t is a whole number of frames
+        else:
+            frame = int(round(t/self.frameDur))
+            offset = 0.0
+        if frame < minFrame:
+            frame, offset = minFrame, 0.0
+        self.events[name] = [frame, offset, frame*self.frameDur + offset, math.nan]
+        self.nFrames = max(self.nFrames, frame + 1)
+        return frame
+
+    def frame(self, name):
+        return self.events[name][0] if name in self.events else None
+
+    def offset(self, name):
+        return self.events[name][1]
+
+    def scheduled(self, name):
+        return self.events[name][2]
+
+    def achieved(self, name):
+        return self.events[name][3]
+
+    def markAchieved(self, name, t):
+        """saves the achieved time of an event, relative to the start of the trial."""
+        if name in self.events and math.isnan(self.events[name][3]):
+            self.events[name][3] = t
+
+    def report(self):
+        """returns a list of (name, frame, scheduled, achieved, error) tuples, times in ms, sorted by schedule."""
+        rows = []
+        for name, (frame, offset, scheduled, achieved) in sorted(self.events.items(), key = lambda e: e[1][2]):
+            rows.append((name, frame, scheduled*1000, achieved*1000, (achieved-scheduled)*1000))
+        return rows
+
+    def reportText(self):
+        return ' '.join(f'# {name}[{frame}]: {s:.1f}/{a:.1f}ms ({e:+.1f})' for name, frame, s, a, e in self.report())
+
+
+def buildTrialTimeline(frameDur, fixDur, interDur, maxRT, tms_time = math.nan):
+    """builds the timeline of a single RT trial. All durations are in s.
+
+    Args:
+        frameDur (_float_): duration of one frame.
+        fixDur (_float_): duration of the fixation cross.
+        interDur (_float_): interval between the preparatory cue and the imperative signal.
+        maxRT (_float_): the maximum allowed time to respond after the imperative signal.
+        tms_time (_float_): time of the TMS pulse relative to the imperative signal, nan for no pulse.
+
+    Returns:
+        _TrialTimeline_: frame 0 is the fixation flip.
+    """
+    timeline = TrialTimeline(frameDur)
+    timeline.add('fixation', 0.0)
+    cueFrame = timeline.add('cue', fixDur, minFrame = 1)              # each visual event needs a frame of its own
+    isFrame = timeline.add('IS', fixDur + interDur, minFrame = cueFrame + 1)
+    if not math.isnan(tms_time):
+        timeline.add('TMS', max(isFrame*frameDur + tms_time, 0.0), subFrame = True)  # relative to the snapped IS
+    timeline.add('timeout', isFrame*frameDur + maxRT)
+    timeline.nFrames = timeline.frame('timeout')
+    return timeline
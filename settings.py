@@ -0,0 +1,92 @@
+"""
+The settings of the RT tasks: the protocol (tasks, timing, number of trials, TMS stimulation times), the devices,
+the response keys and the trigger codes.
+
+They are kept here, apart from the script, so that the experiment and the design simulator (montecarlo.py) read
+the same values. Change them here.
+
+Written for RT_tasks_v4.1.py
+"""
+
+debug = True # disables serial and parallel triggers, for testing.
+
+############## Experiment settings ##################
+tasks = ['SRT_L', 'SRT_R', 'UCRT', 'ICRT']      # a list of which tasks to be run: 'SRT_L', 'SRT_R', 'UCRT', 'ICRT'
+ITI = (4000, 5000)                              # sets the range of the ITI in ms.
+PCISI = (900, 900)                              # sets the range of the interval between PC and IS in ICRT (in ms).
+maxRT = 1000                                    # the maximum allowd time to respons anfter IS, in ms
+RTtrials = 2                                   # the number of trials used to determine mean RT for TMS at 50%RT. If set to zero
+catchRatio = 0.1                                # the amount of catch trials to be added, relative to non-catch trials
+trialsPerStimtimePerCondition = 1              # the number of trials for each stimulation, per hand per task. 
+baselinesPerCondition = 1                       # the number of baseline EMG trials, per hand per task.
+bl_before = 0                                  # Number of MEP baselines before &
+bl_after = 0                                    # after the experimental tasks
+enableBreaks = True                             # enables brakes for the participant to rest
+breakInterval = 10*60                           # enables a break every 10th minute (600th s)
+maxRun = {}                                     # maximum number of trials in a row with the same 'right' and/or 'tms_time', e.g. {'right': 4, 'tms_time': 3}
+feedbackTime = 0.5                              # seconds the RT feedback is shown after each trial
+emgPort = 0                                     # TCP port of the EMG amplifier stream, MEPs are measured online. 0 disables EMG
+emgRate = 5000                                  # sampling rate of the EMG stream, in Hz
+emgChannels = 1                                 # number of channels in the EMG stream, MEPs are measured on the first
+syncInterval = 30                               # seconds between clock sync markers, sent between trials
+eegMarkerFile = ''                              # the marker file the EEG recorder writes (BrainVision .vmrk or sample;code), read online for clock sync
+eegRate = 1000                                  # sampling rate of the EEG, in Hz
+qualityTolerances = {'IS': 5, 'TMS': 2, 'marker': 2, 'droppedFrames': None}   # ms off target (IS after cue, TMS after IS) or frames dropped before a trial is re-queued, None disables a check
+maxRequeues = 2                                 # how often a trial can be replaced by a re-queued one
+dashboard = None                                # live experimenter dashboard in a separate process: 'web' (http://127.0.0.1:8765), 'terminal' or None. Also opted in with --dashboard
+realtime = True                                 # GC control, high priority, CPU pinning and warm-up around the trials, see realtime.py
+
+keyLeft = 'a' # For left index finger button presses
+keyRight = 'g' # For right index finger button presses
+keyContinue = 'd' # For user to continue (middle keypad button)
+
+######## TMS stimulation times #################
+stimTime_BL = -500                               # the time at which to stimulate with TMS for baseline EMG measurement
+stimTimes_SRT_L = [-100, 'halfRT']                # the times at which to stimulate with TMS in SRT_L task, relative to imperative signal
+stimTimes_SRT_R = [-100, 'halfRT']                # the times at which to stimulate with TMS in SRT_L task, relative to imperative signal
+stimTimes_UCRT = [-100, 'halfRT']                 # the times at which to stimulate with TMS in UCRT task, relative to imperative signal
+stimTimes_ICRT = [-100, 'halfRT']                 # the times at which to stimulate with TMS in ICRT task, relative to imperative signal
+stimTimes = {'SRT_L': stimTimes_SRT_L, 'SRT_R': stimTimes_SRT_R, 'UCRT': stimTimes_UCRT, 'ICRT': stimTimes_ICRT}
+
+#NOTE: halfRT is in fact taskandhandspecificRT/3
+
+############ paralell port trigger setup ############
+# Set trigger duration (minimum trigger duration depend on sampling rate of EEG system: e.g. 250hz == 8ms, 500hz == 4ms, 1000hz == 2ms)
+trig_wait = 0.001
+parallelAddress = 0x378                         # address of the parallel port
+
+t_goLeft = 1
+t_goRight = 2
+
+t_SRT_gL = 11 # go left in SRT
+t_SRT_gR = 12 # go right in SRT
+
+t_UCRT_gL = 21 # go left in UCRT
+t_UCRT_gR = 22 # go right in UCRT
+
+t_ICRT_gL = 31 # go left in ICRT
+t_ICRT_gR = 32 # go right in ICRT
+
+t_pCue = 50 # preparatory cue
+
+t_X = 8 # catch signal X
+t_fixStart = 9 # fixation start
+t_respL = 65 # left hand response
+t_respR = 70 # right hand response
+t_respError = 75 # a response which is neither right nor left. (should not happen)
+
+t_timeout = 80 # trial timeout - if no response
+t_trialEnd = 99 # end of current trial
+t_TMS = 100 # TMS sent
+t_startExp = 111 # start of experiment
+t_startBlock = 112 # start of block
+t_pause = 113 #pause
+t_sync = 120 # clock sync marker
+
+t_endExp = 255 # experiment finished
+
+############ serial port TMS trigger setup ###########
+# Set serial send period to 1ms
+ser_wait = 0.001
+serialPort = 'COM1'                             # the serial port of the stimulator
+serialBaudrate = 9600
@@ -0,0 +1,335 @@
+"""
+Headless simulation of the RT tasks on a virtual clock.
+
+Provides stand-ins for the parts of psychopy used by RT_tasks_v4.1.py (visual, core, event and gui), which all
+share one virtual clock. Nothing waits in real time: a flip advances the clock to the next refresh and
+core.wait advances it by the time waited. A SimulatedParticipant watches the flips and presses keys with
+reaction times drawn from an ex-Gaussian per task, so a whole session runs in seconds and writes the same
+RT_data_*.csv as a real one.
+
+Run a session with:  python RT_tasks_v4.1.py --simulate [--subject N]
+
+Written for RT_tasks_v4.1.py
+"""
+import os, math
+from types import SimpleNamespace
+
+import numpy as np
+
+from markers import MarkerPort, Edge
+
+frameRate = 60                                                        # refresh rate of the simulated screen, in Hz
+
+
+class VirtualClock:
+    """The time base of a simulated session, in s. Only moves when advanced."""
+
+    def __init__(self):
+        self.now = 0.0
+
+    def advance(self, dt):
+        if dt > 0:
+            self.now += dt
+
+    def advanceTo(self, t):
+        self.now = max(self.now, t)
+
+
+virtualClock = VirtualClock()
+
+
+def argValue(argv, name, default):
+    """returns the value after name in argv, e.g. --subject 3."""
+    if name in argv and argv.index(name) + 1 < len(argv):
+        return type(default)(argv[argv.index(name) + 1])
+    return default
+
+
+############ core ############
+class Clock:
+    """Stand-in for psychopy.core.Clock on the virtual clock."""
+
+    def __init__(self):
+        self._timeAtLastReset = virtualClock.now
+
+    def getTime(self):
+        return virtualClock.now - self._timeAtLastReset
+
+    def getLastResetTime(self):
+        return self._timeAtLastReset
+
+    def reset(self, newT = 0.0):
+        self._timeAtLastReset = virtualClock.now + newT
+
+
+def wait(secs, hogCPUperiod = 0.2):
+    virtualClock.advance(secs)
+
+
+def quit():
+    raise SystemExit(0)
+
+
+core = SimpleNamespace(Clock = Clock, wait = wait, quit = quit, getTime = lambda: virtualClock.now)
+
+
+############ visual ############
+class Window:
+    """Stand-in for psychopy.visual.Window. A flip advances the virtual clock to the next refresh, calls the
+    functions registered with callOnFlip and tells flipListeners what was drawn. With dropRate > 0 a flip misses
+    its refresh that often and comes a frame late, seeded by dropSeed."""
+
+    def __init__(self, size = (800, 600), dropRate = 0.0, dropSeed = 0, **kwargs):
+        self.size = size
+        self.frameDur = 1.0/frameRate
+        self.dropRate = dropRate
+        self._dropRng = np.random.default_rng(dropSeed)
+        self.mouseVisible = True
+        self.flipListeners = []                                       # called as listener(flipTime, namesDrawn)
+        self.nFlips = 0
+        self._drawn = []
+        self._onFlip = []
+
+    def getActualFrameRate(self, **kwargs):
+        return frameRate
+
+    def callOnFlip(self, function, *args, **kwargs):
+        self._onFlip.append((function, args, kwargs))
+
+    def flip(self, clearBuffer = True):
+        nextFrame = (math.floor(virtualClock.now/self.frameDur + 1e-9) + 1)*self.frameDur
+        if self.dropRate and self._dropRng.random() < self.dropRate:
+            nextFrame += self.frameDur                                # a dropped frame
+        virtualClock.advanceTo(nextFrame)
+        for function, args, kwargs in self._onFlip:
+            function(*args, **kwargs)
+        self._onFlip = []
+        for listener in self.flipListeners:
+            listener(virtualClock.now, self._drawn)
+        if clearBuffer:
+            self._drawn = []
+        self.nFlips += 1
+        return virtualClock.now
+
+    def clearBuffer(self):
+        self._drawn = []
+
+    def close(self):
+        pass
+
+
+class Stim:
+    """Stand-in for any psychopy stimulus. Keeps its attributes, drawing only tells the window its name."""
+
+    def __init__(self, win = None, name = None, **kwargs):
+        self.win = win
+        self.name = name
+        self.__dict__.update(kwargs)
+
+    def draw(self, win = None):
+        (win or self.win)._drawn.append(self.name)
+
+
+visual = SimpleNamespace(Window = Window, TextStim = Stim, ShapeStim = Stim, Circle = Stim, BufferImageStim = Stim)
+
+
+############ event & gui ############
+event = SimpleNamespace(getKeys = lambda *args, **kwargs: [], clearEvents = lambda *args, **kwargs: None,
+                        waitKeys = lambda keyList = None, **kwargs: [keyList[0]] if keyList else [None])
+
+
+class DlgFromDict:
+    """Stand-in for psychopy.gui.DlgFromDict: accepts the defaults, taking the first option of every list."""
+
+    def __init__(self, dictionary, title = '', fixed = (), **kwargs):
+        for key, value in dictionary.items():
+            if isinstance(value, (list, tuple)):
+                dictionary[key] = value[0]
+        self.OK = True
+
+
+gui = SimpleNamespace(DlgFromDict = DlgFromDict)
+
+
+############ triggers ############
+class SimMarkerPort(MarkerPort):
+    """A MarkerPort without worker thread: every marker becomes an Edge on the virtual clock right away."""
+
+    def __init__(self, pulseWidth = 0.001, clock = None):
+        self.backend = None
+        self.pulseWidth = pulseWidth
+        self.gap = pulseWidth
+        self.clock = clock or core.getTime
+        self.edges = []
+        self.merged = 0
+        self.highPriority = False
+
+    def send(self, code):
+        t = self.clock()
+        if self.edges and self.edges[-1].clear + self.gap > t:        # back-to-back markers follow each other
+            t = self.edges[-1].clear + self.gap
+        self.edges.append(Edge(code, self.clock(), t, t + self.pulseWidth))
+
+    def waitSent(self, timeout = 0.05):
+        return True                                                   # the edges are there as soon as they are sent
+
+    def flush(self, timeout = 1.0):
+        pass
+
+    def close(self):
+        pass
+
+
+class SimEEGRecorder:
+    """The marker channel of a simulated EEG recording. Every marker edge sent is recorded at the sample the EEG
+    clock, which has its own offset and drift, puts it on, and appended to a BrainVision marker file. Works as the
+    reader of a clocksync.ClockSync.
+
+    Args:
+        markers (_MarkerPort_): the port whose edges are recorded.
+        path (_str_): the .vmrk file to write.
+        fs (_float_): sampling rate of the EEG in Hz.
+        offset (_float_): EEG time in s at local time 0.
+        drift (_float_): rate error of the EEG clock, e.g. 20e-6 for 20 ppm.
+        jitter (_float_): SD of the detection time of a marker in s.
+        append (_bool_): the session is resumed: the recording went on, the file is continued and the EEG clock
+            carries on restartGap s after its last marker, while the local clock starts at 0 again.
+    """
+
+    def __init__(self, markers, path, fs = 1000, offset = 12.3, drift = 20e-6, jitter = 0.0002, seed = 0,
+                 append = False, restartGap = 30.0):
+        self.markers, self.path, self.fs = markers, path, fs
+        self.offset, self.drift, self.jitter = offset, drift, jitter
+        self.rng = np.random.default_rng(seed)
+        self.recorded = 0                                             # edges recorded so far
+        self.nMarkers = 1
+        if append and os.path.exists(path):
+            from clocksync import parseMarker
+            with open(path) as f:
+                lines = f.read().splitlines()
+            self.nMarkers = sum(line.startswith('Mk') for line in lines)
+            samples = [m[0] for m in map(parseMarker, lines) if m is not None]
+            self.offset = round((samples[-1]/fs if samples else 0) + restartGap, 3)
+            self.rng = np.random.default_rng([seed, self.nMarkers])
+        else:
+            with open(path, 'w') as f:
+                f.write(f'Brain Vision Data Exchange Marker File, Version 1.0\n[Marker Infos]\nMk1=New Segment,,1,1,0\n')
+
+    def read(self):
+        """records the edges sent since the last read and returns them as (sample, code)."""
+        edges = self.markers.edges[self.recorded:]
+        self.recorded += len(edges)
+        new = []
+        for e in edges:
+            t = self.offset + e.set*(1 + self.drift) + self.rng.normal(0, self.jitter)
+            new.append((int(t*self.fs), e.code))
+        with open(self.path, 'a') as f:
+            for sample, code in new:
+                self.nMarkers += 1
+                f.write(f'Mk{self.nMarkers}=Stimulus,S{code:3d},{sample},1,0\n')
+        return new
+
+
+############ EMG ############
+class SimulatedEMGSource:
+    """An EMG source for emg.EMGStream on the virtual clock: noise, a TMS artefact at every pulse and a biphasic
+    MEP after it. Samples are made up to the current time whenever it is read.
+
+    Args:
+        fs (_float_): sampling rate in Hz.
+        noise (_float_): SD of the background EMG in uV.
+        mep (_tuple_): median amplitude (uV, log-normal) and latency (ms) of the MEPs.
+        seed (_int_): seed of the random generator.
+    """
+
+    def __init__(self, fs = 5000, noise = 10, mep = (1000, 22), seed = 0, clock = None):
+        self.fs, self.noise, self.mep = fs, noise, mep
+        self.rng = np.random.default_rng(seed)
+        self.clock = clock or core.getTime
+        self.pulses = []                                              # (time, amplitude) of every pulse
+        self.made = 0
+
+    def open(self):
+        self.start = self.clock()
+
+    def pulse(self, trialN, t):
+        self.pulses.append((t, self.mep[0]*self.rng.lognormal(0, 0.4)))
+
+    def read(self):
+        due = int((self.clock() - self.start)*self.fs)
+        if due <= self.made:
+            return None
+        times = self.start + np.arange(self.made, due)/self.fs
+        x = self.rng.normal(0, self.noise, len(times))
+        for t, amplitude in self.pulses:
+            s = times - t
+            x += np.where((s >= 0) & (s < 0.002), 5000, 0)                # stimulation artefact
+            s = s - self.mep[1]/1000
+            inMEP = (s >= 0) & (s < 0.02)
+            x += np.where(inMEP, amplitude/2*np.sin(2*np.pi*50*s)*np.sin(np.pi*s/0.02), 0)
+        self.pulses = [p for p in self.pulses if p[0] > times[-1] - 0.1]
+        self.made = due
+        return times, x[:, None].astype(np.float32)
+
+    def close(self):
+        pass
+
+
+############ participant ############
+rtModels = {                                                          # ex-Gaussian (mu, sigma, tau) of RT per task, in ms
+    'SRT_L': (230, 25, 40),
+    'SRT_R': (220, 25, 40),
+    'UCRT': (330, 40, 70),
+    'ICRT': (280, 35, 50),
+}
+
+
+class SimulatedParticipant:
+    """Responds to the imperative signal like a participant would.
+
+    Args:
+        backend (_responses.ScriptedBackend_): where the key presses go.
+        keyLeft, keyRight (_str_): the response keys.
+        seed (_int_): seed of the participant's random generator.
+        rtModels (_dict_): task: (mu, sigma, tau) of the ex-Gaussian RT distribution in ms.
+        pError (_float_): chance of pressing the wrong key.
+        pFalseAlarm (_float_): chance of responding to a catch trial.
+        pMiss (_float_): chance of not responding at all.
+    """
+    goNames = ('SRTgo', 'goRight', 'goLeft')                          # single stimuli, or pre-rendered frames named IS_*
+
+    def __init__(self, backend, keyLeft, keyRight, seed = 0, rtModels = rtModels, pError = 0.03, pFalseAlarm = 0.1, pMiss = 0.01):
+        self.backend = backend
+        self.keyLeft, self.keyRight = keyLeft, keyRight
+        self.rng = np.random.default_rng(seed)
+        self.rtModels = rtModels
+        self.pError, self.pFalseAlarm, self.pMiss = pError, pFalseAlarm, pMiss
+        self.trial = None                                             # (task, right, is_catch) of the upcoming trial
+        self.rts = []                                                 # every RT the participant intended, in ms
+
+    def sampleRT(self, task):
+        mu, sigma, tau = self.rtModels[task]
+        return max(self.rng.normal(mu, sigma) + self.rng.exponential(tau), 80.0)
+
+    def prepare(self, task, right, is_catch):
+        """the participant knows the task from the instructions, but not when or where the signal comes."""
+        self.trial = (task, right, is_catch)
+
+    def onFlip(self, t, drawn):
+        if self.trial is None:
+            return
+        task, right, is_catch = self.trial
+        if is_catch and any(name == 'catchX' or name.startswith('catch') for name in drawn):
+            respond = self.rng.random() < self.pFalseAlarm
+        elif not is_catch and any(name in self.goNames or name.startswith('IS_') for name in drawn):
+            respond = self.rng.random() >= self.pMiss
+        else:
+            return
+        self.trial = None
+        if not respond:
+            return
+        if self.rng.random() < self.pError:
+            right = not right
+        rt = self.sampleRT(task)
+        self.rts.append(rt)
+        self.backend.press(self.keyRight if right else self.keyLeft, t - self.backend.clock.getLastResetTime() + rt/1000)
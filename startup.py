@@ -0,0 +1,184 @@
+"""
+Startup of the RT tasks: preflight checks, preparation while the dialog is open, and startup timing.
+
+The session used to import everything, open the parallel and serial ports at module load and only then show the
+dialog, after which the folders, files, window and stimuli were made one by one, so a missing port or display
+only showed up late, as a traceback. Now the heavy imports are made where they are needed, and while the
+experimenter fills in the dialog a Preflight runs on a thread pool: it opens the ports, checks the output folders,
+sends triggers through a loopback and builds the trial plans of the Subject IDs most likely to be entered. The
+checks which import pyglet (the display and the stimulus modules) run on the main thread after the dialog, since
+pyglet must not be set up off the main thread while the dialog's GUI runs on it. Then the results are collected
+and reported as PASS/FAIL, and the session stops there if a required check failed.
+
+The StartupTimer marks the phases from the first line of the script to the first instruction screen, with and
+without the time the dialog was open.
+
+Written for RT_tasks_v4.1.py
+"""
+import os, re, time, shutil, traceback
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+
+Check = namedtuple('Check', ['name', 'ok', 'required', 'value', 'detail', 'seconds'])
+
+
+class Preflight:
+    """Startup checks and preparations, run in parallel.
+
+    Args:
+        workers (_int_): number of threads, by default one per check.
+    """
+
+    def __init__(self, workers = None):
+        self.workers = workers
+        self.checks = {}                                              # name: (function, required, describe, mainThread)
+        self.futures = {}
+        self.results = {}
+        self._pool = None
+
+    def add(self, name, function, required = True, describe = str, mainThread = False):
+        """adds a check. function() returns a value (e.g. the opened port) or raises if the check failed,
+        describe(value) is the text of the report. A mainThread check is not started, it runs in wait()."""
+        self.checks[name] = (function, required, describe, mainThread)
+
+    def start(self):
+        """starts every check but the mainThread ones, returns right away."""
+        pooled = {name: check[:3] for name, check in self.checks.items() if not check[3]}
+        self._pool = ThreadPoolExecutor(self.workers or max(len(pooled), 1), thread_name_prefix = 'Preflight')
+        self.futures = {name: self._pool.submit(self._run, name, *check) for name, check in pooled.items()}
+        return self
+
+    @staticmethod
+    def _run(name, function, required, describe):
+        start = time.perf_counter()
+        try:
+            value = function()
+            return Check(name, True, required, value, describe(value), time.perf_counter() - start)
+        except Exception as e:                                        # every failure goes into the report
+            detail = f'{type(e).__name__}: {e}' if str(e) else traceback.format_exc(limit = 1).strip().splitlines()[-1]
+            return Check(name, False, required, None, detail, time.perf_counter() - start)
+
+    def wait(self, timeout = 30):
+        """runs the mainThread checks and waits for the others, one which takes longer than timeout fails.
+        Returns the Checks."""
+        for name, (function, required, describe, mainThread) in self.checks.items():
+            if mainThread:
+                self.results[name] = self._run(name, function, required, describe)
+        deadline = time.perf_counter() + timeout
+        for name, future in self.futures.items():
+            try:
+                self.results[name] = future.result(max(deadline - time.perf_counter(), 0))
+            except FutureTimeout:
+                self.results[name] = Check(name, False, self.checks[name][1], None, f'no result after {timeout} s', timeout)
+        self._pool.shutdown(wait = False)
+        self.results = {name: self.results[name] for name in self.checks}   # reported in the order they were added
+        return list(self.results.values())
+
+    def value(self, name):
+        """the value of a check which passed, None if it failed."""
+        return self.results[name].value if name in self.results else None
+
+    def passed(self):
+        """True if every required check passed."""
+        return all(c.ok or not c.required for c in self.results.values())
+
+    def report(self):
+        lines = [f'#   {"PASS" if c.ok else "FAIL" if c.required else "WARN"}  {c.name:18} {c.detail} ({c.seconds*1000:.0f} ms)'
+                 for c in self.results.values()]
+        return f'# Preflight: {"passed" if self.passed() else "FAILED"}\n' + '\n'.join(lines)
+
+
+############ checks ############
+def checkFolders(root, folders = ('info', 'log', 'data')):
+    """makes the output folders and writes, reads back and removes a file in each. Returns the free space."""
+    for folder in folders:
+        path = os.path.join(root, folder)
+        os.makedirs(path, exist_ok = True)
+        probe = os.path.join(path, f'.preflight_{os.getpid()}')
+        with open(probe, 'w') as f:
+            f.write('ok')
+            f.flush()
+            os.fsync(f.fileno())
+        with open(probe) as f:
+            ok = f.read() == 'ok'
+        os.remove(probe)
+        if not ok:
+            raise OSError(f'{path} did not read back what was written')
+    return f'{", ".join(folders)} writable, {shutil.disk_usage(root).free/1e9:.1f} GB free'
+
+
+def checkDisplay(size = None):
+    """returns the screens pyglet finds. Raises if there is none, or if none is at least size (w, h).
+    Imports pyglet, so run it on the main thread."""
+    import pyglet
+    display = getattr(pyglet, 'canvas', None) or pyglet.display   # pyglet.display since pyglet 2.1
+    screens = display.get_display().get_screens()
+    if not screens:
+        raise RuntimeError('no screen found')
+    if size and not any(s.width >= size[0] and s.height >= size[1] for s in screens):
+        raise RuntimeError(f'no screen of {size[0]}x{size[1]}: {[(s.width, s.height) for s in screens]}')
+    return ', '.join(f'{s.width}x{s.height}' for s in screens)
+
+
+def checkLoopback(nPulses = 20):
+    """sends triggers through the serial code path and a pseudo-terminal, see tms.measureLoopback."""
+    from tms import measureLoopback
+    result = measureLoopback(nPulses, interval = 0.002)
+    if result['received'] != nPulses:
+        raise RuntimeError(f'{result["received"]} of {nPulses} triggers arrived')
+    return (f'{nPulses} triggers, arrival median {result["arrival"]["median"]:.3f} ms, max {result["arrival"]["max"]:.3f} ms'
+            f' (software only, the serial line adds {result["byteTime"]:.2f} ms)')
+
+
+def likelySubjects(root):
+    """the Subject IDs most likely to be entered: the last one (to resume it) and the next one."""
+    folder = os.path.join(root, 'info')
+    names = os.listdir(folder) if os.path.isdir(folder) else []
+    ids = [int(m.group(1)) for m in map(re.compile(r'info_(\d+)').match, names) if m]
+    if not ids:
+        return [0]
+    return [max(ids) + 1, max(ids)]
+
+
+############ timing ############
+class StartupTimer:
+    """Marks the phases of the startup on time.perf_counter.
+
+    Args:
+        start (_float_): the launch, by default now. Make it on the first line of the script.
+    """
+
+    def __init__(self, start = None):
+        self.start = time.perf_counter() if start is None else start
+        self.marks = []                                               # (phase, time since start) in order
+        self.waited = 0.0                                             # time spent waiting for the experimenter
+
+    def mark(self, phase):
+        self.marks.append((phase, time.perf_counter() - self.start))
+
+    def dialog(self, show):
+        """shows the dialog through show() and keeps the time it was open apart. Returns what show returned."""
+        start = time.perf_counter()
+        result = show()
+        self.waited += time.perf_counter() - start
+        self.mark('dialog')
+        return result
+
+    def since(self, phase):
+        """seconds from the launch until phase, None if not reached."""
+        return next((t for p, t in self.marks if p == phase), None)
+
+    def report(self):
+        phases, last = [], 0.0
+        for phase, t in self.marks:
+            phases.append(f'{phase} {t - last:.3f}')
+            last = t
+        total = self.marks[-1][1] if self.marks else 0.0
+        return (f'# Startup: {", ".join(phases)} s. Launch to {self.marks[-1][0] if self.marks else "start"} '
+                f'{total:.3f} s, {total - self.waited:.3f} s without the {self.waited:.3f} s the dialog was open')
+
+
+def parseReport(text):
+    """returns {'total': s, 'machine': s, 'dialog': s} of the last StartupTimer report in text."""
+    found = re.findall(r'# Startup: .* Launch to .* (\S+) s, (\S+) s without the (\S+) s the dialog', text)
+    return dict(zip(('total', 'machine', 'dialog'), map(float, found[-1]))) if found else {}
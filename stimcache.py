@@ -0,0 +1,99 @@
+"""
+Pre-rendered stimuli for the RT tasks.
+
+StimulusCache renders every composite frame (goal + ball, both goals in UCRT, catch X, ...) once at startup into
+a single visual.BufferImageStim, so a frame costs one blit however many shapes it is made of.
+
+FeedbackCache keeps the "RT : xxx ms" feedback texts. Setting the text of a TextStim rebuilds its texture, so
+each (rt, correct) text is built once and memoized, least recently used first out when maxSize is reached. The
+likely RTs can be built ahead with prebuild, a few at a time while the feedback is shown.
+
+Written for RT_tasks_v4.1.py
+"""
+import math, time
+from collections import OrderedDict
+
+
+class StimulusCache:
+    """Composite frames rendered into single images.
+
+    Args:
+        win (_visual.Window_): the window the frames are drawn in.
+        frames (_dict_): name: list of stimuli, drawn in list order.
+        visual (_module_): psychopy.visual, or the stand-in of simulation.py.
+    """
+
+    def __init__(self, win, frames, visual):
+        self.frames = {}
+        for name, stims in frames.items():
+            self.frames[name] = visual.BufferImageStim(win, stim = list(stims), name = name)
+        win.clearBuffer()                                             # BufferImageStim leaves the last capture behind
+
+    def __getitem__(self, name):
+        return self.frames[name]
+
+    def __contains__(self, name):
+        return name in self.frames
+
+
+class FeedbackCache:
+    """Memoized feedback texts.
+
+    Args:
+        win (_visual.Window_): the window the feedback is drawn in.
+        visual (_module_): psychopy.visual, or the stand-in of simulation.py.
+        maxSize (_int_): the maximum number of texts kept.
+        colorCorrect, colorWrong: colors of correct and incorrect feedback.
+        **textKwargs: passed on to visual.TextStim.
+    """
+
+    def __init__(self, win, visual, maxSize = 256, colorCorrect = (0,128,0), colorWrong = (255,0,0), **textKwargs):
+        self.win = win
+        self.visual = visual
+        self.maxSize = maxSize
+        self.colors = {True: list(colorCorrect), False: list(colorWrong)}
+        self.textKwargs = textKwargs
+        self.built = 0                                                # number of TextStims created, for diagnostics
+        self._stims = OrderedDict()
+        self._fixed = {}                                              # timeout and incorrect states, never dropped
+        for correct in (True, False):
+            self._fixed[('nan', correct)] = self._build(math.nan, correct)
+
+    @staticmethod
+    def text(rt):
+        return f'RT : {rt}ms'
+
+    def get(self, rt, correct):
+        """returns the feedback stimulus of rt (in ms, nan if no response) shown as correct or not."""
+        key = ('nan' if isinstance(rt, float) and math.isnan(rt) else rt, bool(correct))
+        if key in self._fixed:
+            return self._fixed[key]
+        stim = self._stims.get(key)
+        if stim is None:
+            stim = self._build(rt, correct)
+            self._stims[key] = stim
+            if len(self._stims) > self.maxSize:
+                self._stims.popitem(last = False)
+        else:
+            self._stims.move_to_end(key)
+        return stim
+
+    def _build(self, rt, correct):
+        self.built += 1
+        return self.visual.TextStim(win = self.win, text = self.text(rt), color = self.colors[bool(correct)],
+                                    name = 'feedback', **self.textKwargs)
+
+    def prebuild(self, rts, correct = True, until = None, clock = time.perf_counter):
+        """builds the feedback of the rts in rts which are not built yet, e.g. range(100, 600), so feedback rarely builds
+        a texture. With until it stops once clock() passes it, call it again to go on. Returns the number built."""
+        built = 0
+        for rt in rts:
+            if until is not None and clock() >= until:
+                break
+            if (rt, bool(correct)) not in self._stims:
+                self.get(rt, correct)
+                built += 1
+        return built
+
+    def __len__(self):
+        return len(self._stims) + len(self._fixed)
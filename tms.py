@@ -0,0 +1,211 @@
+"""
+TMS trigger driver for the RT tasks.
+
+The stimulator is triggered by a single byte on a serial port. The driver keeps the pulse payload pre-encoded,
+arms the port before a trial (empties its buffers), timestamps when the write call returns and when the byte has
+left the port, and keeps the latency of every pulse so it can be written into the trial record.
+
+Backends: SerialBackend (pyserial), NullBackend (no hardware) and PtyLoopback, a Linux pseudo-terminal that
+stands in for the stimulator. The loopback end reads what was written and timestamps its arrival, so trigger
+latency and throughput can be measured through the same pyserial code path without a stimulator. A pty ignores
+the baud rate, so this only measures the software overhead: a real port adds the time the bits take on the wire,
+10 bits per byte at the baud rate (1.04 ms a byte at 9600 baud), which measureLoopback reports as byteTime.
+
+Written for RT_tasks_v4.1.py
+"""
+import os, time, threading, queue
+from collections import namedtuple
+
+import numpy as np
+
+Pulse = namedtuple('Pulse', ['start', 'written', 'drained'])          # times on the driver clock, in s
+
+
+class NullBackend:
+    """A port that does nothing. Used when debugging without hardware."""
+    name = 'null'
+
+    def write(self, payload):
+        return len(payload)
+
+    def drain(self):
+        pass
+
+    def reset(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class SerialBackend:
+    """A serial port, e.g. COM1 on the lab PC or the device of a PtyLoopback."""
+    name = 'serial'
+
+    def __init__(self, port = 'COM1', baudrate = 9600):
+        import serial                                                 # only needed when a port is used
+        self.ser = serial.Serial(port, baudrate = baudrate, timeout = 0, write_timeout = 0.1)
+
+    def write(self, payload):
+        return self.ser.write(payload)
+
+    def drain(self):
+        self.ser.flush()                                              # returns when the bytes have left the port
+
+    def reset(self):
+        self.ser.reset_output_buffer()
+        self.ser.reset_input_buffer()
+
+    def close(self):
+        self.ser.close()
+
+
+class PtyLoopback:
+    """A pseudo-terminal standing in for the stimulator (Linux/macOS only).
+
+    Open a SerialBackend on .port; everything written to it is read back on the other end by a thread,
+    which saves (arrival time, byte) in .received. Bytes arrive as soon as they are written whatever the baud rate,
+    the serial line itself is not modelled.
+    """
+
+    def __init__(self, clock = time.perf_counter):
+        import tty
+        self.clock = clock
+        self._master, self._slave = os.openpty()
+        tty.setraw(self._slave)                                       # no line discipline between writer and reader
+        self.port = os.ttyname(self._slave)
+        self.received = []
+        self._running = True
+        self._reader = threading.Thread(target = self._read, name = 'PtyLoopback', daemon = True)
+        self._reader.start()
+
+    def _read(self):
+        import select
+        while self._running:
+            ready, _, _ = select.select([self._master], [], [], 0.05)
+            if not ready:
+                continue
+            try:
+                data = os.read(self._master, 4096)
+            except OSError:
+                break
+            t = self.clock()
+            self.received.extend((t, b) for b in data)
+
+    def close(self):
+        self._running = False
+        self._reader.join(timeout = 1.0)
+        os.close(self._master)
+        os.close(self._slave)
+
+
+class TMSDriver:
+    """Sends TMS triggers and measures how long they take.
+
+    Args:
+        backend (_object_): anything with write(bytes), drain(), reset() and close().
+        code (_int_): the byte which triggers the stimulator.
+        pulseWidth (_float_): time before the port is set back to 0, in s. The clear is written from a thread.
+        drain (_bool_): wait until the byte has left the port before returning, the latency is then measured until
+         the byte has left. At 9600 baud this costs ~1 ms.
+        clock (_callable_): returns the current time in s.
+    """
+
+    def __init__(self, backend, code = 100, pulseWidth = 0.001, drain = False, clock = time.perf_counter):
+        self.backend = backend
+        self.payload = bytes([code])                                  # pre-encoded, nothing is built when firing
+        self.clearPayload = bytes([0])
+        self.pulseWidth = pulseWidth
+        self.drain = drain
+        self.clock = clock
+        self.pulses = []                                              # Pulse of every trigger sent
+        self.armed = False
+        self._lock = threading.Lock()                                 # the port is used by the trial loop and the clear thread
+        self._clears = queue.SimpleQueue()
+        self._clearer = threading.Thread(target = self._clear, name = 'TMSClear', daemon = True)
+        self._clearer.start()
+
+    def arm(self):
+        """empties the port buffers so the next pulse goes out immediately. Call this before the trial."""
+        with self._lock:
+            self.backend.reset()
+        self.armed = True
+
+    def fire(self):
+        """sends the trigger byte and returns its latency in ms, see lastLatency."""
+        with self._lock:
+            start = self.clock()
+            self.backend.write(self.payload)
+            written = self.clock()
+            if self.drain:
+                self.backend.drain()
+            drained = self.clock() if self.drain else float('nan')
+        self.pulses.append(Pulse(start, written, drained))
+        self.armed = False
+        self._clears.put((drained if self.drain else written) + self.pulseWidth)
+        return self.lastLatency()
+
+    def _clear(self):
+        while True:
+            t = self._clears.get()
+            if t is None:
+                break
+            delay = t - self.clock()
+            if delay > 0:
+                time.sleep(delay)
+            with self._lock:
+                self.backend.write(self.clearPayload)
+
+    def lastLatency(self):
+        """latency of the last pulse in ms: until drained if draining, else until the write call returned."""
+        if not self.pulses:
+            return float('nan')
+        p = self.pulses[-1]
+        return ((p.drained if self.drain else p.written) - p.start)*1000
+
+    def latencyStats(self):
+        """returns n, mean, median, max and std of the latencies in ms, until drained if draining."""
+        if not self.pulses:
+            return {'n': 0}
+        lat = np.array([(p.drained if self.drain else p.written) - p.start for p in self.pulses])*1000
+        return {'n': len(lat), 'mean': float(lat.mean()), 'median': float(np.median(lat)), 'max': float(lat.max()), 'std': float(lat.std())}
+
+    def close(self):
+        self._clears.put(None)
+        self._clearer.join(timeout = 1.0)
+        with self._lock:
+            self.backend.close()
+
+
+def measureLoopback(nPulses = 200, baudrate = 9600, interval = 0.005):
+    """fires nPulses through a PtyLoopback and returns write, drain and arrival latency stats in ms,
+    plus the throughput in pulses/s. Needs pyserial and a pseudo-terminal (Linux). The latencies are the software
+    overhead only; byteTime is the time the payload would take on a real line at baudrate, in ms."""
+    loop = PtyLoopback()
+    driver = TMSDriver(SerialBackend(loop.port, baudrate = baudrate), drain = True, pulseWidth = interval/2, clock = loop.clock)
+    t0 = loop.clock()
+    for i in range(nPulses):
+        driver.arm()
+        driver.fire()
+        time.sleep(interval)
+    elapsed = loop.clock() - t0
+    time.sleep(0.1)
+    driver.close()
+    loop.close()
+
+    arrivals = np.array([t for t, b in loop.received if b == driver.payload[0]])
+    start = np.array([p.start for p in driver.pulses])
+    n = min(len(arrivals), len(start))
+    result = {'pulses': nPulses, 'received': len(arrivals), 'throughput': nPulses/elapsed,
+              'byteTime': 10*len(driver.payload)/baudrate*1000}          # start, 8 data and stop bit per byte
+    for name, lat in (('write', np.array([p.written - p.start for p in driver.pulses])),
+                      ('drain', np.array([p.drained - p.start for p in driver.pulses])),
+                      ('arrival', arrivals[:n] - start[:n])):
+        lat = lat*1000
+        result[name] = {'mean': float(lat.mean()), 'median': float(np.median(lat)), 'p99': float(np.percentile(lat, 99)), 'max': float(lat.max())}
+    return result
+
+
+if __name__ == '__main__':
+    for name, value in measureLoopback().items():
+        print(f'{name}: {value}')